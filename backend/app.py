@@ -3,7 +3,7 @@ from typing import List
 import cv2
 import gradio as gr
 import numpy as np
-from inference import get_sam_predictor, run_inference
+from inference import get_sam_predictor, predict_object
 
 # points color and marker
 COLORS = [(255, 0, 0), (0, 255, 0)]
@@ -47,7 +47,12 @@ def select_point(predictor,
         sel_pix.append((evt.index, 1))
     
     # run inference on the original image
-    o_masks = run_inference(predictor, original_img, sel_pix, multi_object)
+    (point, label), = sel_pix
+    mask, _ = predict_object(predictor, [point], [label])
+    if not label and not multi_object:
+        # a lone background point selects nothing
+        mask = np.zeros_like(mask)
+    o_masks = [(mask, 'mask_0')]
     
     # Create visualization on the display image
     img = display_img.copy()
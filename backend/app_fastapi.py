@@ -1,19 +1,39 @@
-from typing import List 
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from typing import List, Literal, Optional
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from starlette.concurrency import run_in_threadpool
 from PIL import Image
 from pydantic import BaseModel
-import cv2
 import numpy as np
-from classifiers import predict_avalanche_type, predict_spam
-from inference import get_sam_predictor 
+import classifiers
+from classifiers import predict_avalanche_type, predict_spam, warmup as warmup_classifier
+from inference import SAM2_VARIANTS, embedding_cache, get_sam_model, get_sam_predictor
+import asyncio
 import base64
+import functools
+import gzip
 import io
-from sam_utils import select_point,overlay
-import shutil
-import os
+import time
+import mask_encoding
+import metrics
+from classifier_backends import CLASSIFIERS
+from decoding import ImageTooLargeError, to_original
+from dedup import DedupIndex
+from sam_utils import refine_masks, select_point, unpack_mask
+from sessions import SessionStore
+from uploads import UploadStore
+from executor import QueueFullError, executors
+from config import (DEDUP_MAX_DISTANCE, IMAGE_FORMAT, IMAGE_QUALITY, MASK_RESPONSE_FORMAT, PREVIEW_MAX_SIDE,
+                    SAM_MODEL, SAM_PREVIEW_MODEL, SPECULATIVE_EMBEDDING, TERRAIN_CELL_SIZE_M,
+                    TERRAIN_MIN_HIT_FRACTION, WARMUP)
+from elevation import get_dem
+from terrain import estimate_area
+from photo_metadata import read_metadata
+from reports import ReportStore
+from sensors import find_sensor
 from helpers import *
+from helpers import _steepness_angles
 
 
 
@@ -28,65 +48,353 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global states
-predictor = None
-# IDEA: Just save the original image and whenever we show the image
-# we apply the 'counter' number of transformations to it
-original_image = None
-# keeps track of how many masks there are in the image
-counter = 0
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-TEMP_DIR = os.path.join(SCRIPT_DIR, 'temp')
-print(TEMP_DIR)
-
-class Point(BaseModel):
+@app.middleware("http")
+async def instrument(request, call_next):
+    """Log the stage timings of every request and count it in the metrics."""
+    start = time.perf_counter()
+    with metrics.request_timings() as timings:
+        response = await call_next(request)
+    # the route template, so ids in paths don't become separate series
+    route = request.scope.get("route")
+    metrics.log_request(request.method, request.url.path, response.status_code, time.perf_counter() - start,
+                        timings, route=route.path if route is not None else None)
+    return response
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request, e: QueueFullError):
+    return JSONResponse(
+        content={"error": str(e)},
+        status_code=429,
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+# Models loading in the background, by component name
+warmup_tasks = {}
+
+@app.on_event("startup")
+async def start_warmup():
+    """
+    Load the classifiers and SAM2 models in parallel without blocking the
+    server; /readyz reports 503 until they are done. Without WARMUP they
+    load lazily on the first request that needs them.
+    """
+    if not WARMUP:
+        return
+    loop = asyncio.get_running_loop()
+    for name in ("binary", "avalanche_type"):
+        warmup_tasks[name] = loop.run_in_executor(None, warmup_classifier, name)
+    for variant in {SAM_MODEL, SAM_PREVIEW_MODEL} - {None}:
+        warmup_tasks[f"sam2_{variant}"] = loop.run_in_executor(None, get_sam_model, 'cpu', variant)
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the server answers, whether or not the models are loaded."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: 200 once every model has been loaded."""
+    components = {}
+    for name, task in warmup_tasks.items():
+        if not task.done():
+            components[name] = "loading"
+        elif task.exception() is not None:
+            components[name] = f"failed: {task.exception()}"
+        else:
+            components[name] = "ready"
+    ready = all(state == "ready" for state in components.values())
+    return JSONResponse(
+        content={"status": "ready" if ready else "not ready", "components": components},
+        status_code=200 if ready else 503,
+    )
+
+def collect_app_metrics():
+    """Gauges of the model queues, caches and sessions, read on every scrape."""
+    caches = {"sam_embeddings": embedding_cache, "uploads": uploads._cache}
+    batchers = getattr(classifiers, "_batchers", {})
+    dedup_lookups = {}
+    if dedup is not None:
+        dedup_lookups = {"exact": dedup.exact_hits, "near": dedup.near_hits, "miss": dedup.misses}
+    return [
+        ("avalanche_executor_pending", "gauge", "Model calls running or queued per executor",
+         [({"executor": name}, e.pending) for name, e in executors.items()]),
+        ("avalanche_executor_queued", "gauge", "Model calls waiting for a thread per executor",
+         [({"executor": name}, e.queued) for name, e in executors.items()]),
+        ("avalanche_batcher_queued", "gauge", "Inputs waiting for a classifier forward pass",
+         [({"model": name}, b.qsize()) for name, b in list(batchers.items())]),
+        ("avalanche_cache_hits_total", "counter", "Cache hits",
+         [({"cache": name}, c.hits) for name, c in caches.items()]),
+        ("avalanche_cache_misses_total", "counter", "Cache misses",
+         [({"cache": name}, c.misses) for name, c in caches.items()]),
+        ("avalanche_cache_bytes", "gauge", "Memory held by a cache",
+         [({"cache": name}, c.nbytes) for name, c in caches.items()]),
+        ("avalanche_cache_entries", "gauge", "Entries in a cache",
+         [({"cache": name}, len(c)) for name, c in caches.items()]),
+        ("avalanche_dedup_lookups_total", "counter", "Uploads looked up in the duplicate index",
+         [({"result": result}, count) for result, count in dedup_lookups.items()]),
+        ("avalanche_dedup_entries", "gauge", "Distinct photos in the duplicate index",
+         [({}, len(dedup) if dedup is not None else 0)]),
+        ("avalanche_sessions", "gauge", "Open segmentation sessions", [({}, len(sessions))]),
+        ("avalanche_sessions_bytes", "gauge", "Memory held by segmentation sessions",
+         [({}, sessions.nbytes())]),
+    ]
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Uploads are decoded once and then referenced by image id
+uploads = UploadStore()
+
+# Verdicts and embeddings shared by near-duplicate uploads
+dedup = DedupIndex() if DEDUP_MAX_DISTANCE >= 0 else None
+
+# Segmentation state per uploaded image. We just save the original image
+# and whenever we show the image we apply the session's masks to it
+sessions = SessionStore()
+
+metrics.register_collector(collect_app_metrics)
+
+# see render_masks, validated before a request changes the session
+ResponseFormat = Literal["image", "preview", "rle"]
+
+class SessionRequest(BaseModel):
+    session_id: str
+    response_format: Optional[ResponseFormat] = None
+
+class Point(SessionRequest):
     x: int
     y: int
+    # 1 adds the point to the object, 0 excludes it
+    label: int = 1
+    # start another object instead of refining the last one
+    new_object: bool = False
+
+def get_session(session_id: str):
+    try:
+        return sessions.get(session_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Unknown or expired session")
+
+async def resolve_upload(file: Optional[UploadFile], image_id: Optional[str]):
+    """Return the upload referenced by `image_id`, or store the posted file."""
+    if image_id is not None:
+        try:
+            return uploads.get(image_id)
+        except KeyError:
+            raise HTTPException(status_code=404, detail="Unknown or expired image id")
+    if file is None:
+        raise HTTPException(status_code=422, detail="Either a file or an image_id is required")
+    image_data = await file.read()
+    try:
+        return await run_in_threadpool(uploads.add, image_data)
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
 
 def encode_image(image_array: np.ndarray) -> str:
     """Convert numpy array to base64 string."""
-    success, encoded_image = cv2.imencode('.png', image_array)
-    if success:
-        return base64.b64encode(encoded_image.tobytes()).decode('utf-8')
-    return ""
-
-def decode_image(base64_string: str) -> np.ndarray:
-    """Convert base64 string to numpy array."""
-    img_data = base64.b64decode(base64_string)
-    img_array = np.frombuffer(img_data, np.uint8)
-    return cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-
-def overlay_mask(image: np.ndarray, mask: np.ndarray, alpha: float = 0.5):
-    """Overlay mask on image with transparency."""
-    overlay = image.copy()
-    if mask.any():
-        overlay[mask > 0] = [255, 0, 0]  # Red overlay for mask
-    return cv2.addWeighted(overlay, alpha, image, 1 - alpha, 0)
+    return base64.b64encode(mask_encoding.encode_image(image_array, IMAGE_FORMAT, IMAGE_QUALITY)).decode('utf-8')
+
+def accepts_gzip(request: Request) -> bool:
+    """Whether the request's Accept-Encoding allows a gzip body."""
+    for coding in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            quality = params.replace(" ", "").lower().removeprefix("q=")
+            try:
+                return not quality or float(quality) > 0
+            except ValueError:
+                return False
+    return False
+
+def binary_response(body: bytes, gzip_ok: bool, headers=None):
+    """An RLE body, gzipped for clients that accept it."""
+    headers = dict(headers or {})
+    if gzip_ok:
+        # the browser inflates it transparently, runs of smooth masks compress ~3x
+        headers["Content-Encoding"] = "gzip"
+        body = gzip.compress(body, 6)
+    return Response(content=body, media_type="application/octet-stream", headers=headers)
+
+def render_masks(session, response_format, operation, masks=(), gzip_ok=False):
+    """
+    Response for a change of the session's masks: the full composited image as
+    base64 JSON, a downscaled composite or only the changed masks as binary RLE.
+    """
+    response_format = response_format or MASK_RESPONSE_FORMAT
+    headers = {"X-Mask-Count": str(len(session.masks))}
+    if response_format == "rle":
+        # masks are computed on the decoded view, clients work in original pixels
+        shape = session.masks.shape
+        if session.original_size is not None:
+            masks = [to_original(mask, session.original_size) for mask in masks]
+            shape = (session.original_size[1], session.original_size[0])
+        body = mask_encoding.encode_masks(masks, shape, operation)
+        return binary_response(body, gzip_ok, headers)
+
+    with session.lock:
+        img = session.masks.composite()[:,:,[2,1,0]]
+    if response_format == "preview":
+        body = mask_encoding.encode_image(
+            mask_encoding.downscale(img, PREVIEW_MAX_SIDE), IMAGE_FORMAT, IMAGE_QUALITY
+        )
+        return Response(content=body, media_type=f"image/{IMAGE_FORMAT}", headers=headers)
+    if response_format == "image":
+        return {"image": encode_image(img), "format": IMAGE_FORMAT}
+    raise HTTPException(status_code=400, detail=f"Unknown response format '{response_format}'")
+
+@app.post("/upload")
+async def upload_image(file: UploadFile = File(...)):
+    """Store an image once; other endpoints accept the returned image id."""
+    try:
+        upload = await resolve_upload(file, None)
+        width, height = upload.size
+        return JSONResponse(content={"image_id": upload.image_id, "width": width, "height": height})
+    except HTTPException as e:
+        return JSONResponse(content={"error": e.detail}, status_code=e.status_code)
+    except Exception as e:
+        print(e)
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+
+
+def find_duplicate(upload):
+    """The dedup entry shared by the upload and its near-duplicates, None if disabled."""
+    if dedup is None:
+        return None
+    return dedup.match(upload.image_id, upload.view(CLASSIFIERS["binary"][2]))
+
+async def classify(upload, duplicate, name, predict, min_side):
+    """Verdict of classifier `name` on the upload, computed once per group of duplicates."""
+    if duplicate is not None and name in duplicate.verdicts:
+        return duplicate.verdicts[name]
+    verdict = await executors[name].run(predict, upload.view(min_side))
+    if duplicate is not None:
+        duplicate.verdicts[name] = verdict
+    return verdict
+
+
+def start_embedding(image, key, variant):
+    """Embed the image for segmentation, returns the future of its predictor."""
+    embedding = executors["sam_embed"].start(get_sam_predictor, device='cpu', image=image, key=key, variant=variant)
+    # failures are reported when the session is clicked
+    embedding.add_done_callback(lambda f: f.cancelled() or f.exception())
+    return embedding
+
+def discard_embedding(embedding, key, variant, cached):
+    """
+    Drop a speculative embedding, the upload turned out to be spam. Once
+    done its features leave the cache, unless they were cached before.
+    """
+    def discard(future):
+        if not cached and not future.cancelled() and future.exception() is None:
+            embedding_cache.pop((variant, key))
+    embedding.add_done_callback(discard)
+    metrics.speculative_embeddings.inc(result="discarded")
+
+def embedding_status(session):
+    """"pending", "ready" or "failed"."""
+    if not session.embedding.done():
+        return "pending"
+    return "ready" if session.predictor is not None or session.embedding.exception() is None else "failed"
+
+def embedding_failed(session):
+    embedding = session.embedding
+    return embedding.done() and not embedding.cancelled() and embedding.exception() is not None
+
+async def wait_for_embedding(session):
+    """The session's predictor, once its image is embedded. A failed embedding is started again."""
+    if session.predictor is None:
+        try:
+            if embedding_failed(session):
+                session.embedding = start_embedding(session.image, session.image_id, session.variant)
+            # shielded, the embedding is shared by every request of the session
+            session.predictor = await asyncio.shield(session.embedding)
+        except QueueFullError:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Embedding the image failed: {e}")
+    return session.predictor
+
 
 @app.post("/spamcheck")
-async def spam_classify_image(file: UploadFile = File(...)):
+async def spam_classify_image(
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    sam_model: str = Form(SAM_MODEL),
+    preview_model: Optional[str] = Form(SAM_PREVIEW_MODEL),
+):
+    """
+        Classify the image and, if it is not spam, open a segmentation
+        session. With a preview model, clicks are answered by that faster
+        SAM2 variant and `sam_model` refines the masks on /refine.
+
+        The session is returned as soon as the verdict is known. Its
+        image is embedded in the background, started together with the
+        classifier when an embedding thread is idle; `embedding` in the
+        response and GET /embedding/{session_id} tell when clicks can be
+        answered, /add_point waits for it.
+    """
     try:
+        if preview_model in ("", "none"):
+            preview_model = None
+        for variant in (sam_model, preview_model):
+            if variant is not None and variant not in SAM2_VARIANTS:
+                raise HTTPException(status_code=422, detail=f"Unknown SAM2 model '{variant}'")
+        upload = await resolve_upload(file, image_id)
+        duplicate = await run_in_threadpool(find_duplicate, upload)
 
-        global counter
-        shutil.rmtree(TEMP_DIR, ignore_errors=True)
-        os.makedirs(TEMP_DIR, exist_ok=True)
-        counter = 0
+        # SAM2 works on the upload decoded at its input resolution. Its
+        # embedding is cached by image id, the hash of the upload's bytes:
+        # near-duplicates only share the verdicts, their pixels differ
+        original_image = np.array(upload.image)
+        progressive = preview_model is not None and preview_model != sam_model
+        variant = preview_model if progressive else sam_model
 
-        # Read image file
-        image_data = await file.read()
-        image = Image.open(io.BytesIO(image_data)).convert("RGB")
+        # most uploads are legitimate, so their embedding starts right away
+        # unless the verdict is known or it would queue behind other uploads
+        embedding, cached = None, False
+        known = duplicate is not None and "spam" in duplicate.verdicts
+        embed_executor = executors["sam_embed"]
+        if SPECULATIVE_EMBEDDING and not known and embed_executor.pending < embed_executor.concurrency:
+            cached = (variant, upload.image_id) in embedding_cache
+            embedding = start_embedding(original_image, upload.image_id, variant)
 
-        # Classify image
-        predicted_class = predict_spam(image)
-        # If image is not spam we save it and add it to predictor
-        if predicted_class != 0:
-            global predictor, original_image
-            original_image=np.array(image)
-            predictor = get_sam_predictor(device='cpu', image=original_image)
+        # Classify image, known spam is rejected without running the model
+        try:
+            predicted_class = await classify(upload, duplicate, "spam", predict_spam, CLASSIFIERS["binary"][2])
+        except BaseException:
+            if embedding is not None:
+                discard_embedding(embedding, upload.image_id, variant, cached)
+            raise
+        if predicted_class == 0:
+            if embedding is not None:
+                discard_embedding(embedding, upload.image_id, variant, cached)
+            return JSONResponse(content={"spam": True})
 
-        # return true or false
-        return JSONResponse(content={"spam": predicted_class == 0})
+        # If image is not spam we open a segmentation session for it
+        if embedding is None:
+            embedding = start_embedding(original_image, upload.image_id, variant)
+            metrics.speculative_embeddings.inc(result="sequential")
+        else:
+            metrics.speculative_embeddings.inc(result="used")
+        refine_predictor = None
+        if progressive:
+            # embed with the full model in the background, ready for /refine
+            refine_predictor = embed_in_background(original_image, upload.image_id, sam_model)
+        session = sessions.create(
+            original_image, None, image_id=upload.image_id, refine_predictor=refine_predictor,
+            original_size=upload.size, metadata=upload.metadata, embedding=embedding, variant=variant,
+            refine_variant=sam_model if progressive else None,
+        )
+        return JSONResponse(content={
+            "spam": False,
+            "session_id": session.session_id,
+            "image_id": upload.image_id,
+            "embedding": embedding_status(session),
+        })
 
+    except QueueFullError:
+        raise
     except HTTPException as e:
         print(e)
         return JSONResponse(content={"error": e.detail}, status_code=e.status_code)
@@ -95,95 +403,356 @@ async def spam_classify_image(file: UploadFile = File(...)):
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 
+@app.get("/embedding/{session_id}")
+async def embedding(session_id: str, wait: bool = False):
+    """Whether the session's image is embedded: "pending", "ready" or "failed". With `wait`, once it is done."""
+    session = get_session(session_id)
+    if wait:
+        await asyncio.wait([session.embedding])
+    return {"status": embedding_status(session)}
+
+
 @app.post("/checkavalanchetype")
-async def classify_avalanche_type(file: UploadFile = File(...)):
+async def classify_avalanche_type(
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+):
     try:
-        # Read image file
-        image_data = await file.read()
-        image = Image.open(io.BytesIO(image_data)).convert("RGB")
+        upload = await resolve_upload(file, image_id)
+        duplicate = await run_in_threadpool(find_duplicate, upload)
         
         # Classify image
-        predicted_class = predict_avalanche_type(image)
+        predicted_class = await classify(
+            upload, duplicate, "avalanche_type", predict_avalanche_type, CLASSIFIERS["avalanche_type"][2]
+        )
         
 
         # return true or false
         return JSONResponse(content={"avalanche_type": predicted_class})
 
+    except QueueFullError:
+        raise
     except HTTPException as e:
         return JSONResponse(content={"error": e.detail}, status_code=e.status_code)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 
+# The example report used when a request has no photo (position) of its own
+EXAMPLE_PHOTO = './../images/avalanche.jpeg'
+EXAMPLE_PHOTO_POSITION = (2684500, 1173301)
+EXAMPLE_AVALANCHE_POSITION = (2684458, 1173135)
+
+@functools.lru_cache(maxsize=None)
+def example_metadata():
+    with open(EXAMPLE_PHOTO, 'rb') as f:
+        return read_metadata(f.read())
+
+def union_locked(session):
+    """Union of the session's masks, None without any."""
+    # the session lock is taken in the worker thread, never on the event loop
+    with session.lock:
+        return session.masks.union() if len(session.masks) else None
+
 @app.post("/estimate_avalanche_size")
-async def estimate_avalanche_size():
-    image_path = './../images/avalanche.jpeg'
-    
-    ## EXAMPLE: ESTIMATION OF AVALANCHE SIZE
-    camera_name = 'Apple iPhone 11'
-    latitude, longitude, focal_length = get_exif_data(image_path)
-    sensor_size = get_sensor_size(camera_name)
-    # Example positions (already given in the problem)
-    photoposition = [2684500, 1173301]
-    avalancheposition = [2684458, 1173135]
-
-    # Add elevations for both positions
-    photoposition.append(get_elevation(photoposition[0], photoposition[1]))
-    avalancheposition.append(get_elevation(avalancheposition[0], avalancheposition[1]))
-
-    # Check if elevations are valid before proceeding
-    if photoposition[2] is None or avalancheposition[2] is None:
-        print("Error: Unable to retrieve elevation data.")
+async def estimate_avalanche_size(
+    image_id: Optional[str] = Form(None),
+    session_id: Optional[str] = Form(None),
+    avalanche_latitude: Optional[float] = Form(None),
+    avalanche_longitude: Optional[float] = Form(None),
+):
+    """
+        Estimate the avalanche's surface from the session's mask and the
+        EXIF data of its photo, parsed when it was uploaded. The photo is
+        taken at its GPS position looking at the avalanche at
+        (avalanche_latitude, avalanche_longitude). Without either position
+        the example positions are used, with only one of them it fails.
+    """
+    if (avalanche_latitude is None) != (avalanche_longitude is None):
+        return JSONResponse(content={"error": "avalanche_latitude and avalanche_longitude must be given together"},
+                            status_code=422)
+    session = get_session(session_id) if session_id is not None else None
+    image_size = None
+    if session is not None and session.metadata is not None:
+        metadata, image_size = session.metadata, session.original_size
+    elif image_id is not None:
+        upload = await resolve_upload(None, image_id)
+        metadata, image_size = upload.metadata, upload.size
+    else:
+        metadata = None
+    if (metadata or example_metadata()).focal_length_mm is None:
+        return JSONResponse(content={"error": "The photo has no focal length in its EXIF data"}, status_code=422)
+
+    # The photo's GPS position and the requested avalanche position, converted
+    # to LV95 together; the example pair only stands in when neither is known
+    has_photo_position = metadata is not None and metadata.has_position
+    has_avalanche_position = avalanche_latitude is not None and avalanche_longitude is not None
+    if has_photo_position != has_avalanche_position:
+        error = ("avalanche_latitude and avalanche_longitude are required for a photo with a GPS position"
+                 if has_photo_position else "The photo has no GPS position to go with the avalanche position")
+        return JSONResponse(content={"error": error}, status_code=422)
+    if has_photo_position:
+        eastings, northings = wgs84_to_lv95(
+            [metadata.latitude, avalanche_latitude], [metadata.longitude, avalanche_longitude],
+        )
+        photoposition, avalancheposition = [list(p) for p in zip(eastings.tolist(), northings.tolist())]
+        positions = {"positions": "exif"}
     else:
+        photoposition, avalancheposition = list(EXAMPLE_PHOTO_POSITION), list(EXAMPLE_AVALANCHE_POSITION)
+        positions = {
+            "positions": "example",
+            "warning": "Neither the photo's nor the avalanche's position is known, "
+                       "the size is estimated for the example positions",
+        }
+    metadata = metadata or example_metadata()
+
+    focal_length = metadata.focal_length_mm / 1000
+    sensor, sensor_method = find_sensor(
+        metadata.make, metadata.model, metadata.focal_length_mm, metadata.focal_length_35mm, image_size,
+    )
+    sensor_size = sensor.size
+    camera = {"make": sensor.make, "model": sensor.model, "sensor_match": sensor_method}
+
+    try:
+        # Fetch every height sample concurrently: each position and the points
+        # `delta` east and north of it, for the steepness angles
+        delta = 5
+        heights = await run_in_threadpool(get_elevations, [
+            (e + de, n + dn)
+            for e, n in (photoposition, avalancheposition)
+            for de, dn in ((0, 0), (delta, 0), (0, delta))
+        ])
+        photo_heights, avalanche_heights = heights[:3], heights[3:]
+
+        # Add elevations for both positions
+        photoposition.append(photo_heights[0])
+        avalancheposition.append(avalanche_heights[0])
+
         # Compute steepness angles for the avalanche position (and optionally for the photo position too)
-        (angle_east_avalanche, angle_north_avalanche) = compute_steepness_angles(avalancheposition[0], avalancheposition[1], delta=5, sr=None)
-        (angle_east_photo, angle_north_photo) = compute_steepness_angles(photoposition[0], photoposition[1], delta=5, sr=None)
+        (angle_east_avalanche, angle_north_avalanche) = _steepness_angles(*avalanche_heights, delta)
+        (angle_east_photo, angle_north_photo) = _steepness_angles(*photo_heights, delta)
+    except ElevationError as e:
+        print(f"Error: Unable to retrieve elevation data. {e}")
+        return JSONResponse(content={"error": str(e)}, status_code=502)
 
-        # Compute the 3D distance between the two positions (easting, northing, elevation)
-        distance = compute_3d_distance(photoposition[0], photoposition[1], photoposition[2], avalancheposition[0], avalancheposition[1], avalancheposition[2])
+    # Compute the 3D distance between the two positions (easting, northing, elevation)
+    distance = compute_3d_distance(photoposition[0], photoposition[1], photoposition[2], avalancheposition[0], avalancheposition[1], avalancheposition[2])
 
-        # Compute the angle differences (angles between observer and avalanche)
-        angle_east_diff = angle_east_avalanche - angle_east_photo
-        angle_north_diff = angle_north_avalanche - angle_north_photo
+    # Compute the angle differences (angles between observer and avalanche)
+    angle_east_diff = angle_east_avalanche - angle_east_photo
+    angle_north_diff = angle_north_avalanche - angle_north_photo
         
-    #mask = getSamSegmentation(image_path)
-    mask = 0.3
-    finalsize = computeAvalancheSize(mask, distance, focal_length, sensor_size, (angle_east_diff,angle_north_diff))
+    # Segmentation of the session, or the old fixed fraction without one
+    mask = await run_in_threadpool(union_locked, session) if session is not None else None
+
+    dem = get_dem()
+    terrain = {}
+    if mask is not None and dem is not None:
+        # the photo's pixel grid, which the camera model is defined on
+        photo_mask = mask
+        if session.original_size is not None:
+            photo_mask = await run_in_threadpool(to_original, mask, session.original_size)
+        # project every mask pixel onto the terrain for the real surface area
+        finalsize, stats = await run_in_threadpool(
+            estimate_area, photo_mask, photoposition, avalancheposition,
+            focal_length, sensor_size, dem, cell_size=TERRAIN_CELL_SIZE_M,
+        )
+        if stats["hits"] > 0 and stats["hits"] >= TERRAIN_MIN_HIT_FRACTION * stats["rays"]:
+            print(f"The distance is {distance} and the projected size is {finalsize} square meters ({stats})")
+            return JSONResponse(content={
+                "distance": distance, "finalsize": finalsize, "method": "terrain", "camera": camera,
+                **positions, **stats,
+            })
+        # e.g. the DEM doesn't cover the view, the area of the few hits would be far too small
+        terrain = {"terrain": {
+            **stats, "warning": f"Only {stats['hits']} of {stats['rays']} rays hit the terrain, "
+                                "the size is estimated on a plane",
+        }}
+
+    # the fraction is the same at the session's (view) resolution
+    fraction = float(mask.mean()) if mask is not None else 0.3
+    finalsize = computeAvalancheSize(fraction, distance, focal_length, sensor_size, (angle_east_diff,angle_north_diff))
     print(f"The distance is {distance} and the estimated size id {finalsize} square meters")
-    return JSONResponse(content={"distance": distance, "finalsize": finalsize})
+    return JSONResponse(content={"distance": distance, "finalsize": finalsize, "method": "planar", "camera": camera,
+                                 **positions, **terrain})
     
 
 
 @app.post("/add_point")
-async def add_point(point: Point):
+async def add_point(point: Point, http_request: Request):
     """
         When user clicks on image we do segmentation on image 
         and return the image.
     """
-    global predictor, original_image, counter
-
-    # segment point
-    img = select_point(
-        predictor=predictor,
-        original_img=original_image,
-        point=point,
-        counter=counter,
+    session = get_session(point.session_id)
+    await wait_for_embedding(session)
+    mask, new_object = await executors["sam_predict"].run(select_point_locked, session, point)
+
+    masks = [] if mask is None else [mask]
+    operation = mask_encoding.APPEND if new_object else mask_encoding.UPDATE
+    return await run_in_threadpool(
+        render_masks, session, point.response_format, operation, masks, accepts_gzip(http_request),
     )
-    
-    counter += 1
-    img = img[:,:,[2,1,0]]
-    return {
-        "image": encode_image(img),
-    }
+
+def select_point_locked(session, point):
+    # the session lock is taken in the worker thread, never on the event loop
+    with session.lock:
+        # segment point
+        return select_point(
+            predictor=session.predictor,
+            masks=session.masks,
+            point=session.to_view(point.x, point.y),
+            label=point.label,
+            new_object=point.new_object,
+        )
+
+def embed_in_background(image, image_id, variant):
+    future = asyncio.ensure_future(executors["sam_refine"].run(
+        get_sam_predictor, device='cpu', image=image, key=image_id, variant=variant,
+    ))
+    # failures are reported (and retried) when the session is refined
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    return future
+
+async def refine_session(session):
+    try:
+        predictor = await session.refine_predictor
+    except Exception:
+        session.refine_predictor = embed_in_background(session.image, session.image_id, session.refine_variant)
+        predictor = await session.refine_predictor
+    return await executors["sam_refine"].run(refine_masks_locked, session, predictor)
+
+def refine_masks_locked(session, predictor):
+    with session.lock:
+        refine_masks(predictor, session.masks)
+
+@app.post("/refine", status_code=202)
+async def refine(request: SessionRequest):
+    """
+        When the user confirms, recompute the preview masks with the full
+        SAM2 model in the background. Poll GET /refine/{session_id}.
+    """
+    session = get_session(request.session_id)
+    if session.refine_predictor is None:
+        # the masks already come from the full model
+        return {"status": "done"}
+    if session.refine_task is None or session.refine_task.done():
+        session.refine_task = asyncio.create_task(refine_session(session))
+    return {"status": "pending"}
+
+@app.get("/refine/{session_id}")
+async def refine_status(http_request: Request, session_id: str, response_format: Optional[ResponseFormat] = None):
+    session = get_session(session_id)
+    task = session.refine_task
+    if session.refine_predictor is not None and task is None:
+        return {"status": "idle"}
+    if task is not None and not task.done():
+        return {"status": "pending"}
+    if task is not None and task.exception() is not None:
+        return JSONResponse(content={"status": "failed", "error": str(task.exception())}, status_code=500)
+
+    def render():
+        with session.lock:
+            masks = [session.masks.mask(i) for i in range(len(session.masks))]
+        return render_masks(session, response_format, mask_encoding.REPLACE, masks, accepts_gzip(http_request))
+
+    response = await run_in_threadpool(render)
+    if isinstance(response, dict):
+        response["status"] = "done"
+    return response
 
 @app.post("/undo")
-async def undo():
-    global original_image, counter
-    counter -= 1
+def undo(request: SessionRequest, http_request: Request):
+    session = get_session(request.session_id)
+    gzip_ok = accepts_gzip(http_request)
+    with session.lock:
+        undone = session.masks.can_undo()
+        if undone:
+            restored = session.masks.pop()
+        else:
+            masks = [session.masks.mask(i) for i in range(len(session.masks))]
+
+    if not undone:
+        # nothing to undo, resend every mask so the client stays in sync
+        return render_masks(session, request.response_format, mask_encoding.REPLACE, masks, gzip_ok)
+
+    # undoing a refinement click restores the object's previous mask
+    if restored is not None:
+        return render_masks(session, request.response_format, mask_encoding.UPDATE, [restored], gzip_ok)
+    return render_masks(session, request.response_format, mask_encoding.POP, gzip_ok=gzip_ok)
+
+class ReportRequest(BaseModel):
+    session_id: str
+    # where the photo was taken, defaults to its GPS position
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    avalanche_type: Optional[int] = None
+    size_m2: Optional[float] = None
+
+@functools.lru_cache(maxsize=None)
+def get_reports():
+    return ReportStore()
+
+def packed_masks_locked(session):
+    with session.lock:
+        return session.masks.packed(), session.masks.shape
+
+@app.post("/reports")
+async def submit_report(request: ReportRequest):
+    """Store the session's final masks as a report."""
+    session = get_session(request.session_id)
+    packed, shape = await run_in_threadpool(packed_masks_locked, session)
+    if not packed:
+        raise HTTPException(status_code=422, detail="The session has no masks to submit")
+
+    latitude, longitude = request.latitude, request.longitude
+    if latitude is None and session.metadata is not None and session.metadata.has_position:
+        latitude, longitude = session.metadata.latitude, session.metadata.longitude
+
+    def save():
+        masks = [unpack_mask(p, shape) for p in packed]
+        return get_reports().save(
+            masks, session.original_size or (shape[1], shape[0]),
+            image_id=session.image_id, latitude=latitude, longitude=longitude,
+            avalanche_type=request.avalanche_type, size_m2=request.size_m2,
+        )
+
+    report_id = await run_in_threadpool(save)
+    return {"report_id": report_id}
+
+@app.get("/reports")
+async def find_reports(min_latitude: float, min_longitude: float, max_latitude: float, max_longitude: float,
+                       limit: int = 100):
+    """Reports photographed inside a latitude/longitude box, newest first."""
+    reports = await run_in_threadpool(
+        get_reports().within, min_latitude, min_longitude, max_latitude, max_longitude, limit,
+    )
+    return {"reports": reports}
+
+@app.get("/reports/{report_id}")
+async def get_report(report_id: str):
+    """A report with the simplified polygons of its masks, in pixels of the photo."""
+    report = await run_in_threadpool(get_reports().get, report_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Unknown report")
+    return report
+
+@app.get("/reports/{report_id}/masks")
+async def get_report_masks(report_id: str, http_request: Request):
+    """The report's masks as a binary RLE body (see mask_encoding.py) at the photo's size."""
+    def render():
+        report = get_reports().get(report_id, polygons=False)
+        if report is None:
+            return None
+        size = (report["width"], report["height"])
+        masks = [to_original(mask, size) for mask in get_reports().masks(report_id)]
+        body = mask_encoding.encode_masks(masks, (size[1], size[0]), mask_encoding.REPLACE)
+        return binary_response(body, accepts_gzip(http_request))
 
-    img = overlay(original_image, count=counter)
-    img = img[:,:,[2,1,0]]
-    return {"image": encode_image(img)}
+    response = await run_in_threadpool(render)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Unknown report")
+    return response
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,86 @@
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+
+import torch
+
+from metrics import batch_size, timed
+
+
+class MicroBatcher:
+    """
+    Groups concurrent single-image forward passes of a model into batches.
+
+    A background thread collects up to `max_batch_size` requests, waiting at
+    most `max_wait_ms` after the first one, and runs them together. Inputs
+    are bucketed by shape: the ResNet transforms resize the shorter side
+    only, so photos with the same aspect ratio share a bucket, while padding
+    would change the pooled features and thus the predictions.
+
+    Args:
+        model (nn.Module): Model taking a (N, C, H, W) batch.
+        max_batch_size (int): Maximum number of inputs per forward pass.
+        max_wait_ms (float): How long to wait for a batch to fill up.
+    """
+
+    def __init__(self, model, max_batch_size=8, max_wait_ms=10, name="batcher"):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def submit(self, tensor: torch.Tensor) -> Future:
+        """Queue a single (C, H, W) input; the future resolves to its output row."""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((tensor, future))
+        return future
+
+    def __call__(self, tensor: torch.Tensor) -> torch.Tensor:
+        return self.submit(tensor).result()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._run(batch)
+
+    def _run(self, batch):
+        buckets = defaultdict(list)
+        for tensor, future in batch:
+            if future.set_running_or_notify_cancel():
+                buckets[tuple(tensor.shape)].append((tensor, future))
+
+        for items in buckets.values():
+            batch_size.observe(len(items), model=self.name)
+            try:
+                with torch.no_grad(), timed(f"{self.name}_forward"):
+                    outputs = self.model(torch.stack([tensor for tensor, _ in items]))
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            for (_, future), output in zip(items, outputs):
+                future.set_result(output)
@@ -0,0 +1,270 @@
+"""
+Benchmark the backend hot paths without the real checkpoints.
+
+Every case runs on synthetic photos with randomly initialized models, so the
+numbers are reproducible on any machine with the Python dependencies:
+upload decoding, both classifier forwards, SAM2 image embedding and prompt
+decoding, overlay compositing for growing mask counts, image and mask
+encoding, and size estimation (planar and terrain projection).
+
+Results are written as JSON. Given a baseline from an earlier run, cases
+whose median got slower by more than --threshold fail the run (exit code 1).
+
+Example:
+    python benchmark.py --output before.json
+    python benchmark.py --baseline before.json --threshold 0.1
+    python benchmark.py --only sam --repeat 5
+"""
+import argparse
+import fnmatch
+import io
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from classifier_backends import CLASSIFIERS, build_preprocess, build_resnet, load_backend
+from config import DECODE_MIN_SIDE
+from decoding import decode
+from mask_encoding import encode_image, encode_masks
+
+# (width, height) of the synthetic photos, a 12MP phone camera
+PHOTO_SIZE = (4000, 3000)
+
+
+def synthetic_photo(size=PHOTO_SIZE, seed=0):
+    """Smooth gradients with texture, so JPEG and PNG sizes resemble a real photo."""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.stack([
+        127 + 100 * np.sin(x / 300 + c) * np.cos(y / 200 - c) for c in range(3)
+    ], axis=-1)
+    image += rng.normal(0, 8, (height, width, 1))
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def synthetic_mask(shape, index=0):
+    """An elliptic blob, placed differently per index."""
+    height, width = shape
+    y, x = np.ogrid[0:height, 0:width]
+    cy = height * (0.3 + 0.4 * ((index * 0.37) % 1))
+    cx = width * (0.3 + 0.4 * ((index * 0.61) % 1))
+    return ((y - cy) / (height / 6)) ** 2 + ((x - cx) / (width / 8)) ** 2 < 1
+
+
+def jpeg_bytes(image, quality=90):
+    buf = io.BytesIO()
+    Image.fromarray(image).save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
+
+
+def decode_cases(photo):
+    data = jpeg_bytes(photo)
+    yield 'decode/full', lambda: Image.open(io.BytesIO(data)).convert('RGB')
+    yield 'decode/draft', lambda: decode(data)
+
+
+def classifier_cases(view, backend):
+    for name, (_, _, size) in CLASSIFIERS.items():
+        model = load_backend(name, backend, build_resnet(name, load_checkpoint=False))
+        batch = build_preprocess(size)(view).unsqueeze(0)
+
+        def forward(model=model, batch=batch):
+            with torch.no_grad():
+                model(batch)
+        yield f'classifier/{name}/{backend}', forward
+
+
+def sam_cases(view, variant):
+    from sam2.build_sam import build_sam2
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+    from inference import SAM2_VARIANTS, predict_object
+
+    model = build_sam2(SAM2_VARIANTS[variant][1], None, device='cpu')
+    predictor = SAM2ImagePredictor(model)
+    image = np.array(view)
+    yield f'sam/{variant}/set_image', lambda: predictor.set_image(image)
+
+    predictor.set_image(image)
+    point = [(image.shape[1] // 2, image.shape[0] // 2)]
+    _, logits = predict_object(predictor, point, [1])
+    yield f'sam/{variant}/predict_click', lambda: predict_object(predictor, point, [1])
+    yield f'sam/{variant}/predict_refine', lambda: predict_object(
+        predictor, point + [(10, 10)], [1, 0], logits
+    )
+
+
+def overlay_cases(view):
+    from sam_utils import MaskStack
+
+    image = np.array(view)
+    for count in (1, 4, 16):
+        masks = [synthetic_mask(image.shape[:2], i) for i in range(count)]
+
+        def composite(masks=masks):
+            stack = MaskStack(image)
+            for mask in masks:
+                stack.push(mask)
+                stack.composite()
+        yield f'overlay/{count}_masks', composite
+
+
+def encode_image_cases(photo, view):
+    image = np.array(view)
+    for fmt in ('png', 'jpeg', 'webp'):
+        yield f'encode_image/{fmt}', lambda fmt=fmt: encode_image(image, fmt)
+    yield 'encode_image/png_full', lambda: encode_image(photo, 'png')
+
+
+def encode_masks_cases(photo):
+    masks = [synthetic_mask(photo.shape[:2])]
+    yield 'encode_masks/rle_full', lambda: encode_masks(masks, photo.shape[:2])
+
+
+def size_cases(photo):
+    from elevation import DEMGrid
+    from helpers import computeAvalancheSize
+    from terrain import Camera, footprint_area
+
+    yield 'size/planar', lambda: computeAvalancheSize(0.3, 500, 0.0042, (0.0064, 0.0048), (10, 20))
+
+    # flat ground around the camera and a 35 degree slope rising north of
+    # y = 2000, the target 500m up the slope
+    cell, slope_start = 2.0, 2000.0
+    top = 2999 * cell
+    # rows run from the top (north) edge at y0 southwards
+    ys = top - np.arange(3000) * cell
+    heights = np.maximum(ys - slope_start, 0) * math.tan(math.radians(35))
+    grid = DEMGrid(np.repeat(heights[:, None], 3000, axis=1).astype(np.float32), 0.0, top, cell)
+    ground, target = (3000.0, 1000.0), (3000.0, 2500.0, 500 * math.tan(math.radians(35)))
+    assert abs(grid.heights(np.array([ground[0]]), np.array([ground[1]]))[0]) < 1e-3
+    assert abs(grid.heights(np.array([target[0]]), np.array([target[1]]))[0] - target[2]) < 0.01
+    camera = Camera.look_at((*ground, 1.6), target, 0.0042, (0.0056, 0.0042),
+                            (photo.shape[1], photo.shape[0]))
+    mask = synthetic_mask(photo.shape[:2])
+    yield 'size/terrain', lambda: footprint_area(mask, camera, grid)
+
+
+def measure(fn, repeat, warmup):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        'median_ms': statistics.median(times) * 1000,
+        'min_ms': min(times) * 1000,
+        'mean_ms': statistics.fmean(times) * 1000,
+        'stdev_ms': statistics.stdev(times) * 1000 if len(times) > 1 else 0.0,
+        'repeat': repeat,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Cases whose median regressed by more than `threshold` against the baseline."""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get('results', {}).get(name)
+        if before is None:
+            continue
+        change = result['median_ms'] / before['median_ms'] - 1
+        result['change'] = change
+        if change > threshold:
+            regressions.append((name, before['median_ms'], result['median_ms'], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', help='JSON result file (printed to stdout if not given)')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='allowed relative slowdown of the median before failing')
+    parser.add_argument('--only', nargs='+', default=['*'],
+                        help='glob patterns of the cases to run, e.g. "sam/*"')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=os.cpu_count(),
+                        help='torch intra-op threads')
+    parser.add_argument('--classifier-backends', nargs='+', default=['eager'])
+    parser.add_argument('--sam-model', default='tiny', help='SAM2 variant to benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    photo = synthetic_photo(seed=args.seed)
+    view, _ = decode(jpeg_bytes(photo), DECODE_MIN_SIDE)
+
+    # case generators by name prefix, only set up (and e.g. build models)
+    # if one of their cases is selected
+    groups = {
+        'decode': lambda: decode_cases(photo),
+        'classifier': lambda: (c for b in args.classifier_backends for c in classifier_cases(view, b)),
+        'sam': lambda: sam_cases(view, args.sam_model),
+        'overlay': lambda: overlay_cases(view),
+        'encode_image': lambda: encode_image_cases(photo, view),
+        'encode_masks': lambda: encode_masks_cases(photo),
+        'size': lambda: size_cases(photo),
+    }
+
+    def selected(name):
+        return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(name, p + '/*') for p in args.only)
+
+    results = {}
+    for group, cases in groups.items():
+        if not any(fnmatch.fnmatch(group, p.split('/')[0]) for p in args.only):
+            continue
+        for name, fn in cases():
+            if not selected(name):
+                continue
+            results[name] = measure(fn, args.repeat, args.warmup)
+            print(f"{name:<40}{results[name]['median_ms']:>10.2f} ms", file=sys.stderr)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count(),
+            'threads': args.threads,
+            'photo_size': PHOTO_SIZE,
+            'sam_model': args.sam_model,
+        },
+        'results': results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        report['regressions'] = [name for name, *_ in regressions]
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    for name, before, after, change in regressions:
+        print(f"REGRESSION {name}: {before:.2f} ms -> {after:.2f} ms ({change:+.0%})", file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
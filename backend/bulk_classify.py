@@ -0,0 +1,227 @@
+"""
+Re-score archived report photos with the spam and avalanche-type classifiers.
+
+Images are decoded and preprocessed by parallel DataLoader workers, grouped
+by input shape into batched forward passes, and results are appended to a
+CSV as they come in. Re-running the same command skips images that already
+have a result, so an interrupted run resumes where it stopped, and retries
+the images that failed to load.
+
+Example:
+    python bulk_classify.py /data/reports --output scores.csv --workers 8
+    python bulk_classify.py manifest.txt --output scores.parquet  # needs pyarrow
+"""
+import argparse
+import csv
+import os
+import time
+from collections import defaultdict
+
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff'}
+AVALANCHE_TYPES = ['none', 'slab', 'loose', 'glide']
+FIELDS = (
+    ['path', 'spam', 'spam_prob', 'avalanche_type']
+    + [f'type_prob_{t}' for t in AVALANCHE_TYPES]
+    + ['error']
+)
+
+
+def list_images(source):
+    """Image paths from a directory (recursively) or a manifest with one path per line."""
+    if os.path.isdir(source):
+        paths = []
+        for root, _, files in os.walk(source):
+            paths.extend(
+                os.path.join(root, f) for f in files
+                if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS
+            )
+        return sorted(paths)
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source) as f:
+        lines = [line.strip().split(',')[0] for line in f]
+    return [p if os.path.isabs(p) else os.path.join(base, p) for p in lines if p and p != 'path']
+
+
+def read_done(progress_path):
+    """
+    Paths scored by an earlier run. Rows of images that failed are dropped
+    from the progress file, so those images are retried without ending up
+    in the results twice.
+    """
+    if not os.path.exists(progress_path):
+        return set()
+    with open(progress_path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    scored = [row for row in rows if not row.get('error')]
+    if len(scored) < len(rows):
+        tmp_path = progress_path + '.tmp'
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(scored)
+        os.replace(tmp_path, progress_path)
+    return {row['path'] for row in scored}
+
+
+class ReportImages(Dataset):
+    def __init__(self, paths, preprocess_binary, preprocess_multiclass):
+        self.paths = paths
+        self.preprocess_binary = preprocess_binary
+        self.preprocess_multiclass = preprocess_multiclass
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        path = self.paths[i]
+        try:
+            image = Image.open(path).convert("RGB")
+            return path, self.preprocess_binary(image), self.preprocess_multiclass(image), None
+        except Exception as e:
+            return path, None, None, str(e)
+
+
+class ShapeBuckets:
+    """
+    Collect tensors per shape and hand out full batches. Beyond `max_buffered`
+    tensors in all buckets together, the largest bucket is handed out early,
+    so archives with many aspect ratios don't pile up partial batches.
+    """
+
+    def __init__(self, batch_size, max_buffered=None):
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered or batch_size * 8
+        self._buckets = defaultdict(list)
+        self._buffered = 0
+
+    def add(self, key, tensor):
+        bucket = self._buckets[tuple(tensor.shape)]
+        bucket.append((key, tensor))
+        self._buffered += 1
+        if len(bucket) >= self.batch_size:
+            return self._pop(tuple(tensor.shape))
+        if self._buffered > self.max_buffered:
+            return self._pop(max(self._buckets, key=lambda shape: len(self._buckets[shape])))
+        return None
+
+    def _pop(self, shape):
+        batch = self._buckets.pop(shape)
+        self._buffered -= len(batch)
+        return batch
+
+    def drain(self):
+        while self._buckets:
+            yield self._pop(next(iter(self._buckets)))
+
+
+def forward(model, items):
+    with torch.no_grad():
+        probs = torch.softmax(model(torch.stack([t for _, t in items])), dim=1)
+    return {key: p.tolist() for (key, _), p in zip(items, probs)}
+
+
+def write_parquet(progress_path, output):
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+    pq.write_table(pacsv.read_csv(progress_path), output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('source', help='directory of images or manifest file (one path per line)')
+    parser.add_argument('--output', required=True, help='.csv or .parquet result file')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--max-buffered', type=int, default=None,
+                        help='images waiting for a full batch per model before partial batches run '
+                             '(default 8 batches)')
+    parser.add_argument('--workers', type=int, default=max((os.cpu_count() or 2) // 2, 1),
+                        help='parallel decode workers')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(),
+                        help='torch intra-op threads for the forward passes')
+    args = parser.parse_args()
+
+    # Parquet can't be appended to, so results stream into a CSV that is
+    # converted once every image has been scored
+    parquet = args.output.endswith('.parquet')
+    if parquet:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            parser.error("writing .parquet needs pyarrow (pip install pyarrow), or use a .csv output")
+
+    torch.set_num_threads(args.threads)
+    from classifier_backends import load_backend
+    from classifiers import preprocess_binary, preprocess_multiclass
+    from config import CLASSIFIER_BACKEND
+    # the batches are formed here, no micro-batcher needed
+    binary_model = load_backend("binary", CLASSIFIER_BACKEND)
+    avalanchetype_model = load_backend("avalanche_type", CLASSIFIER_BACKEND)
+
+    progress_path = args.output + '.progress.csv' if parquet else args.output
+
+    done = read_done(progress_path)
+    paths = [p for p in list_images(args.source) if p not in done]
+    print(f"{len(done)} images already scored, {len(paths)} to go")
+
+    loader = DataLoader(
+        ReportImages(paths, preprocess_binary, preprocess_multiclass),
+        batch_size=None,
+        num_workers=args.workers,
+        prefetch_factor=4 if args.workers else None,
+    )
+
+    new_file = not os.path.exists(progress_path)
+    with open(progress_path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        if new_file:
+            writer.writeheader()
+
+        spam_buckets = ShapeBuckets(args.batch_size, args.max_buffered)
+        type_buckets = ShapeBuckets(args.batch_size, args.max_buffered)
+        spam_probs, type_probs = {}, {}
+        n_done, start = 0, time.monotonic()
+
+        def flush():
+            nonlocal n_done
+            for path in [p for p in spam_probs if p in type_probs]:
+                spam, types = spam_probs.pop(path), type_probs.pop(path)
+                row = {'path': path, 'spam': spam[0] > spam[1], 'spam_prob': spam[0],
+                       'avalanche_type': AVALANCHE_TYPES[max(range(len(types)), key=types.__getitem__)]}
+                row.update({f'type_prob_{t}': p for t, p in zip(AVALANCHE_TYPES, types)})
+                writer.writerow(row)
+                n_done += 1
+            f.flush()
+
+        for path, spam_input, type_input, error in loader:
+            if error is not None:
+                writer.writerow({'path': path, 'error': error})
+                continue
+            batch = spam_buckets.add(path, spam_input)
+            if batch:
+                spam_probs.update(forward(binary_model, batch))
+            batch = type_buckets.add(path, type_input)
+            if batch:
+                type_probs.update(forward(avalanchetype_model, batch))
+                flush()
+                elapsed = time.monotonic() - start
+                print(f"{n_done}/{len(paths)} images, {n_done / elapsed:.1f} img/s", end='\r')
+
+        for batch in spam_buckets.drain():
+            spam_probs.update(forward(binary_model, batch))
+        for batch in type_buckets.drain():
+            type_probs.update(forward(avalanchetype_model, batch))
+        flush()
+
+    print(f"\nScored {n_done} images in {time.monotonic() - start:.1f}s")
+    if parquet:
+        write_parquet(progress_path, args.output)
+        print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Model definitions and CPU inference backends for the ResNet50 classifiers.
+
+Backends:
+    eager         plain fp32 PyTorch module
+    compile       torch.compile of the eager module
+    torchscript   frozen TorchScript traced by export_classifiers.py
+    onnx          ONNX Runtime session on the exported .onnx model
+    int8_dynamic  dynamic int8 quantization of the Linear head only; the
+                  convolutions stay fp32, so expect little speedup
+    int8_static   FX static int8 quantization calibrated by export_classifiers.py
+
+torchscript, onnx and int8_static load files from EXPORT_DIR and therefore
+need `python export_classifiers.py` to have been run for the checkpoints.
+"""
+import copy
+import os
+
+import torch
+import torch.nn as nn
+from torchvision import models, transforms
+
+from config import CHECKPOINT_DIR, EXPORT_DIR
+
+BACKENDS = ("eager", "compile", "torchscript", "onnx", "int8_dynamic", "int8_static")
+EXPORT_EXTENSIONS = {"torchscript": ".ts", "onnx": ".onnx", "int8_static": ".int8.ts"}
+
+# name: (checkpoint file, number of classes, preprocessing resize)
+CLASSIFIERS = {
+    "binary": ("best_avalanche_model.pth", 2, 224),  # 2 classes: avalanche / no avalanche
+    "avalanche_type": ("best_avalanche_multiclass_model.pth", 4, 704),  # none / slab / loose / glide
+}
+
+
+def build_preprocess(size):
+    return transforms.Compose([
+        transforms.Resize(size),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+
+
+def build_resnet(name, load_checkpoint=True):
+    """
+    Eager fp32 ResNet50 with the classification head of our checkpoints,
+    randomly initialized without `load_checkpoint` (for benchmarks).
+    """
+    checkpoint, num_classes, _ = CLASSIFIERS[name]
+    # Plain ResNet50, every weight is overwritten by the checkpoint below so
+    # there's no point in downloading the ImageNet weights
+    model = models.resnet50(weights=None)
+
+    # Modify the final layer for our classes
+    num_features = model.fc.in_features
+    model.fc = nn.Sequential(
+        nn.Linear(num_features, 256),
+        nn.ReLU(),
+        nn.Dropout(0.5),
+        nn.Linear(256, num_classes)
+    )
+    path = os.path.join(CHECKPOINT_DIR, checkpoint)
+    if not load_checkpoint:
+        return model.eval()
+    try:
+        model.load_state_dict(torch.load(path, map_location=torch.device('cpu')))
+    except FileNotFoundError:
+        raise RuntimeError(f"Model file '{path}' not found. Ensure it is in the checkpoints directory.")
+    model.eval()
+    return model
+
+
+def exported_path(name, backend):
+    checkpoint = CLASSIFIERS[name][0]
+    stem = os.path.splitext(checkpoint)[0]
+    return os.path.join(EXPORT_DIR, stem + EXPORT_EXTENSIONS[backend])
+
+
+class OnnxModel:
+    """Callable wrapper making an ONNX Runtime session look like a module."""
+
+    def __init__(self, path, threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch: torch.Tensor) -> torch.Tensor:
+        outputs = self.session.run(None, {self.input_name: batch.numpy()})
+        return torch.from_numpy(outputs[0])
+
+
+def load_backend(name, backend, model=None):
+    """
+    Return a callable mapping a (N, 3, H, W) batch to logits for the
+    classifier `name` using `backend`. `model` is the eager module, built
+    from the checkpoint if not given and needed.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown classifier backend '{backend}', expected one of {BACKENDS}")
+    if backend in EXPORT_EXTENSIONS:
+        path = exported_path(name, backend)
+        if not os.path.exists(path):
+            raise RuntimeError(f"'{path}' not found, run export_classifiers.py first.")
+        if backend == "onnx":
+            return OnnxModel(path, threads=torch.get_num_threads())
+        # optimize after loading, the fused graph doesn't survive serialization
+        return torch.jit.optimize_for_inference(torch.jit.load(path, map_location='cpu').eval())
+
+    model = model if model is not None else build_resnet(name)
+    if backend == "compile":
+        return torch.compile(model)
+    if backend == "int8_dynamic":
+        # the convolutions dominate ResNet50, only the Linear head is quantized
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def export_torchscript(model, path, example):
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    torch.jit.freeze(traced).save(path)
+
+
+def export_onnx(model, path, example):
+    torch.onnx.export(
+        model,
+        (example,),
+        path,
+        input_names=["input"],
+        output_names=["logits"],
+        dynamic_axes={"input": {0: "batch", 2: "height", 3: "width"}, "logits": {0: "batch"}},
+        opset_version=17,
+    )
+
+
+def quantize_static(model, calibration_batches):
+    """Post-training static int8 quantization, calibrated on sample batches."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    example = calibration_batches[0]
+    prepared = prepare_fx(copy.deepcopy(model), get_default_qconfig_mapping("x86"), (example,))
+    with torch.no_grad():
+        for batch in calibration_batches:
+            prepared(batch)
+    return convert_fx(prepared)
@@ -5,75 +5,64 @@ from torchvision import models, transforms
 from PIL import Image
 import torch
 import io
+import threading
 import numpy as np
 import torch.nn as nn
 
-
-# Load ResNet model (assumes model is saved locally as 'resnet_model.pth')
-try:
-    # Load pretrained ResNet50
-    binary_model = models.resnet50(pretrained=True)
-
-
-    # Modify the final layer for binary classification
-    num_features = binary_model.fc.in_features
-    binary_model.fc = nn.Sequential(
-        nn.Linear(num_features, 256),
-        nn.ReLU(),
-        nn.Dropout(0.5),
-        nn.Linear(256, 2)  # 2 classes: avalanche / no avalanche
-    )
-    binary_model.load_state_dict(torch.load("../checkpoints/best_avalanche_model.pth", map_location=torch.device('cpu')))
-    binary_model.eval()
-except FileNotFoundError:
-    raise RuntimeError("Model file 'resnet_model.pth' not found. Ensure it is in the current directory.")
+from batching import MicroBatcher
+from classifier_backends import CLASSIFIERS, build_preprocess, load_backend
+from config import AVALANCHE_TYPE_MAX_BATCH, BATCH_MAX_WAIT_MS, CLASSIFIER_BACKEND, SPAM_MAX_BATCH
+from metrics import timed
 
 
+# Define image preprocessing transforms
+preprocess_binary = build_preprocess(CLASSIFIERS["binary"][2])
+preprocess_multiclass = build_preprocess(CLASSIFIERS["avalanche_type"][2])
 
+BATCH_SIZES = {"binary": SPAM_MAX_BATCH, "avalanche_type": AVALANCHE_TYPE_MAX_BATCH}
 
-try:
-    # Load pretrained ResNet50
-    avalanchetype_model = models.resnet50(pretrained=True)
+# The ResNet models are loaded from the checkpoints on first use (or by
+# `warmup`) and wrapped in the configured inference backend, see
+# classifier_backends.py. Concurrent requests share forward passes
+_batchers = {}
+_batchers_lock = threading.Lock()
+_load_locks = {name: threading.Lock() for name in CLASSIFIERS}
 
 
-    # Modify the final layer for binary classification
-    num_features = avalanchetype_model.fc.in_features
-    avalanchetype_model.fc = nn.Sequential(
-        nn.Linear(num_features, 256),
-        nn.ReLU(),
-        nn.Dropout(0.5),
-        nn.Linear(256, 4)  # 2 classes: avalanche / no avalanche
-    )
-    avalanchetype_model.load_state_dict(torch.load("../checkpoints/best_avalanche_multiclass_model.pth", map_location=torch.device('cpu')))
-    avalanchetype_model.eval()
-except FileNotFoundError:
-    raise RuntimeError("Model file 'resnet_model.pth' not found. Ensure it is in the current directory.")
+def get_batcher(name):
+    """The micro-batcher of classifier `name`, loading the model if needed."""
+    batcher = _batchers.get(name)
+    if batcher is not None:
+        return batcher
+    # one lock per model so both classifiers can load in parallel
+    with _load_locks[name]:
+        if name not in _batchers:
+            model = load_backend(name, CLASSIFIER_BACKEND)
+            batcher = MicroBatcher(model, BATCH_SIZES[name], BATCH_MAX_WAIT_MS, name=f"{name}-batcher")
+            with _batchers_lock:
+                _batchers[name] = batcher
+        return _batchers[name]
 
 
+def is_loaded(name):
+    return name in _batchers
 
-# Define image preprocessing transforms
-preprocess_binary = transforms.Compose([
-    transforms.Resize(224),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-])
 
-preprocess_multiclass = transforms.Compose([
-    transforms.Resize(704),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-])
+def warmup(name):
+    """Load classifier `name` and run one forward pass to initialize its backend."""
+    size = CLASSIFIERS[name][2]
+    get_batcher(name)(torch.zeros(3, size, size))
 
 # Function to predict the class of an image
 def predict_spam(image: Image.Image):
     try:
-        # Preprocess image
-        input_tensor = preprocess_binary(image).unsqueeze(0)
-        # Perform inference
-        with torch.no_grad():
-            outputs = binary_model(input_tensor)
+        with timed("predict_spam"):
+            # Preprocess image
+            input_tensor = preprocess_binary(image)
+            # Perform inference
+            outputs = get_batcher("binary")(input_tensor)
         # Get predicted class
-        _, predicted_class = outputs.max(1)
+        predicted_class = outputs.argmax()
         print(predicted_class)
         return predicted_class.item()
     except Exception as e:
@@ -83,13 +72,13 @@ def predict_spam(image: Image.Image):
 # Function to predict the class of an image
 def predict_avalanche_type(image: Image.Image):
     try:
-        # Preprocess image
-        input_tensor = preprocess_multiclass(image).unsqueeze(0)
-        # Perform inference
-        with torch.no_grad():
-            outputs = avalanchetype_model(input_tensor)
+        with timed("predict_avalanche_type"):
+            # Preprocess image
+            input_tensor = preprocess_multiclass(image)
+            # Perform inference
+            outputs = get_batcher("avalanche_type")(input_tensor)
         # Get predicted class
-        _, predicted_class = outputs.max(1)
+        predicted_class = outputs.argmax()
         print(outputs)
         print(predicted_class)
         return predicted_class.item()
@@ -0,0 +1,140 @@
+import os
+
+# Backend settings, overridable through environment variables
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CHECKPOINT_DIR = os.environ.get(
+    "CHECKPOINT_DIR", os.path.join(SCRIPT_DIR, '..', 'checkpoints')
+)
+
+# Classifier inference backend, see classifier_backends.py
+CLASSIFIER_BACKEND = os.environ.get("CLASSIFIER_BACKEND", "eager")
+EXPORT_DIR = os.environ.get("EXPORT_DIR", os.path.join(CHECKPOINT_DIR, 'exported'))
+
+# SAM2 variant used for segmentation (tiny, small, base_plus or large).
+# With SAM_PREVIEW_MODEL set, clicks are answered by that faster variant
+# and SAM_MODEL refines the masks when the user confirms
+SAM_MODEL = os.environ.get("SAM_MODEL", "large")
+SAM_PREVIEW_MODEL = os.environ.get("SAM_PREVIEW_MODEL") or None
+
+# Load the classifiers and SAM2 models in the background at startup
+# (/readyz is 503 until done); with WARMUP=0 they load on first use
+WARMUP = os.environ.get("WARMUP", "1") not in ("0", "false", "False")
+
+# Memory budget for cached SAM2 image embeddings (~16MB per image)
+SAM_EMBEDDING_CACHE_MB = int(os.environ.get("SAM_EMBEDDING_CACHE_MB", 512))
+
+# Segmentation sessions expire after SESSION_TTL_S seconds of inactivity;
+# the least recently used ones are dropped beyond SESSION_MAX_MB
+SESSION_TTL_S = float(os.environ.get("SESSION_TTL_S", 30 * 60))
+SESSION_MAX_MB = int(os.environ.get("SESSION_MAX_MB", 2048))
+
+# Composited overlays kept per session for O(1) undo; older ones are
+# rebuilt from the packed masks on demand
+MASK_OVERLAY_CACHE_STEPS = int(os.environ.get("MASK_OVERLAY_CACHE_STEPS", 8))
+
+# Segmentation responses: "image" is the full composited photo base64 encoded
+# in JSON, "preview" the composite downscaled to PREVIEW_MAX_SIDE and "rle"
+# only the changed masks (see mask_encoding.py), both as binary bodies.
+# Requests may pick another one with `response_format`. Images are encoded as
+# IMAGE_FORMAT (png, jpeg or webp) with IMAGE_QUALITY for the lossy formats
+MASK_RESPONSE_FORMAT = os.environ.get("MASK_RESPONSE_FORMAT", "image")
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "png")
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", 90))
+PREVIEW_MAX_SIDE = int(os.environ.get("PREVIEW_MAX_SIDE", 1280))
+
+# Blocking model calls run in per-model executors: (concurrency, queue size).
+# Requests beyond the queue are rejected with 429 and Retry-After
+def _executor_limits(name, concurrency, max_queue):
+    prefix = f"{name.upper()}_EXECUTOR"
+    return (
+        int(os.environ.get(f"{prefix}_CONCURRENCY", concurrency)),
+        int(os.environ.get(f"{prefix}_QUEUE", max_queue)),
+    )
+
+EXECUTOR_LIMITS = {
+    "spam": _executor_limits("spam", 8, 32),
+    "avalanche_type": _executor_limits("avalanche_type", 4, 16),
+    "sam_embed": _executor_limits("sam_embed", 1, 4),
+    "sam_predict": _executor_limits("sam_predict", 2, 16),
+    # full model embeddings and refinement in progressive mode
+    "sam_refine": _executor_limits("sam_refine", 1, 8),
+}
+RETRY_AFTER_S = int(os.environ.get("RETRY_AFTER_S", 2))
+
+# Start the SAM2 embedding of an upload while the spam classifier runs, if
+# an embedding thread is idle; it is discarded when the upload is spam
+SPECULATIVE_EMBEDDING = os.environ.get("SPECULATIVE_EMBEDDING", "1") not in ("0", "false", "False")
+
+# Concurrent classifier requests are grouped into one forward pass of up to
+# *_MAX_BATCH images, waiting at most BATCH_MAX_WAIT_MS for a batch to fill.
+# Executor concurrency bounds how many requests can join a batch
+SPAM_MAX_BATCH = int(os.environ.get("SPAM_MAX_BATCH", 8))
+AVALANCHE_TYPE_MAX_BATCH = int(os.environ.get("AVALANCHE_TYPE_MAX_BATCH", 4))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 10))
+
+# Decoded uploads referenced by image id across endpoints. Uploads are decoded
+# with their shorter side reduced to DECODE_MIN_SIDE (SAM2's input size), photos
+# above UPLOAD_MAX_PIXELS are rejected
+UPLOAD_CACHE_MB = int(os.environ.get("UPLOAD_CACHE_MB", 1024))
+DECODE_MIN_SIDE = int(os.environ.get("DECODE_MIN_SIDE", 1024))
+UPLOAD_MAX_PIXELS = int(os.environ.get("UPLOAD_MAX_PIXELS", 64_000_000))
+
+# Uploads whose perceptual hashes differ in at most DEDUP_MAX_DISTANCE of 64
+# bits share classifier verdicts (see dedup.py); the index
+# remembers DEDUP_MAX_ENTRIES uploads. A negative distance disables it
+DEDUP_MAX_DISTANCE = int(os.environ.get("DEDUP_MAX_DISTANCE", 4))
+DEDUP_MAX_ENTRIES = int(os.environ.get("DEDUP_MAX_ENTRIES", 100_000))
+
+# Directory of memory-mapped DEM tiles (see elevation.py); when unset,
+# elevations come from the geo.admin.ch height service
+DEM_DIR = os.environ.get("DEM_DIR") or None
+
+# Remote height service, used for points not covered by the local DEM.
+# Heights are cached per ELEVATION_QUANTUM_M grid point in memory and on disk
+ELEVATION_URL = os.environ.get("ELEVATION_URL", "https://api3.geo.admin.ch/rest/services/height")
+ELEVATION_TIMEOUT_S = float(os.environ.get("ELEVATION_TIMEOUT_S", 5))
+ELEVATION_RETRIES = int(os.environ.get("ELEVATION_RETRIES", 3))
+ELEVATION_WORKERS = int(os.environ.get("ELEVATION_WORKERS", 8))
+ELEVATION_QUANTUM_M = float(os.environ.get("ELEVATION_QUANTUM_M", 0.5))
+ELEVATION_CACHE_SIZE = int(os.environ.get("ELEVATION_CACHE_SIZE", 100_000))
+ELEVATION_CACHE_PATH = os.environ.get(
+    "ELEVATION_CACHE_PATH", os.path.join(SCRIPT_DIR, 'cache', 'elevation.sqlite')
+) or None
+
+# Terrain projection of masks: rays beyond TERRAIN_MAX_DISTANCE_M are
+# ignored, masks are sub-sampled to at most TERRAIN_MAX_RAYS rays traced
+# TERRAIN_CHUNK_SIZE at a time against the DEM resampled to TERRAIN_CELL_SIZE_M.
+# When fewer than TERRAIN_MIN_HIT_FRACTION of the rays hit the DEM (it doesn't
+# cover the view), the size is estimated on a plane instead
+TERRAIN_MAX_DISTANCE_M = float(os.environ.get("TERRAIN_MAX_DISTANCE_M", 5000))
+TERRAIN_MAX_RAYS = int(os.environ.get("TERRAIN_MAX_RAYS", 100_000))
+TERRAIN_CHUNK_SIZE = int(os.environ.get("TERRAIN_CHUNK_SIZE", 65_536))
+TERRAIN_CELL_SIZE_M = float(os.environ.get("TERRAIN_CELL_SIZE_M", 2))
+TERRAIN_MIN_HIT_FRACTION = float(os.environ.get("TERRAIN_MIN_HIT_FRACTION", 0.5))
+
+# Camera sensor catalogues (CSV or JSON, separated by os.pathsep) added to the
+# bundled sensors.csv, see sensors.py. Photos of unknown cameras without a
+# 35mm equivalent focal length are assumed to come from DEFAULT_CAMERA
+SENSOR_DB = [p for p in os.environ.get("SENSOR_DB", "").split(os.pathsep) if p]
+DEFAULT_CAMERA = os.environ.get("DEFAULT_CAMERA", "Apple iPhone 11")
+SENSOR_LOOKUP_CACHE_SIZE = int(os.environ.get("SENSOR_LOOKUP_CACHE_SIZE", 4096))
+
+# Submitted reports and their masks (RLE and polygons simplified to within
+# REPORT_POLYGON_TOLERANCE_PX pixels), see reports.py
+REPORT_DB_PATH = os.environ.get("REPORT_DB_PATH", os.path.join(SCRIPT_DIR, 'data', 'reports.sqlite'))
+REPORT_POLYGON_TOLERANCE_PX = float(os.environ.get("REPORT_POLYGON_TOLERANCE_PX", 1.5))
+
+# Pre-fork mode (prefork.py): WORKERS processes forked after the models are
+# loaded share the weights, each running torch with WORKER_THREADS threads
+# (0: the cores split evenly). The router in front of them listens on
+# ROUTER_HOST:ROUTER_PORT and accepts bodies up to ROUTER_MAX_BODY_MB
+WORKERS = int(os.environ.get("WORKERS", 2))
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", 0))
+ROUTER_HOST = os.environ.get("ROUTER_HOST", "0.0.0.0")
+ROUTER_PORT = int(os.environ.get("ROUTER_PORT", 8000))
+ROUTER_MAX_BODY_MB = int(os.environ.get("ROUTER_MAX_BODY_MB", 64))
+
+# Stage timings of every request are logged as one JSON line (REQUEST_LOG=0
+# disables it); TRACING=otel also opens an OpenTelemetry span per stage
+REQUEST_LOG = os.environ.get("REQUEST_LOG", "1") not in ("0", "false", "False")
+TRACING = os.environ.get("TRACING") or None
@@ -0,0 +1,83 @@
+"""
+Resolution-aware decoding of uploaded photos.
+
+None of the models needs the native 12-48MP resolution: the spam classifier
+resizes to 224px, the avalanche type classifier to 704px and SAM2 to 1024px.
+Uploads are therefore decoded once at the largest of these sizes, using
+JPEG draft mode (DCT scaling) so the full resolution is never materialized,
+with EXIF orientation applied. The smaller views are resized from it on
+demand. Masks computed on a view are mapped back to the original pixel grid
+for the client and for size estimation.
+"""
+import io
+import math
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+from config import DECODE_MIN_SIDE, UPLOAD_MAX_PIXELS
+from metrics import timed
+
+# EXIF orientations that swap width and height
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+class ImageTooLargeError(ValueError):
+    """Raised for uploads above UPLOAD_MAX_PIXELS."""
+
+
+@timed("decode")
+def decode(data: bytes, min_side=DECODE_MIN_SIDE, max_pixels=UPLOAD_MAX_PIXELS):
+    """
+    Decode an image with its shorter side reduced to `min_side` (never
+    enlarged), upright according to its EXIF orientation.
+
+    Returns:
+        tuple: (RGB PIL image, (width, height) of the upright original)
+    """
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    if max_pixels and width * height > max_pixels:
+        raise ImageTooLargeError(
+            f"Image of {width}x{height} pixels exceeds the limit of {max_pixels} pixels"
+        )
+
+    scale = min_side / min(width, height)
+    if scale < 1:
+        # JPEG decodes at the smallest 1/2^k scale still covering the request
+        image.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+
+    if image.getexif().get(0x0112) in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    return resize_min_side(image, min_side), (width, height)
+
+
+def resize_min_side(image: Image.Image, min_side: int) -> Image.Image:
+    """
+    Shrink an image so its shorter side is `min_side`, with the same size
+    rounding and filter as torchvision's Resize(min_side), which is then a no-op.
+    """
+    width, height = image.size
+    short, long = min(width, height), max(width, height)
+    if short <= min_side:
+        return image
+    long = int(min_side * long / short)
+    size = (min_side, long) if width <= height else (long, min_side)
+    return image.resize(size, Image.BILINEAR)
+
+
+def to_view(x, y, original_size, view_size):
+    """Map a pixel of the original image to the view, both given as (width, height)."""
+    return (
+        int(x * view_size[0] / original_size[0]),
+        int(y * view_size[1] / original_size[1]),
+    )
+
+
+def to_original(mask: np.ndarray, original_size) -> np.ndarray:
+    """Resize a boolean mask of a view to the original (width, height)."""
+    if (mask.shape[1], mask.shape[0]) == tuple(original_size):
+        return mask
+    return cv2.resize(mask.astype(np.uint8), tuple(original_size), interpolation=cv2.INTER_NEAREST) > 0
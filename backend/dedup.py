@@ -0,0 +1,155 @@
+"""
+Near-duplicate detection of uploads by perceptual hashing.
+
+Spam waves and re-submitted reports upload the same photo again and again,
+often re-encoded, resized or with stripped metadata, so their bytes (and
+image ids) differ. Every upload gets a 64-bit pHash (low frequencies of the
+DCT) and dHash (horizontal gradients) of its decoded image. pHashes are kept
+in a multi-index hash, which finds all hashes within a small Hamming
+distance of a query with a few dict lookups instead of a scan. A candidate
+is a duplicate if its dHash is within the distance as well.
+
+Duplicates share one entry holding the verdicts of the classifiers, so a
+repeat is answered without any model. SAM2 embeddings are not shared: masks
+must be computed on the photo's own pixels, and byte-identical uploads
+already get the same image id and thus the same cached embedding.
+"""
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from config import DEDUP_MAX_DISTANCE, DEDUP_MAX_ENTRIES
+from metrics import timed
+
+
+def _bits(flags: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(flags.ravel()).tobytes(), "big")
+
+
+def phash(gray: np.ndarray) -> int:
+    """pHash: signs of the 8x8 lowest DCT frequencies of a 32x32 thumbnail against their median."""
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8]
+    return _bits(low > np.median(low.ravel()[1:]))
+
+
+def dhash(gray: np.ndarray) -> int:
+    """dHash: whether each pixel of a 9x8 thumbnail is brighter than its right neighbour."""
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return _bits(small[:, :-1] > small[:, 1:])
+
+
+def image_hashes(image: Image.Image):
+    """(pHash, dHash) of an image."""
+    gray = np.asarray(image.convert("L"))
+    return phash(gray), dhash(gray)
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class MultiIndexHash:
+    """
+    64-bit hashes searchable by Hamming distance up to `max_distance`
+    (multi-index hashing). Hashes are split into max_distance + 1 chunks, each
+    indexed in a dict: two hashes within the distance differ in at most
+    max_distance bits, so at least one of their chunks is equal and the
+    candidates are found by one dict lookup per chunk.
+    """
+
+    def __init__(self, max_distance):
+        chunks = max_distance + 1
+        # bit offsets and widths of the chunks
+        widths = [64 // chunks + (i < 64 % chunks) for i in range(chunks)]
+        offsets = [sum(widths[:i]) for i in range(chunks)]
+        self.max_distance = max_distance
+        self._chunks = [(offset, (1 << width) - 1) for offset, width in zip(offsets, widths)]
+        self._tables = [{} for _ in range(chunks)]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, value: int, item):
+        self._size += 1
+        for (offset, mask), table in zip(self._chunks, self._tables):
+            table.setdefault((value >> offset) & mask, []).append((value, item))
+
+    def search(self, value: int):
+        """[(distance, item)] of every hash within `max_distance`, nearest first."""
+        found = {}
+        for (offset, mask), table in zip(self._chunks, self._tables):
+            for candidate, item in table.get((value >> offset) & mask, ()):
+                distance = hamming(value, candidate)
+                if distance <= self.max_distance:
+                    found[id(item)] = (distance, item)
+        return sorted(found.values(), key=lambda f: f[0])
+
+
+@dataclass
+class Entry:
+    """A photo and its duplicates: the first upload's id, its hashes and cached verdicts."""
+    image_id: str
+    hashes: tuple
+    verdicts: dict = field(default_factory=dict)
+
+
+class DedupIndex:
+    """
+    Entries of the uploaded photos by image id and perceptual hash. Beyond
+    `max_entries` the older half is forgotten and the hash index rebuilt
+    from the rest.
+    """
+
+    def __init__(self, max_distance=DEDUP_MAX_DISTANCE, max_entries=DEDUP_MAX_ENTRIES):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._hashes = MultiIndexHash(max_distance)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    @timed("dedup")
+    def match(self, image_id: str, image: Image.Image) -> Entry:
+        """
+        The entry of the image or of a near-duplicate, added as new entry if
+        there is none.
+        """
+        with self._lock:
+            entry = self._entries.get(image_id)
+            if entry is not None:
+                self.exact_hits += 1
+                self._entries.move_to_end(image_id)
+                return entry
+
+        hashes = image_hashes(image)
+        with self._lock:
+            for _, candidate in self._hashes.search(hashes[0]):
+                if hamming(hashes[1], candidate.hashes[1]) <= self.max_distance:
+                    self.near_hits += 1
+                    self._entries[image_id] = candidate
+                    return candidate
+            self.misses += 1
+            entry = Entry(image_id, hashes)
+            self._entries[image_id] = entry
+            self._hashes.add(hashes[0], entry)
+            if len(self._entries) > self.max_entries:
+                self._forget_older_half()
+            return entry
+
+    def _forget_older_half(self):
+        for _ in range(len(self._entries) // 2):
+            self._entries.popitem(last=False)
+        self._hashes = MultiIndexHash(self.max_distance)
+        for entry in {id(e): e for e in self._entries.values()}.values():
+            self._hashes.add(entry.hashes[0], entry)
@@ -0,0 +1,459 @@
+"""
+Elevation lookups, from a local tiled DEM or the geo.admin.ch height service.
+
+A DEM directory holds one float32 `.npy` raster per tile plus `index.json`
+describing where each tile lies in LV95 (EPSG:2056). Tiles are opened with
+`np.load(mmap_mode='r')`, so only the pages around looked-up points are read.
+
+Convert swissALTI3D tiles (XYZ or ESRI ASCII grid, GeoTIFF with rasterio) with:
+    python elevation.py convert swissalti3d/*.xyz --out ../dem
+
+Without a DEM, RemoteElevation queries the height service through a pooled
+session with timeouts and retries, caching heights of quantized coordinates
+in memory and on disk and fetching independent points concurrently.
+"""
+import argparse
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cache import LRUCache
+from config import (DEM_DIR, ELEVATION_CACHE_PATH, ELEVATION_CACHE_SIZE, ELEVATION_QUANTUM_M,
+                    ELEVATION_RETRIES, ELEVATION_TIMEOUT_S, ELEVATION_URL, ELEVATION_WORKERS)
+from metrics import timed
+
+INDEX_FILE = 'index.json'
+# LV03 (EPSG:21781) coordinates are LV95 shifted by these false origins
+LV03_OFFSET = (2_000_000, 1_000_000)
+
+
+class DEMTile:
+    """
+    One raster tile. (x0, y0) is the center of the top-left cell, rows go
+    south and columns go east in steps of `cell_size` meters.
+    """
+
+    def __init__(self, path, x0, y0, cell_size, nodata=None):
+        self.path = path
+        self.x0 = x0
+        self.y0 = y0
+        self.cell_size = cell_size
+        self.nodata = nodata
+        self.data = np.load(path, mmap_mode='r')
+        self.height, self.width = self.data.shape
+
+    @property
+    def bounds(self):
+        """(west, south, east, north) of the cell centers."""
+        return (
+            self.x0,
+            self.y0 - (self.height - 1) * self.cell_size,
+            self.x0 + (self.width - 1) * self.cell_size,
+            self.y0,
+        )
+
+    def contains(self, x, y):
+        # half a cell of margin closes the gap between adjacent tiles
+        west, south, east, north = self.bounds
+        m = self.cell_size / 2
+        return (x >= west - m) & (x <= east + m) & (y >= south - m) & (y <= north + m)
+
+    def bilinear(self, x, y):
+        """Bilinearly interpolated heights at points inside the tile."""
+        col = (x - self.x0) / self.cell_size
+        row = (self.y0 - y) / self.cell_size
+        c0 = np.clip(np.floor(col).astype(np.int64), 0, self.width - 2)
+        r0 = np.clip(np.floor(row).astype(np.int64), 0, self.height - 2)
+        fc = np.clip(col - c0, 0, 1)
+        fr = np.clip(row - r0, 0, 1)
+
+        z00 = self.data[r0, c0].astype(np.float64)
+        z01 = self.data[r0, c0 + 1].astype(np.float64)
+        z10 = self.data[r0 + 1, c0].astype(np.float64)
+        z11 = self.data[r0 + 1, c0 + 1].astype(np.float64)
+        z = (
+            z00 * (1 - fr) * (1 - fc) + z01 * (1 - fr) * fc
+            + z10 * fr * (1 - fc) + z11 * fr * fc
+        )
+        if self.nodata is not None:
+            invalid = (z00 == self.nodata) | (z01 == self.nodata) | (z10 == self.nodata) | (z11 == self.nodata)
+            z[invalid] = np.nan
+        return z
+
+
+class DEMGrid:
+    """
+    Regular in-memory height grid, e.g. a window cut out of a DEMStore.
+    (x0, y0) is the center of the top-left cell; cells outside the DEM are NaN.
+    """
+
+    def __init__(self, data, x0, y0, cell_size):
+        self.data = data
+        self.x0 = x0
+        self.y0 = y0
+        self.cell_size = cell_size
+        self.height, self.width = data.shape
+
+    def heights(self, x, y):
+        """Bilinearly interpolated heights, NaN outside the grid."""
+        col = (x - self.x0) / self.cell_size
+        row = (self.y0 - y) / self.cell_size
+        outside = (col < 0) | (row < 0) | (col > self.width - 1) | (row > self.height - 1)
+        c0 = np.clip(col.astype(np.int64), 0, self.width - 2)
+        r0 = np.clip(row.astype(np.int64), 0, self.height - 2)
+        fc = col - c0
+        fr = row - r0
+
+        z = (
+            self.data[r0, c0] * (1 - fr) * (1 - fc) + self.data[r0, c0 + 1] * (1 - fr) * fc
+            + self.data[r0 + 1, c0] * fr * (1 - fc) + self.data[r0 + 1, c0 + 1] * fr * fc
+        )
+        z[outside] = np.nan
+        return z
+
+    def gradient(self, x, y):
+        """Terrain slopes (dz/dx, dz/dy) by central differences."""
+        c = self.cell_size
+        dzdx = (self.heights(x + c, y) - self.heights(x - c, y)) / (2 * c)
+        dzdy = (self.heights(x, y + c) - self.heights(x, y - c)) / (2 * c)
+        return dzdx, dzdy
+
+
+class DEMStore:
+    """
+    Collection of DEM tiles with a grid index over their extents, answering
+    vectorized bilinear height queries for arrays of LV95 coordinates.
+    """
+
+    def __init__(self, directory, bucket_size=None):
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.tiles = [
+            DEMTile(os.path.join(directory, t['file']), t['x0'], t['y0'], t['cell_size'], t.get('nodata'))
+            for t in index['tiles']
+        ]
+        # bucket tiles on a coarse grid so lookups only test nearby tiles
+        self.bucket_size = bucket_size or index.get('bucket_size', 1000)
+        self._buckets = defaultdict(list)
+        for i, tile in enumerate(self.tiles):
+            west, south, east, north = np.array(tile.bounds) + np.array([-1, -1, 1, 1]) * tile.cell_size
+            for bx in range(int(west // self.bucket_size), int(east // self.bucket_size) + 1):
+                for by in range(int(south // self.bucket_size), int(north // self.bucket_size) + 1):
+                    self._buckets[bx, by].append(i)
+
+    def elevation(self, easting, northing, sr=None):
+        """
+        Heights in meters at the given coordinates; NaN outside the DEM.
+        Scalars in give a float out, arrays give an array of the same shape.
+        """
+        x = np.asarray(easting, dtype=np.float64)
+        y = np.asarray(northing, dtype=np.float64)
+        shape = np.broadcast(x, y).shape
+        x, y = np.broadcast_to(x, shape).ravel(), np.broadcast_to(y, shape).ravel()
+        if sr == 21781:
+            x, y = x + LV03_OFFSET[0], y + LV03_OFFSET[1]
+
+        z = np.full(x.shape, np.nan)
+        bx = np.floor(x / self.bucket_size).astype(np.int64)
+        by = np.floor(y / self.bucket_size).astype(np.int64)
+        keys, inverse = np.unique(np.stack([bx, by], axis=1), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        for k, (kx, ky) in enumerate(keys):
+            in_bucket = np.flatnonzero(inverse == k)
+            for i in self._buckets.get((kx, ky), ()):
+                todo = in_bucket[np.isnan(z[in_bucket])]
+                if len(todo) == 0:
+                    break
+                tile = self.tiles[i]
+                inside = todo[tile.contains(x[todo], y[todo])]
+                if len(inside):
+                    z[inside] = tile.bilinear(x[inside], y[inside])
+
+        z = z.reshape(shape)
+        return float(z) if z.ndim == 0 else z
+
+
+    def window(self, west, south, east, north, cell_size=None):
+        """
+        Copy the DEM over a bounding box into an in-memory DEMGrid, resampled
+        (nearest cell) to `cell_size` meters, by default the finest tile resolution.
+        """
+        cell_size = cell_size or min(tile.cell_size for tile in self.tiles)
+        xs = west + np.arange(int(np.ceil((east - west) / cell_size)) + 1) * cell_size
+        ys = north - np.arange(int(np.ceil((north - south) / cell_size)) + 1) * cell_size
+        data = np.full((len(ys), len(xs)), np.nan, dtype=np.float32)
+
+        for tile in self.tiles:
+            t_west, t_south, t_east, t_north = tile.bounds
+            m = tile.cell_size / 2
+            cols = np.flatnonzero((xs >= t_west - m) & (xs <= t_east + m))
+            rows = np.flatnonzero((ys >= t_south - m) & (ys <= t_north + m))
+            if len(cols) == 0 or len(rows) == 0:
+                continue
+            tile_cols = np.clip(np.rint((xs[cols] - tile.x0) / tile.cell_size).astype(np.int64), 0, tile.width - 1)
+            tile_rows = np.clip(np.rint((tile.y0 - ys[rows]) / tile.cell_size).astype(np.int64), 0, tile.height - 1)
+            block = np.asarray(tile.data[np.ix_(tile_rows, tile_cols)], dtype=np.float32)
+            if tile.nodata is not None:
+                block[block == tile.nodata] = np.nan
+            data[np.ix_(rows, cols)] = block
+
+        return DEMGrid(data, float(xs[0]), float(ys[0]), cell_size)
+
+
+@functools.lru_cache(maxsize=None)
+def get_dem():
+    """The configured local DEM, or None to use the remote height service."""
+    if not DEM_DIR:
+        return None
+    return DEMStore(DEM_DIR)
+
+
+class ElevationError(Exception):
+    """Raised when the height of a point can't be determined."""
+
+
+class RemoteElevation:
+    """
+    Client for the geo.admin.ch height service (or a compatible server).
+
+    Coordinates are snapped to `quantum` meters; heights of snapped points
+    are kept in an in-memory LRU and, if `cache_path` is set, in a SQLite
+    file shared across restarts. Rows of the file are tagged with the
+    service URL and quantum, so changing either never reads heights of other
+    cells. Concurrent requests for the same point share one HTTP call.
+    """
+
+    def __init__(self, url=ELEVATION_URL, timeout=ELEVATION_TIMEOUT_S, retries=ELEVATION_RETRIES,
+                 quantum=ELEVATION_QUANTUM_M, cache_size=ELEVATION_CACHE_SIZE,
+                 cache_path=ELEVATION_CACHE_PATH, max_workers=ELEVATION_WORKERS):
+        self.url = url
+        self.timeout = timeout
+        self.quantum = quantum
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=max_workers,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=0.2,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=("GET",),
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="elevation")
+
+        self._memory = LRUCache(cache_size, lambda height: 1)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+        self._disk = None
+        if cache_path:
+            self.source = hashlib.sha256(f"{url} {quantum!r}".encode()).hexdigest()[:16]
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+            self._disk = sqlite3.connect(cache_path, check_same_thread=False)
+            columns = [row[1] for row in self._disk.execute("PRAGMA table_info(heights)")]
+            if columns and "source" not in columns:
+                # heights of an unknown service and grid, unusable
+                self._disk.execute("DROP TABLE heights")
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS heights ("
+                "source TEXT, sr INTEGER, easting INTEGER, northing INTEGER, height REAL, "
+                "PRIMARY KEY (source, sr, easting, northing))"
+            )
+            self._disk.commit()
+            self._disk_lock = threading.Lock()
+
+    def elevation(self, easting, northing, sr=None):
+        return self.elevations([(easting, northing)], sr)[0]
+
+    def elevations(self, points, sr=None):
+        """Heights of several (easting, northing) points, fetched concurrently."""
+        futures = [self._lookup(self._key(e, n, sr)) for e, n in points]
+        return [f.result() for f in futures]
+
+    def _key(self, easting, northing, sr):
+        return (sr or 0, round(easting / self.quantum), round(northing / self.quantum))
+
+    def _lookup(self, key):
+        height = self._memory.get(key)
+        if height is not None:
+            future = Future()
+            future.set_result(height)
+            return future
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._pool.submit(self._fetch, key)
+                self._inflight[key] = future
+        return future
+
+    def _fetch(self, key):
+        try:
+            height = self._disk_get(key)
+            if height is None:
+                height = self._request(key)
+                self._disk_put(key, height)
+            self._memory.put(key, height)
+            return height
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _request(self, key):
+        sr, e, n = key
+        params = {"easting": e * self.quantum, "northing": n * self.quantum}
+        if sr:
+            params["sr"] = sr
+        try:
+            response = self.session.get(self.url, params=params, timeout=self.timeout)
+            response.raise_for_status()  # Raise an exception for HTTP errors
+            data = response.json()
+        except requests.RequestException as e:
+            raise ElevationError(f"An error occurred while making the request: {e}") from e
+        except ValueError as e:
+            raise ElevationError("Invalid response format received from the API.") from e
+        if "height" not in data:
+            raise ElevationError("Elevation data not found in the response.")
+        return float(data["height"])
+
+    def _disk_get(self, key):
+        if self._disk is None:
+            return None
+        with self._disk_lock:
+            row = self._disk.execute(
+                "SELECT height FROM heights WHERE source = ? AND sr = ? AND easting = ? AND northing = ?",
+                (self.source, *key),
+            ).fetchone()
+        return row[0] if row else None
+
+    def _disk_put(self, key, height):
+        if self._disk is None:
+            return
+        with self._disk_lock:
+            self._disk.execute("INSERT OR REPLACE INTO heights VALUES (?, ?, ?, ?, ?)", (self.source, *key, height))
+            self._disk.commit()
+
+
+@functools.lru_cache(maxsize=None)
+def get_remote_elevation():
+    return RemoteElevation()
+
+
+@timed("elevation")
+def get_elevations(points, sr=None):
+    """
+    Heights of (easting, northing) points from the local DEM where it has
+    coverage and from the height service otherwise. Raises ElevationError.
+    """
+    points = list(points)
+    heights = [float('nan')] * len(points)
+    dem = get_dem()
+    if dem is not None and points:
+        heights = dem.elevation(*np.array(points, dtype=np.float64).T, sr=sr).tolist()
+
+    missing = [i for i, h in enumerate(heights) if np.isnan(h)]
+    if missing:
+        remote = get_remote_elevation().elevations([points[i] for i in missing], sr)
+        for i, h in zip(missing, remote):
+            heights[i] = h
+    return heights
+
+
+def read_xyz(path):
+    """swissALTI3D XYZ: one 'X Y Z' line per cell center on a regular grid."""
+    xyz = np.loadtxt(path, skiprows=1 if _has_header(path) else 0, dtype=np.float64)
+    xs, ys = np.unique(xyz[:, 0]), np.unique(xyz[:, 1])
+    cell_size = float(np.min(np.diff(xs)))
+    cols = np.rint((xyz[:, 0] - xs[0]) / cell_size).astype(np.int64)
+    rows = np.rint((ys[-1] - xyz[:, 1]) / cell_size).astype(np.int64)
+    nodata = -9999.0
+    data = np.full((rows.max() + 1, cols.max() + 1), nodata, dtype=np.float32)
+    data[rows, cols] = xyz[:, 2]
+    return data, float(xs[0]), float(ys[-1]), cell_size, nodata
+
+
+def read_asc(path):
+    """ESRI ASCII grid."""
+    header = {}
+    with open(path) as f:
+        for _ in range(6):
+            key, value = f.readline().split()
+            header[key.lower()] = float(value)
+    data = np.loadtxt(path, skiprows=6, dtype=np.float32)
+    cell_size = header['cellsize']
+    x0 = header.get('xllcenter', header.get('xllcorner', 0) + cell_size / 2)
+    y_south = header.get('yllcenter', header.get('yllcorner', 0) + cell_size / 2)
+    y0 = y_south + (data.shape[0] - 1) * cell_size
+    return data, x0, y0, cell_size, header.get('nodata_value')
+
+
+def read_geotiff(path):
+    import rasterio
+    with rasterio.open(path) as src:
+        data = src.read(1).astype(np.float32)
+        cell_size = src.transform.a
+        x0 = src.transform.c + cell_size / 2
+        y0 = src.transform.f - cell_size / 2
+        return data, x0, y0, cell_size, src.nodata
+
+
+def _has_header(path):
+    with open(path) as f:
+        first = f.readline().split()
+    try:
+        [float(v) for v in first]
+        return False
+    except ValueError:
+        return True
+
+
+READERS = {'.xyz': read_xyz, '.txt': read_xyz, '.asc': read_asc,
+           '.tif': read_geotiff, '.tiff': read_geotiff}
+
+
+def convert(paths, out_dir):
+    """Convert DEM rasters to memory-mappable tiles and (re)write the index."""
+    os.makedirs(out_dir, exist_ok=True)
+    index_path = os.path.join(out_dir, INDEX_FILE)
+    tiles = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            tiles = {t['file']: t for t in json.load(f)['tiles']}
+
+    for path in paths:
+        data, x0, y0, cell_size, nodata = READERS[os.path.splitext(path)[1].lower()](path)
+        name = os.path.splitext(os.path.basename(path))[0] + '.npy'
+        np.save(os.path.join(out_dir, name), np.ascontiguousarray(data, dtype=np.float32))
+        tiles[name] = {'file': name, 'x0': x0, 'y0': y0, 'cell_size': cell_size, 'nodata': nodata}
+        print(f"{path}: {data.shape[1]}x{data.shape[0]} cells of {cell_size}m")
+
+    with open(index_path, 'w') as f:
+        json.dump({'bucket_size': 1000, 'tiles': list(tiles.values())}, f, indent=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local DEM tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    convert_parser = commands.add_parser('convert', help='convert DEM rasters to memory-mapped tiles')
+    convert_parser.add_argument('paths', nargs='+')
+    convert_parser.add_argument('--out', required=True)
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        convert(args.paths, args.out)
+
+
+if __name__ == "__main__":
+    main()
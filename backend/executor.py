@@ -0,0 +1,75 @@
+import asyncio
+import contextvars
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import EXECUTOR_LIMITS, RETRY_AFTER_S
+from metrics import queue_wait_seconds
+
+
+class QueueFullError(Exception):
+    """Raised when a model executor cannot accept more work."""
+
+    def __init__(self, name, retry_after=RETRY_AFTER_S):
+        super().__init__(f"Too many pending '{name}' requests")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class ModelExecutor:
+    """
+    Runs blocking model calls off the event loop.
+
+    At most `concurrency` calls run at once in a dedicated thread pool and
+    at most `max_queue` more wait for a free thread; beyond that `run`
+    fails fast with QueueFullError instead of piling up latency.
+    """
+
+    def __init__(self, name, concurrency, max_queue):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.pending = 0
+        self._pool = ThreadPoolExecutor(concurrency, thread_name_prefix=f"{name}-executor")
+
+    @property
+    def queued(self):
+        return max(self.pending - self.concurrency, 0)
+
+    async def run(self, fn, *args, **kwargs):
+        return await self.start(fn, *args, **kwargs)
+
+    def start(self, fn, *args, **kwargs) -> asyncio.Future:
+        """
+        Submit a call from the event loop and return its future without
+        waiting, raising QueueFullError right away if the queue is full.
+        """
+        # only touched from the event loop thread, so no lock is needed
+        if self.pending >= self.concurrency + self.max_queue:
+            raise QueueFullError(self.name)
+        self.pending += 1
+        submitted = time.perf_counter()
+
+        def call():
+            queue_wait_seconds.observe(time.perf_counter() - submitted, executor=self.name)
+            return fn(*args, **kwargs)
+
+        def done(future):
+            self.pending -= 1
+
+        loop = asyncio.get_running_loop()
+        # run in the caller's context so stage timings reach its request
+        context = contextvars.copy_context()
+        future = loop.run_in_executor(self._pool, functools.partial(context.run, call))
+        future.add_done_callback(done)
+        return future
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+executors = {
+    name: ModelExecutor(name, concurrency, max_queue)
+    for name, (concurrency, max_queue) in EXECUTOR_LIMITS.items()
+}
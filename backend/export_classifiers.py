@@ -0,0 +1,135 @@
+"""
+Export the classifier checkpoints to the optimized backends and check parity.
+
+For both classifiers this writes a frozen TorchScript model, an ONNX model and,
+with calibration images, a static int8 model to EXPORT_DIR. It then runs every
+backend over a sample set and reports agreement with the eager model, the
+largest probability difference, accuracy (if labels are given) and latency,
+so the fastest acceptable backend can be picked per host via CLASSIFIER_BACKEND.
+
+The sample set is a directory of images or a CSV manifest with a `path` column
+and optional `binary` / `avalanche_type` columns holding the class index.
+
+Example:
+    python export_classifiers.py --calibration /data/calib --samples labels.csv
+"""
+import argparse
+import csv
+import os
+import time
+
+import torch
+from PIL import Image
+
+from bulk_classify import list_images
+from classifier_backends import (BACKENDS, CLASSIFIERS, build_preprocess, build_resnet,
+                                 export_onnx, export_torchscript, exported_path,
+                                 load_backend, quantize_static)
+from config import EXPORT_DIR
+
+
+def read_samples(source, limit):
+    """List of (path, {classifier: label}) from a directory or labeled manifest."""
+    if source.endswith('.csv'):
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, newline='') as f:
+            rows = list(csv.DictReader(f))
+        samples = [
+            (os.path.join(base, row['path']),
+             {name: int(row[name]) for name in CLASSIFIERS if row.get(name, '') != ''})
+            for row in rows
+        ]
+    else:
+        samples = [(path, {}) for path in list_images(source)]
+    return samples[:limit]
+
+
+def load_inputs(paths, size):
+    preprocess = build_preprocess(size)
+    return [preprocess(Image.open(p).convert("RGB")).unsqueeze(0) for p in paths]
+
+
+def export(name, model, calibration):
+    size = CLASSIFIERS[name][2]
+    example = torch.randn(1, 3, size, size)
+
+    export_torchscript(model, exported_path(name, "torchscript"), example)
+    export_onnx(model, exported_path(name, "onnx"), example)
+    print(f"[{name}] exported TorchScript and ONNX")
+
+    if calibration:
+        quantized = quantize_static(model, calibration)
+        export_torchscript(quantized, exported_path(name, "int8_static"), calibration[0])
+        print(f"[{name}] exported static int8 calibrated on {len(calibration)} images")
+
+
+def parity(name, model, backends, inputs, labels):
+    with torch.no_grad():
+        reference = [torch.softmax(model(x), dim=1) for x in inputs]
+    rows = []
+    for backend in backends:
+        try:
+            runner = load_backend(name, backend, model)
+            with torch.no_grad():
+                runner(inputs[0])  # warmup, compiles lazily for torch.compile
+                start = time.perf_counter()
+                probs = [torch.softmax(runner(x), dim=1) for x in inputs]
+                latency = (time.perf_counter() - start) / len(inputs)
+        except Exception as e:
+            print(f"[{name}] {backend}: skipped ({e})")
+            continue
+
+        agreement = sum(
+            int(p.argmax() == r.argmax()) for p, r in zip(probs, reference)
+        ) / len(inputs)
+        max_diff = max((p - r).abs().max().item() for p, r in zip(probs, reference))
+        labeled = [(p, labels[i]) for i, p in enumerate(probs) if labels[i] is not None]
+        accuracy = (
+            sum(int(p.argmax() == label) for p, label in labeled) / len(labeled)
+            if labeled else None
+        )
+        rows.append((backend, agreement, max_diff, accuracy, latency))
+
+    eager_accuracy = next((r[3] for r in rows if r[0] == "eager"), None)
+    print(f"\n[{name}] {len(inputs)} samples")
+    print(f"{'backend':<14}{'top1 agree':>11}{'max |dp|':>10}{'accuracy':>10}{'delta':>8}{'ms/img':>9}")
+    for backend, agreement, max_diff, accuracy, latency in rows:
+        acc = f"{accuracy:.3f}" if accuracy is not None else "-"
+        delta = (
+            f"{accuracy - eager_accuracy:+.3f}"
+            if accuracy is not None and eager_accuracy is not None else "-"
+        )
+        print(f"{backend:<14}{agreement:>11.3f}{max_diff:>10.4f}{acc:>10}{delta:>8}{latency * 1000:>9.1f}")
+    if any(row[0] == "int8_dynamic" for row in rows):
+        print("int8_dynamic quantizes the Linear head only, the convolutions run in fp32")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calibration', help='directory of images for static int8 calibration')
+    parser.add_argument('--calibration-size', type=int, default=64)
+    parser.add_argument('--samples', help='directory or labeled CSV manifest for the parity check')
+    parser.add_argument('--max-samples', type=int, default=200)
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument('--skip-export', action='store_true', help='only run the parity check')
+    args = parser.parse_args()
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    samples = read_samples(args.samples, args.max_samples) if args.samples else []
+
+    for name, (_, _, size) in CLASSIFIERS.items():
+        model = build_resnet(name)
+        if not args.skip_export:
+            calibration = []
+            if args.calibration:
+                paths = list_images(args.calibration)[:args.calibration_size]
+                calibration = load_inputs(paths, size)
+            export(name, model, calibration)
+        if samples:
+            inputs = load_inputs([path for path, _ in samples], size)
+            labels = [sample_labels.get(name) for _, sample_labels in samples]
+            parity(name, model, args.backends, inputs, labels)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,124 +1,59 @@
-import piexif
-import fractions
-import requests
 import math
 
+import numpy as np
+
+from elevation import ElevationError, get_elevations
+from photo_metadata import read_metadata
+from sensors import get_sensor_database
+
 def get_sensor_size(camera_name):
     """
     Get the physical dimensions of a camera sensor in meters.
 
     Parameters:
-    camera_name (str): The name of the camera.
+    camera_name (str): The name of the camera, e.g. "Apple iPhone 11".
 
     Returns:
     tuple: A tuple (sensor_width, sensor_height) in meters if the camera is found.
-    str: An error message if the camera is not found.
+    None: If the camera isn't in the sensor database (see sensors.py).
     """
-    camera_data = {
-        "Sony Alpha 7 IV": (36, 24),
-        "Canon EOS R5": (36, 24),
-        "Nikon Z9": (36, 24),
-        "Panasonic Lumix S5 II": (36, 24),
-        "Fujifilm X-T5": (23.5, 15.6),
-        "Sony Alpha 6400": (23.5, 15.6),
-        "Canon EOS R10": (22.3, 14.9),
-        "Canon EOS M100": (22.3, 14.9),
-        "Olympus OM-D E-M1 Mark III": (17.3, 13),
-        "Panasonic Lumix GH6": (17.3, 13),
-        "Hasselblad X2D 100C": (44, 33),
-        "Fujifilm GFX 100S": (43.8, 32.9),
-        "Sony Xperia Pro-I": (12.8, 9.6),  # Approximate 1-inch dimensions
-        "Xiaomi 13 Ultra": (12.8, 9.6),  # Approximate 1-inch dimensions
-        "Xiaomi 11 Pro": (16, 12),
-        "Apple iPhone 15 Pro Max": (9.6, 7.2),  # 1/1.28-inch
-        "Google Pixel 8 Pro": (9.2, 7),  # 1/1.31-inch
-        "Samsung Galaxy S23 Ultra": (9.6, 7.2),  # 1/1.3-inch
-        "Huawei P60 Pro": (8.8, 6.6),  # 1/1.4-inch
-        "iPhone SE (2022)": (4, 3),  # 1/3.6-inch
-        "Samsung Galaxy A54": (8.9, 6.6),  # 1/1.56-inch
-        "Apple iPhone 15 Pro Max": (9.6, 7.2),  # 1/1.28-inch
-        "Apple iPhone 15 Pro": (9.6, 7.2),  # 1/1.28-inch
-        "Apple iPhone 15": (7.6, 5.7),  # 1/1.65-inch
-        "Apple iPhone 14 Pro Max": (9.6, 7.2),  # 1/1.28-inch
-        "Apple iPhone 14 Pro": (9.6, 7.2),  # 1/1.28-inch
-        "Apple iPhone 14": (7.6, 5.7),  # 1/1.65-inch
-        "Apple iPhone 13 Pro Max": (7.6, 5.7),  # 1/1.65-inch
-        "Apple iPhone 13 Pro": (7.6, 5.7),  # 1/1.65-inch
-        "Apple iPhone 13": (7.6, 5.7),  # 1/1.65-inch
-        "Apple iPhone 12 Pro Max": (8.4, 6.3),  # 1/1.7-inch
-        "Apple iPhone 12 Pro": (8.4, 6.3),  # 1/1.7-inch
-        "Apple iPhone 12": (7.6, 5.7),  # 1/1.65-inch
-        "Apple iPhone 11 Pro Max": (7.6, 5.7),  # 1/2.55-inch
-        "Apple iPhone 11 Pro": (7.6, 5.7),  # 1/2.55-inch
-        "Apple iPhone 11": (6.4, 4.8),  # 1/3-inch
-        "Apple iPhone XS Max": (7.6, 5.7),  # 1/2.55-inch
-        "Apple iPhone XS": (7.6, 5.7),  # 1/2.55-inch
-        "Apple iPhone XR": (6.4, 4.8),  # 1/3-inch
-        "Apple iPhone X": (6.4, 4.8),  # 1/3-inch
-        "Apple iPhone 8 Plus": (6.4, 4.8),  # 1/3-inch
-        "Apple iPhone 8": (6.4, 4.8),  # 1/3-inch
-        "Apple iPhone 7 Plus": (6.4, 4.8),  # 1/3-inch
-        "Apple iPhone 7": (6.4, 4.8),  # 1/3-inch
-        "Apple iPhone 6s Plus": (6.4, 4.8),  # 1/3-inch
-        "Apple iPhone 6s": (6.4, 4.8),  # 1/3-inch
-        "Apple iPhone 6 Plus": (6.4, 4.8),  # 1/3-inch
-        "Apple iPhone 6": (6.4, 4.8),  # 1/3-inch
-        "Apple iPhone SE (2022)": (4, 3),  # 1/3.6-inch
-        "DJI Mini 3 Pro (Drone)": (9.6, 7.2),  # 1/1.3-inch
-        "GoPro Hero 12 Black": (6.9, 5.2)  # 1/1.9-inch
-    }
-
-    if camera_name in camera_data:
-        sensor_width, sensor_height = camera_data[camera_name]
-        # Convert from mm to meters
-        return (sensor_width / 1000, sensor_height / 1000)
-    else:
-        return "Camera not found."
-    
-def convert_to_degrees(value, ref):
-    """Convert GPS coordinates to degrees."""
-    d = float(value[0][0]) / float(value[0][1])
-    m = float(value[1][0]) / float(value[1][1])
-    s = float(value[2][0]) / float(value[2][1])
-
-    if ref in ['S', 'W']:
-        d = -d
-        m = -m
-        s = -s
-
-    return d + (m / 60.0) + (s / 3600.0)
+    match = get_sensor_database().find(None, camera_name)
+    return match[0].size if match is not None else None
 
 def get_exif_data(image_path):
-    """Extract latitude, longitude, and focal length from a JPEG image."""
-    exif_data = piexif.load(image_path)
-    gps_info = exif_data.get("GPS", {})
-    exif_info = exif_data.get("Exif", {})
-
-    # Extract GPS Data
-    latitude = None
-    longitude = None
-    if piexif.GPSIFD.GPSLatitude in gps_info and piexif.GPSIFD.GPSLatitudeRef in gps_info:
-        print('Ciao')
-        latitude = convert_to_degrees(
-            gps_info[piexif.GPSIFD.GPSLatitude],
-            gps_info[piexif.GPSIFD.GPSLatitudeRef].decode()
-        )
-    if piexif.GPSIFD.GPSLongitude in gps_info and piexif.GPSIFD.GPSLongitudeRef in gps_info:
-        longitude = convert_to_degrees(
-            gps_info[piexif.GPSIFD.GPSLongitude],
-            gps_info[piexif.GPSIFD.GPSLongitudeRef].decode()
-        )
+    """Extract latitude, longitude, and focal length (in meters) from a JPEG image path or its raw bytes."""
+    if isinstance(image_path, str):
+        with open(image_path, 'rb') as f:
+            image_path = f.read()
+    metadata = read_metadata(image_path)
+    focal_length = metadata.focal_length_mm / 1000 if metadata.focal_length_mm is not None else None
+    return metadata.latitude, metadata.longitude, focal_length
+
+def wgs84_to_lv95(latitude, longitude, altitude=None):
+    """
+    Convert WGS84 coordinates to Swiss LV95 (EPSG:2056), with swisstopo's
+    approximate formulas (about 1m accuracy). Accepts scalars or arrays.
 
-    # Extract Focal Length
-    focal_length = None
-    if piexif.ExifIFD.FocalLength in exif_info:
-        focal_length = exif_info[piexif.ExifIFD.FocalLength]
-        focal_length = float(focal_length[0]) / float(focal_length[1])
+    Returns:
+        tuple: (easting, northing) or, with altitudes, (easting, northing, height above LN02).
+    """
+    # auxiliary values, differences to Bern in units of 10000"
+    phi = (np.asarray(latitude, dtype=np.float64) * 3600 - 169028.66) / 10000
+    lam = (np.asarray(longitude, dtype=np.float64) * 3600 - 26782.5) / 10000
+
+    easting = (2600072.37 + 211455.93 * lam - 10938.51 * lam * phi
+               - 0.36 * lam * phi ** 2 - 44.54 * lam ** 3)
+    northing = (1200147.07 + 308807.95 * phi + 3745.25 * lam ** 2 + 76.63 * phi ** 2
+                - 194.56 * lam ** 2 * phi + 119.79 * phi ** 3)
+    if altitude is None:
+        return easting, northing
+    height = np.asarray(altitude, dtype=np.float64) - 49.55 + 2.73 * lam + 6.94 * phi
+    return easting, northing, height
 
-    return latitude, longitude, focal_length/1000
 def get_elevation(easting, northing, sr=None):
     """
-    Retrieve the elevation of a point using the Swiss geo.admin.ch height service.
+    Retrieve the elevation of a point from the local DEM if one is configured
+    (DEM_DIR) and covers it, otherwise from the Swiss geo.admin.ch height service.
 
     Args:
         easting (float): The easting coordinate in LV03 (EPSG:21781) or LV95 (EPSG:2056).
@@ -127,29 +62,11 @@ def get_elevation(easting, northing, sr=None):
 
     Returns:
         float: Elevation in meters.
-        str: Error message if the request fails.
-    """
-    url = "https://api3.geo.admin.ch/rest/services/height"
-    params = {
-        "easting": easting,
-        "northing": northing
-    }
-    if sr:
-        params["sr"] = sr
-
-    try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-        data = response.json()
 
-        if "height" in data:
-            return float(data["height"])
-        else:
-            return "Elevation data not found in the response."
-    except requests.RequestException as e:
-        return f"An error occurred while making the request: {e}"
-    except ValueError:
-        return "Invalid response format received from the API."
+    Raises:
+        ElevationError: If the elevation can't be retrieved.
+    """
+    return get_elevations([(easting, northing)], sr)[0]
     
 def compute_steepness_angles(easting, northing, delta=1, sr=None):
     """
@@ -163,21 +80,17 @@ def compute_steepness_angles(easting, northing, delta=1, sr=None):
 
     Returns:
         tuple: Steepness angles (in degrees) in the easting and northing directions.
-        str: Error message if the calculation fails.
-    """
-    # Elevations at the central point and offsets
-    z_center = get_elevation(easting, northing, sr)
-    if z_center is None:
-        return None, "Elevation data unavailable for the central point."
 
-    z_east = get_elevation(easting + delta, northing, sr)
-    if z_east is None:
-        return None, "Elevation data unavailable for the east-offset point."
-
-    z_north = get_elevation(easting, northing + delta, sr)
-    if z_north is None:
-        return None, "Elevation data unavailable for the north-offset point."
+    Raises:
+        ElevationError: If the elevations can't be retrieved.
+    """
+    # Elevations at the central point and offsets, looked up together
+    z_center, z_east, z_north = get_elevations(
+        [(easting, northing), (easting + delta, northing), (easting, northing + delta)], sr
+    )
+    return _steepness_angles(z_center, z_east, z_north, delta)
 
+def _steepness_angles(z_center, z_east, z_north, delta):
     # Compute the change in elevation (dZ) and change in position (dE and dN)
     delta_z_east = z_east - z_center
     delta_z_north = z_north - z_center
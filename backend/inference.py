@@ -1,56 +1,100 @@
-import gc
+import hashlib
+import os
+import threading
 
 import numpy as np
-import torch
 
 from sam2.build_sam import build_sam2
 from sam2.sam2_image_predictor import SAM2ImagePredictor
 
-def get_sam_predictor(device=None, image=None):
-  sam2_checkpoint = "../checkpoints/sam2.1_hiera_large.pt"
-  model_cfg = "configs/sam2.1/sam2.1_hiera_l.yaml"
-  sam2_model = build_sam2(model_cfg, sam2_checkpoint, device=device)
+from cache import LRUCache
+from config import CHECKPOINT_DIR, SAM_EMBEDDING_CACHE_MB, SAM_MODEL
+from metrics import timed
 
-  predictor = SAM2ImagePredictor(sam2_model)
+# variant: (checkpoint, model config)
+SAM2_VARIANTS = {
+  "tiny": ("sam2.1_hiera_tiny.pt", "configs/sam2.1/sam2.1_hiera_t.yaml"),
+  "small": ("sam2.1_hiera_small.pt", "configs/sam2.1/sam2.1_hiera_s.yaml"),
+  "base_plus": ("sam2.1_hiera_base_plus.pt", "configs/sam2.1/sam2.1_hiera_b+.yaml"),
+  "large": ("sam2.1_hiera_large.pt", "configs/sam2.1/sam2.1_hiera_l.yaml"),
+}
+
+# One SAM2 model per variant and device, shared by every predictor in the process
+_sam_models = {}
+_sam_models_lock = threading.Lock()
+
+
+def _features_nbytes(entry):
+  features, _ = entry
+  tensors = [features["image_embed"], *features["high_res_feats"]]
+  return sum(t.element_size() * t.nelement() for t in tensors)
+
+
+# Image embeddings keyed by image content hash, so re-uploads skip the encoder
+embedding_cache = LRUCache(SAM_EMBEDDING_CACHE_MB * 1024 * 1024, _features_nbytes)
+
+
+def get_sam_model(device=None, variant=None):
+  device = device or 'cpu'
+  variant = variant or SAM_MODEL
+  if variant not in SAM2_VARIANTS:
+    raise ValueError(f"Unknown SAM2 variant '{variant}', expected one of {list(SAM2_VARIANTS)}")
+  with _sam_models_lock:
+    if (variant, device) not in _sam_models:
+      checkpoint, model_cfg = SAM2_VARIANTS[variant]
+      _sam_models[variant, device] = build_sam2(
+        model_cfg, os.path.join(CHECKPOINT_DIR, checkpoint), device=device
+      )
+    return _sam_models[variant, device]
+
+
+def image_key(image: np.ndarray) -> str:
+  """Content hash of a decoded image, used as embedding cache key."""
+  digest = hashlib.sha256(str(image.shape).encode())
+  digest.update(np.ascontiguousarray(image).data)
+  return digest.hexdigest()
+
+
+def set_image_cached(predictor, image, key=None, variant=None):
+  """
+  Set the image on a predictor, reusing cached features when the
+  same image has been embedded by the same model variant before.
+  """
+  key = (variant or SAM_MODEL, key or image_key(image))
+  entry = embedding_cache.get(key)
+  if entry is None:
+    with timed("sam_set_image"):
+      predictor.set_image(image)
+    embedding_cache.put(key, (predictor._features, predictor._orig_hw))
+    return predictor
+  predictor.reset_predictor()
+  predictor._features, predictor._orig_hw = entry
+  predictor._is_image_set = True
+  predictor._is_batch = False
+  return predictor
+
+
+def get_sam_predictor(device=None, image=None, key=None, variant=None):
+  predictor = SAM2ImagePredictor(get_sam_model(device, variant))
   if image is not None:
-    predictor.set_image(image)
+    set_image_cached(predictor, image, key, variant)
   return predictor
 
-def run_inference(predictor, input_x, selected_points,
-                  multi_object: bool = False):
-  if len(selected_points) == 0:
-    return []
-  points = torch.Tensor(
-      [p for p, _ in selected_points]
-  ).to(predictor.device).unsqueeze(1)
-
-  labels = torch.Tensor(
-      [int(l) for _, l in selected_points]
-  ).to(predictor.device).unsqueeze(1)
-
-  # predict segmentation according to the boxes
-  masks, scores, logits = predictor.predict(
-    point_coords=points,
-    point_labels=labels,
-    multimask_output=True,
-  )
-  masks = torch.tensor(masks).unsqueeze(0)
-  scores = torch.tensor(scores).unsqueeze(0)
-
-  masks = masks[:, torch.argmax(scores, dim=1)]
-  masks_pos = masks[labels[:, 0] == 1, 0].cpu().detach().numpy()
-  masks_neg = masks[labels[:, 0] == 0, 0].cpu().detach().numpy()
-  if not multi_object:
-    if len(masks_neg) == 0:
-      masks_neg = np.zeros_like(masks_pos)
-    if len(masks_pos) == 0:
-      masks_pos = np.zeros_like(masks_neg)
-    masks_neg = masks_neg.max(axis=0, keepdims=True)
-    masks_pos = masks_pos.max(axis=0, keepdims=True)
-    masks = (masks_pos.astype(int) - masks_neg.astype(int)).clip(0, 1)
-  else:
-    masks = np.concatenate([masks_pos, masks_neg], axis=0)
-  gc.collect()
-  torch.cuda.empty_cache()
-
-  return [(mask, f'mask_{i}') for i, mask in enumerate(masks)]
+def predict_object(predictor, points, labels, mask_input=None):
+  """
+  One mask for one object prompted by foreground (1) and background (0)
+  points. `mask_input` are the low-res logits of the previous prediction for
+  the object, which SAM refines instead of starting over. Returns the boolean
+  mask and its low-res logits (1, 256, 256) to feed back on the next click.
+  """
+  # only an ambiguous single click needs SAM's three candidate masks
+  multimask = len(points) == 1 and mask_input is None
+  with timed("sam_predict"):
+    masks, scores, logits = predictor.predict(
+      point_coords=np.asarray(points, dtype=np.float32),
+      point_labels=np.asarray(labels, dtype=np.int32),
+      mask_input=mask_input,
+      multimask_output=multimask,
+    )
+  best = int(np.argmax(scores))
+  return masks[best] > 0, logits[best:best + 1]
@@ -0,0 +1,391 @@
+"""
+Concurrent end-to-end load test of the segmentation flow.
+
+Virtual users repeatedly go through upload -> spamcheck -> N x /add_point ->
+/undo, either in-process against the FastAPI app or against a running server.
+Latency percentiles and throughput are reported per endpoint.
+
+During long soak runs the server's RSS (from /metrics) is sampled, and in
+process mode also the number of live torch tensors and numpy arrays and of
+files in a temp directory of its own, so slow growth across thousands of sessions
+(predictor rebuilds, leftover temp files, ...) shows up as a trend. Open
+sessions legitimately hold memory until they expire, so the run fails if
+RSS minus the session store's memory grows by more than --max-rss-growth-mb
+after warmup.
+
+With --stub-models the classifiers and SAM2 are replaced by cheap stand-ins,
+so the test needs no checkpoints and measures the serving overhead. Run the
+same stubs behind a real server with the `serve` command.
+
+Example:
+    python loadtest.py --stub-models --users 16 --sessions 50
+    python loadtest.py serve --stub-models --port 8000 &
+    python loadtest.py --url http://127.0.0.1:8000 --users 32 --duration 3600
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+
+# (width, height) of the uploaded photos
+IMAGE_SIZE = (4000, 3000)
+
+
+class StubPredictor:
+    """Stands in for SAM2ImagePredictor: a disk around the last clicked point."""
+
+    def __init__(self, image, delay):
+        self.shape = image.shape[:2]
+        self.delay = delay
+
+    def predict(self, point_coords, point_labels, mask_input=None, multimask_output=True):
+        time.sleep(self.delay)
+        height, width = self.shape
+        x, y = point_coords[-1]
+        yy, xx = np.ogrid[0:height, 0:width]
+        mask = (yy - y) ** 2 + (xx - x) ** 2 < (min(height, width) / 8) ** 2
+        n = 3 if multimask_output else 1
+        return (
+            np.repeat(mask[None], n, axis=0),
+            np.linspace(1, 0.5, n),
+            np.zeros((n, 256, 256), dtype=np.float32),
+        )
+
+
+def install_stubs(classifier_delay=0.02, embed_delay=0.2, predict_delay=0.02):
+    """Import the app with stand-ins for every model; returns the app module."""
+    os.environ["WARMUP"] = "0"
+    import app_fastapi
+
+    def classify(image):
+        time.sleep(classifier_delay)
+        return 1
+
+    def get_predictor(device=None, image=None, key=None, variant=None):
+        time.sleep(embed_delay)
+        return StubPredictor(image, predict_delay)
+
+    # config may have been imported before WARMUP was set
+    app_fastapi.WARMUP = False
+    app_fastapi.predict_spam = classify
+    app_fastapi.predict_avalanche_type = classify
+    app_fastapi.get_sam_predictor = get_predictor
+    return app_fastapi
+
+
+def make_images(count, size, seed=0):
+    from benchmark import jpeg_bytes, synthetic_photo
+    return [jpeg_bytes(synthetic_photo(size, seed + i)) for i in range(count)]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+        self.sessions = 0
+
+    def record(self, endpoint, elapsed, status):
+        self.latencies[endpoint].append(elapsed)
+        if status is None or status >= 400:
+            self.errors[endpoint][str(status or "failed")] += 1
+
+    def summary(self, duration):
+        rows = {}
+        for endpoint, times in sorted(self.latencies.items()):
+            times = sorted(times)
+            rows[endpoint] = {
+                "requests": len(times),
+                "errors": sum(self.errors[endpoint].values()),
+                "errors_by_status": dict(self.errors[endpoint]),
+                "throughput_rps": len(times) / duration,
+                "p50_ms": percentile(times, 50) * 1000,
+                "p90_ms": percentile(times, 90) * 1000,
+                "p99_ms": percentile(times, 99) * 1000,
+                "max_ms": times[-1] * 1000,
+            }
+        return rows
+
+
+def percentile(sorted_values, q):
+    index = min(int(round(q / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+async def call(client, stats, endpoint, method, url, retries=0, **kwargs):
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            status = response.status_code
+        except Exception:
+            response, status = None, None
+        stats.record(endpoint, time.perf_counter() - start, status)
+        # 429s are the executors shedding load, back off like the frontend would
+        if status != 429 or attempt == retries:
+            break
+        await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+    return response if status is not None and status < 400 else None
+
+
+async def user(client, stats, images, clicks, retries, deadline, sessions_left, rng):
+    while time.monotonic() < deadline and sessions_left[0] > 0:
+        sessions_left[0] -= 1
+        data = rng.choice(images)
+        response = await call(client, stats, "/upload", "POST", "/upload", retries,
+                              files={"file": ("photo.jpg", data, "image/jpeg")})
+        if response is None:
+            continue
+        upload = response.json()
+        response = await call(client, stats, "/spamcheck", "POST", "/spamcheck", retries,
+                              data={"image_id": upload["image_id"]})
+        if response is None or "session_id" not in response.json():
+            continue
+        session_id = response.json()["session_id"]
+
+        for i in range(clicks):
+            point = {
+                "session_id": session_id,
+                "x": rng.randrange(upload["width"]),
+                "y": rng.randrange(upload["height"]),
+                "label": 0 if i % 3 == 2 else 1,
+                "new_object": i % 4 == 0 and i > 0,
+                "response_format": "rle",
+            }
+            await call(client, stats, "/add_point", "POST", "/add_point", retries, json=point)
+        await call(client, stats, "/undo", "POST", "/undo", retries,
+                   json={"session_id": session_id, "response_format": "rle"})
+        stats.sessions += 1
+
+
+def count_objects():
+    """
+    Live torch tensors and numpy arrays in this process. Neither is tracked by
+    the garbage collector itself, so they are found as referents of the
+    containers and instances that are.
+    """
+    import torch
+    seen = set()
+    tensors = arrays = 0
+    for container in gc.get_objects():
+        for obj in gc.get_referents(container):
+            kind = type(obj)
+            if id(obj) in seen or not (issubclass(kind, torch.Tensor) or issubclass(kind, np.ndarray)):
+                continue
+            seen.add(id(obj))
+            if issubclass(kind, torch.Tensor):
+                tensors += 1
+            else:
+                arrays += 1
+    return tensors, arrays
+
+
+# gauges scraped from /metrics, sessions are held until they expire so their
+# memory is expected to grow until the session store is full
+GAUGES = {
+    "process_resident_memory_bytes": ("rss_mb", 2 ** 20),
+    "avalanche_sessions": ("sessions_open", 1),
+    "avalanche_sessions_bytes": ("sessions_mb", 2 ** 20),
+}
+
+
+async def scrape(client):
+    response = await client.get("/metrics")
+    values = {}
+    for line in response.text.splitlines():
+        name, _, value = line.partition(" ")
+        if name in GAUGES:
+            key, unit = GAUGES[name]
+            values[key] = float(value) / unit
+    return values
+
+
+def private_tempdir():
+    """Point the app's temp files at a fresh directory, so only they are counted."""
+    tmp = tempfile.mkdtemp(prefix="loadtest-")
+    os.environ["TMPDIR"] = tmp
+    tempfile.tempdir = tmp
+    return tmp
+
+
+async def monitor(client, stats, samples, interval, tmp, stop):
+    while True:
+        sample = {"t": time.monotonic(), "sessions": stats.sessions}
+        try:
+            sample.update(await scrape(client))
+            sample["rss_unaccounted_mb"] = sample["rss_mb"] - sample.get("sessions_mb", 0)
+        except Exception:
+            pass
+        if tmp is not None:
+            sample["tensors"], sample["arrays"] = count_objects()
+            sample["temp_files"] = len(os.listdir(tmp))
+        samples.append(sample)
+        if stop.is_set():
+            return
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+def growth(samples, key, warmup):
+    """Change of `key` between the end of warmup and the last sample, and per 1000 sessions."""
+    values = [s for s in samples if s.get(key) is not None]
+    after = [s for s in values if s["t"] >= values[0]["t"] + warmup] if values else []
+    if len(after) < 2:
+        after = values
+    if len(after) < 2:
+        return None
+    first, last = after[0], after[-1]
+    change = last[key] - first[key]
+    sessions = last["sessions"] - first["sessions"]
+    return {
+        "start": first[key],
+        "end": last[key],
+        "change": change,
+        "per_1000_sessions": change / sessions * 1000 if sessions else None,
+    }
+
+
+async def run(args):
+    import httpx
+
+    in_process = args.url is None
+    tmp = private_tempdir() if in_process else None
+    if in_process:
+        if args.stub_models:
+            app_module = install_stubs(args.classifier_delay, args.embed_delay, args.predict_delay)
+        else:
+            import app_fastapi as app_module
+        transport = httpx.ASGITransport(app=app_module.app)
+        base_url = "http://loadtest"
+    else:
+        transport = None
+        base_url = args.url
+
+    width, height = (int(v) for v in args.image_size.lower().split("x"))
+    images = make_images(args.images, (width, height), args.seed)
+    stats = Stats()
+    samples = []
+    stop = asyncio.Event()
+    limits = httpx.Limits(max_connections=args.users * 2)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout,
+                                     limits=limits) as client:
+            start = time.monotonic()
+            deadline = start + args.duration if args.duration else float("inf")
+            sessions_left = [args.sessions * args.users if not args.duration else float("inf")]
+            watcher = asyncio.create_task(monitor(client, stats, samples, args.sample_interval, tmp, stop))
+            await asyncio.gather(*(
+                user(client, stats, images, args.clicks, args.retries, deadline, sessions_left,
+                     random.Random(args.seed + i))
+                for i in range(args.users)
+            ))
+            duration = time.monotonic() - start
+            stop.set()
+            await watcher
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {
+        "users": args.users,
+        "sessions": stats.sessions,
+        "duration_s": duration,
+        "sessions_per_s": stats.sessions / duration,
+        "endpoints": stats.summary(duration),
+        "growth": {
+            key: growth(samples, key, args.warmup)
+            for key in ("rss_mb", "rss_unaccounted_mb", "sessions_open", "sessions_mb", "tensors", "arrays", "temp_files")
+        },
+        "samples": samples if args.samples else len(samples),
+    }
+    return report
+
+
+def print_report(report):
+    print(f"{report['sessions']} sessions by {report['users']} users in {report['duration_s']:.1f}s "
+          f"({report['sessions_per_s']:.2f} sessions/s)", file=sys.stderr)
+    print(f"{'endpoint':<14}{'requests':>10}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+          file=sys.stderr)
+    for endpoint, row in report["endpoints"].items():
+        print(f"{endpoint:<14}{row['requests']:>10}{row['errors']:>8}{row['throughput_rps']:>9.1f}"
+              f"{row['p50_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}", file=sys.stderr)
+        if row['errors_by_status']:
+            print(f"{'':<14}errors by status: {row['errors_by_status']}", file=sys.stderr)
+    for key, g in report["growth"].items():
+        if g is not None:
+            per = f", {g['per_1000_sessions']:+.1f} per 1000 sessions" if g["per_1000_sessions"] is not None else ""
+            print(f"{key:<20}{g['start']:>10.1f} -> {g['end']:.1f}{per}", file=sys.stderr)
+
+
+def serve(args):
+    import uvicorn
+    tmp = private_tempdir()
+    print(f"Temp files in {tmp}", file=sys.stderr)
+    if args.stub_models:
+        app_module = install_stubs(args.classifier_delay, args.embed_delay, args.predict_delay)
+    else:
+        import app_fastapi as app_module
+    try:
+        uvicorn.run(app_module.app, host=args.host, port=args.port)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'serve'])
+    parser.add_argument('--url', help='server to test, in-process if not given')
+    parser.add_argument('--users', type=int, default=8, help='concurrent virtual users')
+    parser.add_argument('--sessions', type=int, default=10, help='sessions per user')
+    parser.add_argument('--duration', type=float, help='run for this many seconds instead')
+    parser.add_argument('--clicks', type=int, default=5, help='/add_point calls per session')
+    parser.add_argument('--images', type=int, default=4, help='distinct photos to upload')
+    parser.add_argument('--image-size', default=f'{IMAGE_SIZE[0]}x{IMAGE_SIZE[1]}')
+    parser.add_argument('--retries', type=int, default=3, help='retries of requests rejected with 429')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stub-models', action='store_true', help='replace the models by cheap stand-ins')
+    parser.add_argument('--classifier-delay', type=float, default=0.02, help='seconds per stub classification')
+    parser.add_argument('--embed-delay', type=float, default=0.2, help='seconds per stub SAM2 embedding')
+    parser.add_argument('--predict-delay', type=float, default=0.02, help='seconds per stub SAM2 prediction')
+    parser.add_argument('--sample-interval', type=float, default=5, help='seconds between memory samples')
+    parser.add_argument('--warmup', type=float, default=30, help='seconds ignored for memory growth')
+    parser.add_argument('--max-rss-growth-mb', type=float, help='fail if RSS not held by sessions grows more after warmup')
+    parser.add_argument('--samples', action='store_true', help='include every memory sample in the output')
+    parser.add_argument('--output', help='JSON report file (printed to stdout if not given)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args)
+        return
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    rss = report["growth"]["rss_unaccounted_mb"]
+    if args.max_rss_growth_mb is not None and rss is not None and rss["change"] > args.max_rss_growth_mb:
+        print(f"RSS not held by sessions grew by {rss['change']:.1f} MB after warmup "
+              f"(limit {args.max_rss_growth_mb} MB)", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
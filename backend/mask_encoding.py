@@ -0,0 +1,107 @@
+"""
+Encodings of segmentation results sent to the client.
+
+Instead of re-encoding the whole composited photo after every click, the
+client can keep the masks itself and only receive what changed, as a binary
+body (little-endian):
+
+    header  4s  magic b"RLEM"
+            B   operation: 0 append the masks, 1 replace all masks, 2 pop the last
+                mask, 3 replace the last mask
+            3x  padding
+            I   image height
+            I   image width
+            I   number of masks that follow
+    mask    I   x0, I y0, I width, I height of the mask's bounding box
+            I   number of runs, followed by that many I run lengths
+
+Runs alternate between background and mask pixels in row-major order inside
+the bounding box, starting with background (possibly a run of 0). An empty
+mask has an empty box and no runs.
+"""
+import struct
+
+import cv2
+import numpy as np
+
+from metrics import timed
+
+MAGIC = b"RLEM"
+APPEND, REPLACE, POP, UPDATE = 0, 1, 2, 3
+HEADER = struct.Struct("<4sB3xIII")
+MASK_HEADER = struct.Struct("<IIIII")
+
+IMAGE_FORMATS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp"}
+
+
+def mask_runs(mask: np.ndarray):
+    """Bounding box (x0, y0, w, h) of a boolean mask and its run lengths inside it."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return (0, 0, 0, 0), np.zeros(0, dtype="<u4")
+    cols = np.flatnonzero(mask.any(axis=0))
+    y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+    flat = mask[y0:y1, x0:x1].ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate([[0], changes, [len(flat)]])
+    runs = np.diff(bounds)
+    if flat[0]:
+        runs = np.concatenate([[0], runs])
+    return (int(x0), int(y0), int(x1 - x0), int(y1 - y0)), runs.astype("<u4")
+
+
+@timed("encode_masks")
+def encode_masks(masks, shape, operation=APPEND) -> bytes:
+    """Binary RLE body for the boolean `masks` of an image of `shape` (H, W)."""
+    parts = [HEADER.pack(MAGIC, operation, shape[0], shape[1], len(masks))]
+    for mask in masks:
+        (x0, y0, w, h), runs = mask_runs(mask)
+        parts.append(MASK_HEADER.pack(x0, y0, w, h, len(runs)))
+        parts.append(runs.tobytes())
+    return b"".join(parts)
+
+
+def decode_masks(data: bytes):
+    """Inverse of `encode_masks`: (operation, list of boolean masks)."""
+    magic, operation, height, width, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not an RLE mask body")
+    offset = HEADER.size
+    masks = []
+    for _ in range(count):
+        x0, y0, w, h, n = MASK_HEADER.unpack_from(data, offset)
+        offset += MASK_HEADER.size
+        runs = np.frombuffer(data, dtype="<u4", count=n, offset=offset)
+        offset += 4 * n
+        values = np.arange(n) % 2 == 1
+        mask = np.zeros((height, width), dtype=bool)
+        mask[y0:y0 + h, x0:x0 + w] = np.repeat(values, runs).reshape(h, w)
+        masks.append(mask)
+    return operation, masks
+
+
+@timed("encode_image")
+def encode_image(image: np.ndarray, fmt="png", quality=90) -> bytes:
+    """Encode a BGR image as PNG, JPEG or WebP."""
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format '{fmt}', expected one of {list(IMAGE_FORMATS)}")
+    params = []
+    if fmt == "jpeg":
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif fmt == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    success, encoded = cv2.imencode(IMAGE_FORMATS[fmt], image, params)
+    if not success:
+        raise RuntimeError(f"Could not encode image as {fmt}")
+    return encoded.tobytes()
+
+
+def downscale(image: np.ndarray, max_side: int) -> np.ndarray:
+    """Shrink an image so its longer side is at most `max_side` pixels."""
+    height, width = image.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1:
+        return image
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
@@ -0,0 +1,261 @@
+"""
+Latency and resource instrumentation of the backend.
+
+Stages of a request (decoding, classifier and SAM2 calls, encoding, elevation
+lookups, ...) are wrapped in `timed(stage)`, which records them in a Prometheus
+histogram and in the timings of the current request, logged as one JSON line
+per request. Gauges such as queue depths, cache hit rates, session counts and
+RSS are read by collectors when /metrics is scraped, so they cost nothing in
+between.
+
+Tracing backends plug in with `add_hook(hook)`: `hook(stage)` returns a
+context manager entered around the stage, e.g. an OpenTelemetry span. Without
+hooks `timed` only takes two timestamps.
+"""
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from config import REQUEST_LOG, TRACING
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+logger = logging.getLogger("avalanche.requests")
+
+
+def _escape_label(value):
+    # the text exposition format escapes backslashes, double quotes and newlines
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape_label(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels: (count per bucket + overflow, sum)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(names, key + (bound,))} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+stage_seconds = Histogram("avalanche_stage_seconds", "Duration of request stages", ("stage",))
+queue_wait_seconds = Histogram(
+    "avalanche_executor_queue_seconds", "Time model calls wait for an executor thread", ("executor",)
+)
+batch_size = Histogram(
+    "avalanche_batch_size", "Inputs per classifier forward pass", ("model",), buckets=(1, 2, 4, 8, 16, 32)
+)
+requests_total = Counter("avalanche_requests_total", "HTTP requests", ("path", "status"))
+request_seconds = Histogram("avalanche_request_seconds", "HTTP request duration", ("path",))
+speculative_embeddings = Counter(
+    "avalanche_speculative_embeddings_total", "SAM2 embeddings of uploads by when they started", ("result",)
+)
+
+_metrics = [stage_seconds, queue_wait_seconds, batch_size, requests_total, request_seconds, speculative_embeddings]
+_collectors = []
+_hooks = []
+
+# stage timings of the request being handled, see `request_timings`
+_timings = contextvars.ContextVar("timings", default=None)
+
+
+def register_collector(collector):
+    """
+    Register a callable returning [(name, type, help, [(labels dict, value)])]
+    that is evaluated on every scrape.
+    """
+    _collectors.append(collector)
+
+
+def add_hook(hook):
+    """Trace every stage with `hook(stage)`, a context manager factory."""
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+@contextmanager
+def timed(stage):
+    """Time a stage of the current request, usable as decorator as well."""
+    if _hooks:
+        with ExitStack() as stack:
+            for hook in _hooks:
+                stack.enter_context(hook(stage))
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                _record(stage, time.perf_counter() - start)
+    else:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            _record(stage, time.perf_counter() - start)
+
+
+def _record(stage, elapsed):
+    stage_seconds.observe(elapsed, stage=stage)
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+@contextmanager
+def request_timings():
+    """Collect the stage timings of everything run in this context."""
+    timings = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def log_request(method, path, status, elapsed, timings, route=None):
+    """
+    Count a request under its route template and log it with its path.
+    Requests matching no route share one series, so arbitrary paths don't
+    create new ones.
+    """
+    route = route or "unmatched"
+    requests_total.inc(path=route, status=status)
+    request_seconds.observe(elapsed, path=route)
+    if REQUEST_LOG:
+        logger.info(json.dumps({
+            "method": method,
+            "path": path,
+            "status": status,
+            "ms": round(elapsed * 1000, 2),
+            "stages_ms": {stage: round(t * 1000, 2) for stage, t in timings.items()},
+        }))
+
+
+def rss_bytes():
+    """Resident set size of the process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        # peak rather than current RSS where /proc is missing (KB on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def pss_bytes():
+    """
+    Proportional set size: pages shared with other processes count divided
+    by their number of sharers, so the PSS of pre-forked workers adds up to
+    their total memory. None where /proc is missing.
+    """
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _process_metrics():
+    metrics = [
+        ("process_resident_memory_bytes", "gauge", "Resident memory size", [({}, rss_bytes())]),
+        ("process_threads", "gauge", "Number of threads", [({}, threading.active_count())]),
+    ]
+    pss = pss_bytes()
+    if pss is not None:
+        metrics.append(("process_proportional_memory_bytes", "gauge", "Proportional set size", [({}, pss)]))
+    return metrics
+
+
+register_collector(_process_metrics)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        for name, kind, help, samples in collector():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def otel_hook():
+    """Hook opening an OpenTelemetry span per stage (needs opentelemetry-api)."""
+    from opentelemetry import trace
+    tracer = trace.get_tracer("avalanche")
+    return tracer.start_as_current_span
+
+
+if TRACING == "otel":
+    add_hook(otel_hook())
+
+if REQUEST_LOG and not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
@@ -0,0 +1,112 @@
+"""
+EXIF metadata of uploaded photos, read from the encoded bytes in memory.
+
+Only the JPEG header is walked: marker segments are skipped by their length
+until the Exif APP1 segment, which piexif parses on its own, so neither the
+image data nor a temporary file is touched. Uploads parse it once when they
+are stored (see uploads.py) and sessions keep it for size estimation.
+"""
+import struct
+from dataclasses import dataclass
+from typing import Optional
+
+import piexif
+
+from metrics import timed
+
+EXIF_HEADER = b"Exif\x00\x00"
+# start of scan, the entropy coded image data follows
+SOS = 0xDA
+# markers without a length field
+STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD9)}
+
+
+@dataclass(frozen=True)
+class PhotoMetadata:
+    """What size estimation needs from a photo's EXIF data, None where missing."""
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    altitude: Optional[float] = None
+    focal_length_mm: Optional[float] = None
+    focal_length_35mm: Optional[float] = None
+    make: Optional[str] = None
+    model: Optional[str] = None
+
+    @property
+    def has_position(self):
+        return self.latitude is not None and self.longitude is not None
+
+
+def exif_segment(data: bytes) -> Optional[bytes]:
+    """The Exif APP1 payload of a JPEG (starting with "Exif\\0\\0"), None if it has none."""
+    if data[:2] != b"\xff\xd8":
+        return None
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            # fill byte
+            offset += 1
+            continue
+        if marker in STANDALONE_MARKERS:
+            offset += 2
+            continue
+        if marker == SOS:
+            return None
+        (length,) = struct.unpack(">H", data[offset + 2:offset + 4])
+        if marker == 0xE1 and data[offset + 4:offset + 10] == EXIF_HEADER:
+            return data[offset + 4:offset + 2 + length]
+        offset += 2 + length
+    return None
+
+
+def _rational(value):
+    if not value or not value[1]:
+        return None
+    return value[0] / value[1]
+
+
+def _degrees(value, ref):
+    """GPS (degrees, minutes, seconds) rationals to signed decimal degrees."""
+    parts = [_rational(v) for v in value or ()]
+    if len(parts) != 3 or None in parts:
+        return None
+    degrees = parts[0] + parts[1] / 60 + parts[2] / 3600
+    return -degrees if ref in (b"S", b"W") else degrees
+
+
+def _text(value):
+    if not value:
+        return None
+    return value.decode(errors="ignore").strip("\x00 ") or None
+
+
+@timed("exif")
+def read_metadata(data: bytes) -> PhotoMetadata:
+    """Parse the EXIF data of a JPEG (or TIFF/WebP); empty metadata without any."""
+    segment = exif_segment(data)
+    if segment is None and data[:2] == b"\xff\xd8":
+        return PhotoMetadata()
+    try:
+        exif = piexif.load(segment if segment is not None else data)
+    except Exception:
+        # formats piexif can't read from memory, or corrupt EXIF data
+        return PhotoMetadata()
+
+    zeroth, gps, exif_ifd = exif.get("0th", {}), exif.get("GPS", {}), exif.get("Exif", {})
+    altitude = _rational(gps.get(piexif.GPSIFD.GPSAltitude))
+    if altitude is not None and gps.get(piexif.GPSIFD.GPSAltitudeRef) == 1:
+        # below sea level
+        altitude = -altitude
+    return PhotoMetadata(
+        latitude=_degrees(gps.get(piexif.GPSIFD.GPSLatitude), gps.get(piexif.GPSIFD.GPSLatitudeRef)),
+        longitude=_degrees(gps.get(piexif.GPSIFD.GPSLongitude), gps.get(piexif.GPSIFD.GPSLongitudeRef)),
+        altitude=altitude,
+        focal_length_mm=_rational(exif_ifd.get(piexif.ExifIFD.FocalLength)),
+        # 0 means unknown
+        focal_length_35mm=exif_ifd.get(piexif.ExifIFD.FocalLengthIn35mmFilm) or None,
+        make=_text(zeroth.get(piexif.ImageIFD.Make)),
+        model=_text(zeroth.get(piexif.ImageIFD.Model)),
+    )
@@ -0,0 +1,310 @@
+"""
+Pre-fork deployment: worker processes sharing one copy of the model weights.
+
+Running uvicorn with several workers loads both ResNet50s and SAM2 in every
+process. Here the parent loads them once and then forks the workers, which
+share the weight tensors copy-on-write: inference only reads them, so their
+pages are never copied (gc.freeze keeps the garbage collector from writing
+to the parent's objects as well). Each worker serves the app on a Unix
+socket with WORKER_THREADS torch threads, so the workers together don't
+oversubscribe the cores.
+
+Sessions, uploads and SAM2 embeddings live in the worker that created them.
+Workers prefix the ids they hand out with their index ("3-9f86d0..."), and
+a router in front of them sends every request naming a session_id or
+image_id to that worker; other requests go to the worker with the fewest
+requests in flight, `X-Worker: <index>` picks one explicitly (e.g. to scrape
+its /metrics). GET /readyz is answered by the router, 200 once every worker
+is ready. The memory budgets of the per-process caches (SESSION_MAX_MB,
+UPLOAD_CACHE_MB, SAM_EMBEDDING_CACHE_MB) are split between the workers, so
+the total stays that of a single process.
+
+The parent only supervises: it restarts workers and the router when they
+exit and stops them all on SIGTERM or SIGINT.
+
+    python prefork.py --workers 4
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from config import (
+    CLASSIFIER_BACKEND, ROUTER_HOST, ROUTER_MAX_BODY_MB, ROUTER_PORT, SAM_EMBEDDING_CACHE_MB,
+    SAM_MODEL, SAM_PREVIEW_MODEL, SESSION_MAX_MB, UPLOAD_CACHE_MB, WORKER_THREADS, WORKERS,
+)
+
+# An id handed out by worker N in a JSON body, form field or query string
+ID_FIELD = re.compile(rb'(?:session_id|image_id)(?:"\s*:\s*"|"\r\n(?:[^\r\n]*\r\n)*\r\n|=)(\d+)-')
+# An id as path parameter, /refine/{session_id}
+ID_PATH = re.compile(rb'/(\d+)-[0-9a-f]{32}')
+# Workers restarting more often than this are restarted after a pause
+MIN_UPTIME_S = 10
+
+
+def load_models():
+    """Load the weights the workers share, without starting any thread."""
+    from classifier_backends import CLASSIFIERS
+    from classifiers import get_batcher
+    from inference import get_sam_model
+
+    # ONNX Runtime sessions own a thread pool, which doesn't survive fork;
+    # with that backend every worker loads its own classifiers
+    if CLASSIFIER_BACKEND != "onnx":
+        for name in CLASSIFIERS:
+            get_batcher(name)
+    for variant in {SAM_MODEL, SAM_PREVIEW_MODEL} - {None}:
+        get_sam_model('cpu', variant)
+
+
+def run_worker(index, socket_path, workers, threads):
+    """Serve the app on `socket_path`, in a freshly forked worker."""
+    import torch
+    import uvicorn
+
+    import app_fastapi
+    import inference
+    from sessions import SessionStore
+    from uploads import UploadStore
+
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(threads)
+    except RuntimeError:
+        # inter-op pool already started in the parent
+        pass
+
+    prefix = f"{index}-"
+    app_fastapi.sessions = SessionStore(max_bytes=SESSION_MAX_MB * 1024 * 1024 // workers, id_prefix=prefix)
+    app_fastapi.uploads = UploadStore(UPLOAD_CACHE_MB * 1024 * 1024 // workers, id_prefix=prefix)
+    inference.embedding_cache.max_bytes = SAM_EMBEDDING_CACHE_MB * 1024 * 1024 // workers
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    uvicorn.run(app_fastapi.app, uds=socket_path)
+
+
+class Router:
+    """
+    HTTP front of the workers. Requests are read whole and forwarded with
+    `Connection: close`; the worker's response is relayed unchanged.
+    """
+
+    def __init__(self, sockets, max_body=ROUTER_MAX_BODY_MB * 1024 * 1024):
+        self.sockets = sockets
+        self.max_body = max_body
+        self.in_flight = [0] * len(sockets)
+        self._next = 0
+
+    def pick(self, target: bytes, headers: dict, body: bytes) -> int:
+        """The worker holding the session or upload named by the request, else the least busy one."""
+        forced = headers.get(b"x-worker")
+        match = ID_PATH.search(target) or ID_FIELD.search(target) or ID_FIELD.search(body)
+        index = int(forced) if forced and forced.isdigit() else int(match.group(1)) if match else None
+        if index is not None and index < len(self.sockets):
+            return index
+        # round robin between equally busy workers
+        n = len(self.sockets)
+        start, self._next = self._next, (self._next + 1) % n
+        return min(((start + i) % n for i in range(n)), key=self.in_flight.__getitem__)
+
+    async def handle(self, reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            request_line, *header_lines = head[:-4].split(b"\r\n")
+            _, target, _ = request_line.split(b" ", 2)
+            headers = {}
+            for line in header_lines:
+                name, _, value = line.partition(b":")
+                headers[name.strip().lower()] = value.strip()
+            if b"chunked" in headers.get(b"transfer-encoding", b"").lower():
+                return await self.respond(writer, 411, {"error": "Content-Length required"})
+            length = int(headers.get(b"content-length", 0))
+            if length > self.max_body:
+                return await self.respond(writer, 413, {"error": "Request body too large"})
+            if headers.get(b"expect", b"").lower() == b"100-continue":
+                writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            body = await reader.readexactly(length)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            writer.close()
+            return
+
+        try:
+            if target.split(b"?")[0] == b"/readyz":
+                return await self.readyz(writer)
+            index = self.pick(target, headers, body)
+            self.in_flight[index] += 1
+            try:
+                upstream_reader, upstream = await asyncio.open_unix_connection(self.sockets[index])
+            except OSError:
+                self.in_flight[index] -= 1
+                return await self.respond(writer, 503, {"error": f"Worker {index} unavailable"}, retry_after=1)
+            try:
+                header_lines = [line for line in header_lines
+                                if not line.lower().startswith((b"connection:", b"keep-alive:", b"expect:"))]
+                upstream.write(b"\r\n".join([request_line, *header_lines, b"Connection: close", b"", b""]) + body)
+                await upstream.drain()
+                while chunk := await upstream_reader.read(65536):
+                    writer.write(chunk)
+                    await writer.drain()
+            finally:
+                self.in_flight[index] -= 1
+                upstream.close()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def fetch_status(self, index, path=b"/readyz"):
+        """Status code of a GET to worker `index`, None if it is down."""
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.sockets[index])
+        except OSError:
+            return None
+        try:
+            writer.write(b"GET " + path + b" HTTP/1.1\r\nHost: worker\r\nConnection: close\r\n\r\n")
+            status_line = await reader.readline()
+            return int(status_line.split()[1])
+        except (ConnectionError, IndexError, ValueError):
+            return None
+        finally:
+            writer.close()
+
+    async def readyz(self, writer):
+        statuses = await asyncio.gather(*(self.fetch_status(i) for i in range(len(self.sockets))))
+        ready = all(status == 200 for status in statuses)
+        await self.respond(writer, 200 if ready else 503, {
+            "status": "ready" if ready else "loading",
+            "workers": {str(i): status or "down" for i, status in enumerate(statuses)},
+        })
+
+    async def respond(self, writer, status, content, retry_after=None):
+        body = json.dumps(content).encode()
+        head = [f"HTTP/1.1 {status} {_REASONS.get(status, '')}", "Content-Type: application/json",
+                f"Content-Length: {len(body)}", "Connection: close"]
+        if retry_after is not None:
+            head.append(f"Retry-After: {retry_after}")
+        writer.write("\r\n".join(head).encode() + b"\r\n\r\n" + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+
+_REASONS = {200: "OK", 411: "Length Required", 413: "Content Too Large", 503: "Service Unavailable"}
+
+
+def run_router(sockets, host, port):
+    async def serve():
+        router = Router(sockets)
+        server = await asyncio.start_server(router.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def spawn(target, *args):
+    """Fork a child running `target(*args)`, return its pid."""
+    pid = os.fork()
+    if pid:
+        return pid
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    code = 0
+    try:
+        target(*args)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def default_threads(workers):
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    return max(1, cores // workers)
+
+
+def serve(workers=WORKERS, threads=WORKER_THREADS, host=ROUTER_HOST, port=ROUTER_PORT, stub_models=False):
+    """Load the models, fork `workers` workers and the router, and supervise them until stopped."""
+    threads = threads or default_threads(workers)
+    if stub_models:
+        from loadtest import install_stubs
+        install_stubs()
+    else:
+        import app_fastapi  # noqa: F401, the app the workers run
+        started = time.monotonic()
+        load_models()
+        print(f"Loaded models in {time.monotonic() - started:.1f}s", file=sys.stderr)
+    if threading.active_count() > 1:
+        print(f"Warning: {threading.active_count() - 1} threads running before fork, "
+              "they won't exist in the workers", file=sys.stderr)
+    # everything allocated so far is shared, keep the collector off it
+    gc.collect()
+    gc.freeze()
+
+    socket_dir = tempfile.mkdtemp(prefix="avalanche-workers-")
+    sockets = [os.path.join(socket_dir, f"worker-{i}.sock") for i in range(workers)]
+    roles = [(run_worker, i, sockets[i], workers, threads) for i in range(workers)]
+    roles.append((run_router, sockets, host, port))
+    children = {}
+
+    def start(role):
+        children[spawn(*role)] = (role, time.monotonic())
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for role in roles:
+        start(role)
+    print(f"{workers} workers with {threads} threads each, routing on http://{host}:{port}", file=sys.stderr)
+
+    try:
+        while children:
+            pid, status = os.wait()
+            role, started = children.pop(pid)
+            if stopping:
+                continue
+            name = "router" if role[0] is run_router else f"worker {role[1]}"
+            print(f"{name} exited with status {os.waitstatus_to_exitcode(status)}, restarting", file=sys.stderr)
+            if time.monotonic() - started < MIN_UPTIME_S:
+                time.sleep(1)
+            if not stopping:
+                start(role)
+    finally:
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the app from pre-forked workers sharing the models")
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--threads', type=int, default=WORKER_THREADS,
+                        help="torch threads per worker, 0 splits the cores evenly")
+    parser.add_argument('--host', default=ROUTER_HOST)
+    parser.add_argument('--port', type=int, default=ROUTER_PORT)
+    parser.add_argument('--stub-models', action='store_true',
+                        help="replace the models by the load test's stand-ins")
+    args = parser.parse_args()
+    serve(args.workers, args.threads, args.host, args.port, args.stub_models)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Persistent store of submitted reports and their final masks.
+
+Reports live in an SQLite database with the report id as primary key and an
+index on the photo's geolocation, so single reports and all reports in an
+area are found without a scan. Every object mask is stored twice in compact
+form, both much smaller than a PNG of the mask:
+
+- COCO run-length encoding (column-major runs, compressed to the counts
+  string of pycocotools), lossless and decoded back in a few milliseconds.
+- Polygons of the mask's outer contours and holes, simplified with
+  Douglas-Peucker, for drawing or GIS export without decoding anything.
+
+Masks are kept at the session's (decoded view) resolution, polygons and
+areas in pixels of the original photo.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import cv2
+import numpy as np
+
+from config import REPORT_DB_PATH, REPORT_POLYGON_TOLERANCE_PX
+from metrics import timed
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    report_id TEXT PRIMARY KEY,
+    image_id TEXT,
+    created REAL NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    latitude REAL,
+    longitude REAL,
+    avalanche_type INTEGER,
+    size_m2 REAL
+);
+CREATE INDEX IF NOT EXISTS reports_location ON reports (latitude, longitude);
+CREATE TABLE IF NOT EXISTS masks (
+    report_id TEXT NOT NULL REFERENCES reports (report_id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    area INTEGER NOT NULL,
+    rle TEXT NOT NULL,
+    polygons TEXT NOT NULL,
+    PRIMARY KEY (report_id, idx)
+);
+"""
+
+REPORT_COLUMNS = ("report_id", "image_id", "created", "width", "height",
+                  "latitude", "longitude", "avalanche_type", "size_m2")
+
+
+def rle_counts(mask: np.ndarray) -> np.ndarray:
+    """COCO run lengths: column-major, alternating background/mask, starting with background."""
+    flat = mask.ravel(order="F")
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    runs = np.diff(np.concatenate([[0], changes, [len(flat)]]))
+    if len(flat) and flat[0]:
+        runs = np.concatenate([[0], runs])
+    return runs
+
+
+def encode_rle(mask: np.ndarray) -> str:
+    """Mask as the compressed COCO RLE counts string (pycocotools' `rleToString`)."""
+    counts = rle_counts(mask).tolist()
+    chars = []
+    for i, x in enumerate(counts):
+        # runs are stored relative to the run of the same kind before
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1F
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return "".join(chars)
+
+
+def decode_rle(counts: str, shape) -> np.ndarray:
+    """Inverse of `encode_rle` for a mask of `shape` (height, width)."""
+    runs = []
+    x = k = 0
+    for char in counts:
+        c = ord(char) - 48
+        x |= (c & 0x1F) << (5 * k)
+        k += 1
+        if c & 0x20:
+            continue
+        if c & 0x10:
+            x |= -1 << (5 * k)
+        if len(runs) > 2:
+            x += runs[-2]
+        runs.append(x)
+        x = k = 0
+    values = np.arange(len(runs)) % 2 == 1
+    flat = np.repeat(values, runs)
+    return flat.reshape(shape[1], shape[0]).T
+
+
+def mask_polygons(mask: np.ndarray, scale=(1.0, 1.0), tolerance=REPORT_POLYGON_TOLERANCE_PX):
+    """
+    Simplified outlines of a mask as [{"outer": [[x, y], ...], "holes": [...]}],
+    with coordinates multiplied by `scale` (x, y).
+    """
+    contours, hierarchy = cv2.findContours(mask.astype(np.uint8), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    if hierarchy is None:
+        return []
+
+    def points(contour):
+        contour = cv2.approxPolyDP(contour, tolerance, True)[:, 0].astype(np.float64)
+        return np.round(contour * scale, 1).tolist()
+
+    polygons = []
+    # with RETR_CCOMP outer contours have no parent and holes are their children
+    for i, (_, _, child, parent) in enumerate(hierarchy[0]):
+        if parent != -1:
+            continue
+        outer = points(contours[i])
+        if len(outer) < 3:
+            # specks that simplify to a point or line
+            continue
+        holes = []
+        while child != -1:
+            hole = points(contours[child])
+            if len(hole) >= 3:
+                holes.append(hole)
+            child = hierarchy[0][child][0]
+        polygons.append({"outer": outer, "holes": holes})
+    return polygons
+
+
+class ReportStore:
+    """Reports and their masks in an SQLite database, safe to share between threads."""
+
+    def __init__(self, path=REPORT_DB_PATH):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA foreign_keys = ON")
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM reports").fetchone()[0]
+
+    @timed("report_save")
+    def save(self, masks, original_size, image_id=None, latitude=None, longitude=None,
+             avalanche_type=None, size_m2=None) -> str:
+        """
+        Store a report with its boolean object masks (all of one shape), given
+        the (width, height) of the original photo. Returns the new report id.
+        """
+        report_id = uuid.uuid4().hex
+        width, height = original_size
+        rows = []
+        for idx, mask in enumerate(masks):
+            scale = (width / mask.shape[1], height / mask.shape[0])
+            rows.append((
+                report_id, idx, mask.shape[0], mask.shape[1], round(int(mask.sum()) * scale[0] * scale[1]),
+                encode_rle(mask), json.dumps(mask_polygons(mask, scale), separators=(",", ":")),
+            ))
+        with self._lock, self._db:
+            self._db.execute(
+                f"INSERT INTO reports ({', '.join(REPORT_COLUMNS)}) VALUES ({', '.join('?' * len(REPORT_COLUMNS))})",
+                (report_id, image_id, time.time(), width, height, latitude, longitude, avalanche_type, size_m2),
+            )
+            self._db.executemany("INSERT INTO masks VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return report_id
+
+    def get(self, report_id, polygons=True):
+        """The report as a dict (with the polygons of its masks), None if unknown."""
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT {', '.join(REPORT_COLUMNS)} FROM reports WHERE report_id = ?", (report_id,)
+            ).fetchone()
+            mask_rows = self._db.execute(
+                "SELECT area, polygons FROM masks WHERE report_id = ? ORDER BY idx", (report_id,)
+            ).fetchall() if row is not None and polygons else []
+        if row is None:
+            return None
+        report = dict(zip(REPORT_COLUMNS, row))
+        if polygons:
+            report["masks"] = [{"area": area, "polygons": json.loads(p)} for area, p in mask_rows]
+        return report
+
+    def masks(self, report_id):
+        """The report's boolean masks at their stored resolution, None if unknown."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT height, width, rle FROM masks WHERE report_id = ? ORDER BY idx", (report_id,)
+            ).fetchall()
+            if not rows and self._db.execute(
+                "SELECT 1 FROM reports WHERE report_id = ?", (report_id,)
+            ).fetchone() is None:
+                return None
+        return [decode_rle(rle, (height, width)) for height, width, rle in rows]
+
+    def within(self, min_latitude, min_longitude, max_latitude, max_longitude, limit=100):
+        """Reports photographed inside a latitude/longitude box, newest first."""
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {', '.join(REPORT_COLUMNS)} FROM reports "
+                "WHERE latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ? "
+                "ORDER BY created DESC LIMIT ?",
+                (min_latitude, max_latitude, min_longitude, max_longitude, limit),
+            ).fetchall()
+        return [dict(zip(REPORT_COLUMNS, row)) for row in rows]
+
+    def delete(self, report_id):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM reports WHERE report_id = ?", (report_id,))
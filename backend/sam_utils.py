@@ -1,26 +1,8 @@
 import cv2
 import numpy as np
-from inference import run_inference
-from typing import List
-import os
-from PIL import Image
-import os
-from inference import run_inference
-from typing import List
-
-# Create temp directory in the same directory as the script
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-TEMP_DIR = os.path.join(SCRIPT_DIR, 'temp')
-os.makedirs(TEMP_DIR, exist_ok=True)
-
-def save_masks(o_masks, counter):
-    o_files = []
-    for mask, name in o_masks:
-        o_mask = np.uint8(mask * 255)
-        o_file = os.path.join(TEMP_DIR, f'{name}{counter}.png')
-        cv2.imwrite(o_file, o_mask)
-        o_files.append(o_file)
-    return o_files
+from inference import predict_object
+
+from config import MASK_OVERLAY_CACHE_STEPS
 
 
 def overlay_mask(image: np.ndarray, mask: np.ndarray, alpha: float = 0.6):
@@ -32,44 +14,206 @@ def overlay_mask(image: np.ndarray, mask: np.ndarray, alpha: float = 0.6):
     return cv2.addWeighted(overlay, alpha, image, 1 - alpha, 0)
 
 
+def blend_mask(image: np.ndarray, mask: np.ndarray):
+    """
+    Same as `overlay_mask`, but only blends the bounding box of the mask,
+    since pixels outside it are left unchanged anyway.
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return image
+    cols = np.flatnonzero(mask.any(axis=0))
+    y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+    image = image.copy()
+    image[y0:y1, x0:x1] = overlay_mask(image[y0:y1, x0:x1], mask[y0:y1, x0:x1])
+    return image
+
+
+def unpack_mask(packed: np.ndarray, shape) -> np.ndarray:
+    """Boolean mask of `shape` from its bits packed by `np.packbits`."""
+    return np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape).astype(bool)
+
+
+class MaskStack:
+    """
+    Objects of a segmentation session, one mask each, kept in memory as packed
+    bits. An object is started by a click and refined by further foreground or
+    background clicks; its points and SAM's low-res logits of the last
+    prediction are kept so the next click refines the mask instead of
+    starting over.
+
+    The composited overlay after each object is cached so that adding or
+    removing an object costs a single blend. Only the overlays of the last
+    `max_cached_overlays` objects are kept; older ones are rebuilt from the
+    packed masks if undo reaches them.
+    """
+
+    def __init__(self, image: np.ndarray, max_cached_overlays: int = MASK_OVERLAY_CACHE_STEPS):
+        self.image = image
+        self.shape = image.shape[:2]
+        self.max_cached_overlays = max(max_cached_overlays, 1)
+        self._masks = []
+        self._overlays = []
+        # the prompts ([(x, y), ...], [label, ...]) and low-res logits of each object
+        self.prompts = []
+        self.logits = []
+        # per click: the previous (packed mask, logits) of the refined object,
+        # or None if the click started a new object
+        self._history = []
+
+    def __len__(self):
+        return len(self._masks)
+
+    def nbytes(self):
+        return (
+            sum(m.nbytes for m in self._masks)
+            + sum(o.nbytes for o in self._overlays if o is not None)
+            + sum(l.nbytes for l in self.logits)
+            + sum(h[0].nbytes + h[1].nbytes for h in self._history if h is not None)
+        )
+
+    def _unpack(self, packed) -> np.ndarray:
+        return unpack_mask(packed, self.shape)
+
+    def packed(self) -> list:
+        """
+        The packed bits of every object's mask (see `unpack_mask`). The arrays
+        are replaced, never modified, so they can be unpacked without a lock.
+        """
+        return list(self._masks)
+
+    def mask(self, index: int) -> np.ndarray:
+        """Unpack the boolean mask of an object."""
+        return self._unpack(self._masks[index])
+
+    def union(self) -> np.ndarray:
+        """Boolean mask of every pixel covered by any mask in the stack."""
+        if not self._masks:
+            return np.zeros(self.shape, dtype=bool)
+        return self._unpack(np.bitwise_or.reduce(self._masks))
+
+    def composite(self) -> np.ndarray:
+        """Image with every mask in the stack overlaid."""
+        if not self._masks:
+            return self.image
+        if self._overlays[-1] is None:
+            self._rebuild()
+        return self._overlays[-1]
+
+    def push(self, mask: np.ndarray, prompt=None, logits=None) -> np.ndarray:
+        """
+        Add a new object; its overlay is only blended once `composite` is
+        needed, so clients compositing masks themselves never pay for it.
+        """
+        mask = mask > 0
+        self._masks.append(np.packbits(mask, axis=None))
+        self._overlays.append(None)
+        self.prompts.append(prompt)
+        self.logits.append(logits)
+        self._history.append(None)
+
+        stale = len(self._overlays) - self.max_cached_overlays - 1
+        if stale >= 0:
+            self._overlays[stale] = None
+        return mask
+
+    def update(self, mask: np.ndarray, prompt, logits) -> np.ndarray:
+        """Replace the mask of the last object after another click on it."""
+        mask = mask > 0
+        self._history.append((self._masks[-1], self.logits[-1]))
+        self._masks[-1] = np.packbits(mask, axis=None)
+        self._overlays[-1] = None
+        self.prompts[-1] = prompt
+        self.logits[-1] = logits
+        return mask
+
+    def can_undo(self) -> bool:
+        return bool(self._history)
+
+    def pop(self):
+        """
+        Undo the last click. Returns the restored mask of the last object, or
+        None if the click had started an object, which is then removed.
+        """
+        if not self._history:
+            return None
+        previous = self._history.pop()
+        if previous is None:
+            self._masks.pop()
+            self._overlays.pop()
+            self.prompts.pop()
+            self.logits.pop()
+            return None
+        self._masks[-1], self.logits[-1] = previous
+        self._overlays[-1] = None
+        points, labels = self.prompts[-1]
+        self.prompts[-1] = (points[:-1], labels[:-1])
+        return self.mask(-1)
+
+    def replace(self, objects):
+        """
+        Replace every object with the masks of another model, given per
+        object its (mask, logits) after each of its clicks. The earlier
+        clicks become the undo history, prompts are kept.
+        """
+        self._history = []
+        for i, steps in enumerate(objects):
+            packed = [np.packbits(mask > 0, axis=None) for mask, _ in steps]
+            self._history.append(None)
+            self._history.extend(zip(packed[:-1], [logits for _, logits in steps[:-1]]))
+            self._masks[i], self.logits[i] = packed[-1], steps[-1][1]
+        self._overlays = [None] * len(self._masks)
+
+    def _rebuild(self):
+        # replay the masks on top of the most recent cached overlay
+        start = len(self._overlays) - 1
+        while start >= 0 and self._overlays[start] is None:
+            start -= 1
+        image = self._overlays[start] if start >= 0 else self.image
+        for i in range(start + 1, len(self._overlays)):
+            image = blend_mask(image, self.mask(i))
+            if i >= len(self._overlays) - self.max_cached_overlays:
+                self._overlays[i] = image
+
+
 def select_point(
     predictor,
-    original_img: np.ndarray,
+    masks: MaskStack,
     point,
-    counter:int,
+    label: int = 1,
+    new_object: bool = False,
 ):
-    """When user clicks on the image, show points and update the mask."""
-    point = [point.x, point.y]
-    sel_pix = [(point, 1)]
-    input_img = original_img.copy() 
-    # run inference on the original image
-    o_masks = run_inference(predictor, input_img, sel_pix, [])
-    
-    # Create visualization on the display image
-    img = original_img.copy()
-    # Draw the mask
-    if o_masks:
-        mask = o_masks[0][0]  # Get first mask
-        img = overlay_mask(img, mask)
-    
-    o_files = save_masks(o_masks, counter=counter)
-    img = overlay(img, counter)
-    return img
-
-def overlay(image, count: int):
-    image = image.copy()
-    for c in range(count):
-        o_file = os.path.join(TEMP_DIR, f'mask_0{c}.png')
-        if os.path.exists(o_file):
-            mask = Image.open(o_file).convert("L")
-            mask = np.array(mask)
-            image = overlay_mask(image, mask)
-    return image
+    """
+    When user clicks on the image at `point` (x, y), start a new object or
+    refine the last one with a foreground (label 1) or background (label 0)
+    point. Returns the object's new mask and whether it is a new object, or
+    (None, True) if nothing was segmented.
+    """
+    xy = (int(point[0]), int(point[1]))
+    if new_object or not len(masks):
+        if label == 0:
+            # a lone background point selects nothing
+            return None, True
+        mask, logits = predict_object(predictor, [xy], [label])
+        if not mask.any():
+            return None, True
+        return masks.push(mask, ([xy], [label]), logits), True
+
+    points, labels = masks.prompts[-1]
+    points, labels = points + [xy], labels + [label]
+    # feed the previous logits back so SAM refines the mask it already has
+    mask, logits = predict_object(predictor, points, labels, masks.logits[-1])
+    return masks.update(mask, (points, labels), logits), False
+
 
-def undo_points(predictor, orig_img, display_img, multi_object, sel_pix):
-    global counter
-    counter -= 1
-    
-    img = display_img.copy()
-    img = overlay(img, counter) 
-    return img 
\ No newline at end of file
+def refine_masks(predictor, masks: MaskStack):
+    """
+    Recompute every object of the stack from its points with another
+    predictor, in place. The masks after each click are recomputed too, so
+    undo keeps working on the refined masks.
+    """
+    objects = []
+    for points, labels in masks.prompts:
+        objects.append([predict_object(predictor, points[:n], labels[:n]) for n in range(1, len(points) + 1)])
+    masks.replace(objects)
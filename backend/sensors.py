@@ -0,0 +1,188 @@
+"""
+Camera sensor sizes, looked up by the EXIF Make and Model of a photo.
+
+The catalogue is read from CSV or JSON files (the bundled sensors.csv plus
+any listed in SENSOR_DB) with one camera body per row: make, model,
+sensor_width_mm, sensor_height_mm and optional aliases, e.g. the code names
+phones write as EXIF Model ("2107113SG" for the Xiaomi 11T Pro). Names are
+normalized once into a dictionary index, so that "NIKON CORPORATION"/"NIKON Z 9"
+finds "Nikon"/"Z9" in O(1) however large the catalogue gets. Only names the
+index misses fall back to a fuzzy match within the same make, and every
+answer is memoized, so batch runs over archives pay for it once per model.
+
+Unknown cameras get a sensor derived from the 35mm equivalent focal length
+(EXIF FocalLengthIn35mmFilm), and DEFAULT_CAMERA as the last resort.
+"""
+import csv
+import difflib
+import functools
+import json
+import math
+import os
+import re
+from dataclasses import dataclass
+
+from cache import LRUCache
+from config import DEFAULT_CAMERA, SENSOR_DB, SENSOR_LOOKUP_CACHE_SIZE
+
+BUNDLED_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sensors.csv')
+
+# Minimum difflib similarity of normalized models for a fuzzy match
+FUZZY_CUTOFF = 0.9
+# Diagonal of a 36x24mm full frame sensor
+FULL_FRAME_DIAGONAL_MM = math.hypot(36, 24)
+# Legal suffixes of EXIF Make values ("NIKON CORPORATION", "OLYMPUS IMAGING CORP.")
+MAKE_SUFFIXES = {'corporation', 'corp', 'imaging', 'company', 'co', 'ltd', 'inc', 'digital', 'solutions'}
+
+
+@dataclass(frozen=True)
+class Sensor:
+    make: str
+    model: str
+    width_mm: float
+    height_mm: float
+
+    @property
+    def size(self):
+        """(width, height) in meters, as the size estimation expects."""
+        return self.width_mm / 1000, self.height_mm / 1000
+
+
+def _tokens(name):
+    return re.findall(r'[a-z0-9]+', (name or '').lower())
+
+
+def normalize_make(make):
+    tokens = [t for t in _tokens(make) if t not in MAKE_SUFFIXES]
+    return tokens[0] if tokens else ''
+
+
+def normalize_model(model, make_key=''):
+    """Lowercase alphanumerics without separators, and without a leading make."""
+    tokens = _tokens(model)
+    if make_key and tokens and tokens[0] == make_key:
+        tokens = tokens[1:]
+    return ''.join(tokens)
+
+
+class SensorDatabase:
+    """Sensors indexed by normalized (make, model), aliases included."""
+
+    def __init__(self):
+        self._index = {}
+        # normalized model -> sensors of any make, for a missing or unknown make
+        self._models = {}
+        # normalized make -> normalized models, the fuzzy match candidates
+        self._by_make = {}
+        self._lookups = LRUCache(SENSOR_LOOKUP_CACHE_SIZE, sizeof=lambda _: 1)
+
+    def __len__(self):
+        return len({id(s) for s in self._index.values()})
+
+    @classmethod
+    def load(cls, *paths):
+        db = cls()
+        for path in paths:
+            db.load_file(path)
+        return db
+
+    def load_file(self, path):
+        """Add the cameras of a CSV or JSON file, later files override earlier ones."""
+        with open(path, newline='') as f:
+            rows = json.load(f) if path.endswith('.json') else list(csv.DictReader(f))
+        for row in rows:
+            aliases = row.get('aliases') or []
+            if isinstance(aliases, str):
+                aliases = [a for a in aliases.split(';') if a.strip()]
+            sensor = Sensor(row['make'].strip(), row['model'].strip(),
+                            float(row['sensor_width_mm']), float(row['sensor_height_mm']))
+            self.add(sensor, aliases)
+
+    def add(self, sensor, aliases=()):
+        make_key = normalize_make(sensor.make)
+        for name in (sensor.model, *aliases):
+            model_key = normalize_model(name, make_key)
+            self._index[make_key, model_key] = sensor
+            self._models.setdefault(model_key, set()).add(sensor)
+            self._by_make.setdefault(make_key, set()).add(model_key)
+        if len(self._lookups):
+            # memoized misses may be found now
+            self._lookups = LRUCache(self._lookups.max_bytes, sizeof=lambda _: 1)
+
+    def find(self, make, model):
+        """
+        Returns:
+            tuple: (Sensor, "exact" or "fuzzy"), or None if the camera is unknown.
+        """
+        key = (make, model)
+        match = self._lookups.get(key, key)
+        if match is key:
+            match = self._find(make, model)
+            self._lookups.put(key, match)
+        return match
+
+    def _find(self, make, model):
+        make_key = normalize_make(make)
+        if make_key not in self._by_make:
+            # no or an unknown make, the model may still name it ("Canon EOS R5")
+            tokens = _tokens(model)
+            make_key = tokens[0] if tokens and tokens[0] in self._by_make else ''
+        model_key = normalize_model(model, make_key)
+        if not model_key:
+            return None
+
+        sensor = self._index.get((make_key, model_key))
+        if sensor is not None:
+            return sensor, 'exact'
+        candidates = self._models.get(model_key, ())
+        if len(candidates) == 1:
+            return next(iter(candidates)), 'exact'
+
+        # only spelling may differ, "iPhone 16" is not an "iPhone 6"
+        numbers = re.findall(r'\d+', model_key)
+        for make_key in ([make_key] if make_key else self._by_make):
+            candidates = [m for m in self._by_make[make_key] if re.findall(r'\d+', m) == numbers]
+            close = difflib.get_close_matches(model_key, candidates, n=1, cutoff=FUZZY_CUTOFF)
+            if close:
+                return self._index[make_key, close[0]], 'fuzzy'
+        return None
+
+
+def from_35mm_equivalent(focal_length_mm, focal_length_35mm, aspect=4 / 3):
+    """
+    Sensor whose crop factor maps `focal_length_mm` to the 35mm equivalent
+    focal length, with the given width/height aspect. None without both values.
+    """
+    if not focal_length_mm or not focal_length_35mm:
+        return None
+    diagonal = FULL_FRAME_DIAGONAL_MM * focal_length_mm / focal_length_35mm
+    height = diagonal / math.hypot(aspect, 1)
+    return Sensor('', f'{focal_length_35mm:g}mm equivalent', height * aspect, height)
+
+
+@functools.lru_cache(maxsize=None)
+def get_sensor_database():
+    return SensorDatabase.load(BUNDLED_DB, *SENSOR_DB)
+
+
+def find_sensor(make=None, model=None, focal_length_mm=None, focal_length_35mm=None, image_size=None):
+    """
+    The sensor of a photo from its EXIF data: the catalogue entry of its make
+    and model, else one derived from its 35mm equivalent focal length, else
+    DEFAULT_CAMERA.
+
+    Returns:
+        tuple: (Sensor, method), method being "exact", "fuzzy", "35mm_equivalent" or "default"
+    """
+    db = get_sensor_database()
+    match = db.find(make, model) if model else None
+    if match is not None:
+        return match
+
+    aspect = max(image_size) / min(image_size) if image_size else 4 / 3
+    sensor = from_35mm_equivalent(focal_length_mm, focal_length_35mm, aspect)
+    if sensor is not None:
+        return sensor, '35mm_equivalent'
+
+    sensor, _ = db.find(None, DEFAULT_CAMERA)
+    return sensor, 'default'
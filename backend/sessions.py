@@ -0,0 +1,106 @@
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+
+from config import SESSION_MAX_MB, SESSION_TTL_S
+from decoding import to_view
+from sam_utils import MaskStack
+
+
+@dataclass
+class Session:
+    """Segmentation state of one uploaded report."""
+    session_id: str
+    image: np.ndarray
+    predictor: object
+    masks: MaskStack
+    image_id: Optional[str] = None
+    # progressive mode: future of the full model predictor and the running refinement
+    refine_predictor: Optional[object] = None
+    refine_task: Optional[object] = None
+    # the SAM2 variants answering clicks and refining the masks
+    variant: Optional[str] = None
+    refine_variant: Optional[str] = None
+    # (width, height) of the original photo, `image` may be a reduced view of it
+    original_size: Optional[tuple] = None
+    # EXIF data of the photo, see photo_metadata.py
+    metadata: Optional[object] = None
+    # future of `predictor` while the image is being embedded
+    embedding: Optional[object] = None
+    last_access: float = field(default_factory=time.monotonic)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def nbytes(self):
+        return self.image.nbytes + self.masks.nbytes()
+
+    def to_view(self, x, y):
+        """Map a pixel of the original photo to `image`."""
+        if self.original_size is None:
+            return x, y
+        return to_view(x, y, self.original_size, (self.image.shape[1], self.image.shape[0]))
+
+
+class SessionStore:
+    """
+    Sessions keyed by id, evicted after `ttl` seconds of inactivity or,
+    least recently used first, when their memory exceeds `max_bytes`.
+
+    The store lock only guards the index; callers hold `session.lock`
+    while mutating a session so different users never serialize.
+    """
+
+    def __init__(self, ttl=SESSION_TTL_S, max_bytes=SESSION_MAX_MB * 1024 * 1024, id_prefix=""):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # prepended to session ids, tells the pre-fork router the worker (see prefork.py)
+        self.id_prefix = id_prefix
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def nbytes(self):
+        with self._lock:
+            return sum(s.nbytes() for s in self._sessions.values())
+
+    def create(self, image, predictor, image_id=None, refine_predictor=None, original_size=None,
+               metadata=None, embedding=None, variant=None, refine_variant=None):
+        session = Session(
+            self.id_prefix + uuid.uuid4().hex, image, predictor, MaskStack(image), image_id, refine_predictor,
+            variant=variant, refine_variant=refine_variant,
+            original_size=original_size, metadata=metadata, embedding=embedding,
+        )
+        with self._lock:
+            self._sessions[session.session_id] = session
+            self._evict()
+        return session
+
+    def get(self, session_id):
+        """Return a live session, raising KeyError if unknown or expired."""
+        with self._lock:
+            self._evict()
+            session = self._sessions[session_id]
+            session.last_access = time.monotonic()
+        return session
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def _evict(self):
+        now = time.monotonic()
+        for s in [s for s in self._sessions.values() if now - s.last_access > self.ttl]:
+            del self._sessions[s.session_id]
+
+        total = sum(s.nbytes() for s in self._sessions.values())
+        # keep at least the newest session even if it alone exceeds the budget
+        for s in sorted(self._sessions.values(), key=lambda s: s.last_access)[:-1]:
+            if total <= self.max_bytes:
+                break
+            del self._sessions[s.session_id]
+            total -= s.nbytes()
@@ -0,0 +1,255 @@
+"""
+Real surface area of a segmented avalanche by projecting the mask onto terrain.
+
+Every (sub-sampled) mask pixel is turned into a camera ray and intersected with
+a DEM height grid by relaxed height-field tracing: a ray h meters above the
+terrain can safely advance h / (max_slope * |d_horizontal| - d_up), followed
+by a final bisection. A coarse pass over pixel blocks first gives every ray a
+start distance, so most rays converge in a handful of vectorized steps. The
+footprint of a pixel at distance t on terrain with normal n is
+t^2 * solid_angle / |d . n|, and their sum is the avalanche's surface area.
+Rays are processed in chunks so memory stays bounded for 12MP masks.
+"""
+import math
+from dataclasses import dataclass
+
+import numpy as np
+
+from config import TERRAIN_CHUNK_SIZE, TERRAIN_MAX_DISTANCE_M, TERRAIN_MAX_RAYS
+from metrics import timed
+
+# Photos are taken from roughly eye level above the ground
+CAMERA_HEIGHT_M = 1.6
+# Steepest terrain (dz per horizontal meter) the tracing is guaranteed not to step through
+MAX_SLOPE = 2.0
+# Side in (sub-sampled) pixels of the blocks traced first to find start distances
+COARSE_BLOCK = 8
+# Rays hitting the terrain at grazing angles are clamped to avoid exploding areas
+MIN_INCIDENCE_COS = 0.05
+
+
+@dataclass
+class Camera:
+    """
+    Pinhole camera in LV95. `yaw` is the azimuth of the optical axis in degrees
+    clockwise from north, `pitch` is positive upwards and `roll` clockwise.
+    """
+    position: tuple
+    yaw: float
+    pitch: float
+    focal_length: float
+    sensor_size: tuple
+    image_size: tuple
+    roll: float = 0.0
+
+    @classmethod
+    def look_at(cls, position, target, focal_length, sensor_size, image_size):
+        """Camera at `position` whose image center points at `target` (E, N, Z)."""
+        de, dn, dz = np.subtract(target, position)
+        yaw = math.degrees(math.atan2(de, dn))
+        pitch = math.degrees(math.atan2(dz, math.hypot(de, dn)))
+        return cls(tuple(position), yaw, pitch, focal_length, sensor_size, image_size)
+
+    def axes(self):
+        """Unit right, up and forward vectors in (east, north, up)."""
+        yaw, pitch, roll = np.radians([self.yaw, self.pitch, self.roll])
+        forward = np.array([math.sin(yaw) * math.cos(pitch), math.cos(yaw) * math.cos(pitch), math.sin(pitch)])
+        right = np.array([math.cos(yaw), -math.sin(yaw), 0.0])
+        up = np.cross(right, forward)
+        right, up = (
+            right * math.cos(roll) - up * math.sin(roll),
+            right * math.sin(roll) + up * math.cos(roll),
+        )
+        return right, up, forward
+
+    def rays(self, rows, cols):
+        """
+        Unit world directions and solid angles (per pixel) of the rays through
+        the centers of the given pixels.
+        """
+        width, height = self.image_size
+        pixel_w = self.sensor_size[0] / width
+        pixel_h = self.sensor_size[1] / height
+        x = (cols + 0.5 - width / 2) * pixel_w
+        y = (height / 2 - rows - 0.5) * pixel_h
+        norm = np.sqrt(x * x + y * y + self.focal_length ** 2)
+
+        right, up, forward = self.axes()
+        d = (np.outer(x, right) + np.outer(y, up) + self.focal_length * forward) / norm[:, None]
+        solid_angle = pixel_w * pixel_h * self.focal_length / norm ** 3
+        return d, solid_angle
+
+
+def view_bounds(camera, max_distance):
+    """Bounding box (west, south, east, north) of the terrain the camera can see."""
+    e, n, _ = camera.position
+    width, height = camera.image_size
+    corners = np.array([[0, 0], [0, width - 1], [height - 1, 0], [height - 1, width - 1]], dtype=np.float64)
+    d, _ = camera.rays(corners[:, 0], corners[:, 1])
+    horizontal = d[:, :2] / np.maximum(np.linalg.norm(d[:, :2], axis=1, keepdims=True), 1e-9)
+    xs = np.concatenate([[e], e + horizontal[:, 0] * max_distance])
+    ys = np.concatenate([[n], n + horizontal[:, 1] * max_distance])
+    return xs.min(), ys.min(), xs.max(), ys.max()
+
+
+def trace(origin, d, terrain, max_distance, t_start=None, max_iter=200, bisect_iter=8):
+    """
+    Distance along each ray to its first terrain intersection, NaN if the ray
+    leaves the grid or exceeds `max_distance` without hitting. Rays may start
+    at `t_start` if it is known to lie before their intersection.
+    """
+    n = len(d)
+    min_step = terrain.cell_size / 4
+    horizontal = np.hypot(d[:, 0], d[:, 1])
+    closing_rate = MAX_SLOPE * horizontal - d[:, 2]
+
+    t = np.full(n, min_step) if t_start is None else np.maximum(t_start, min_step)
+    t_prev = np.zeros(n)
+    active = np.ones(n, dtype=bool)
+    hit = np.zeros(n, dtype=bool)
+
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        p = origin + t[idx, None] * d[idx]
+        gap = p[:, 2] - terrain.heights(p[:, 0], p[:, 1])
+
+        below = gap <= 0
+        hit[idx[below]] = True
+        lost = np.isnan(gap) | (t[idx] > max_distance)
+        active[idx[below | lost]] = False
+
+        go = ~(below | lost)
+        step = np.where(
+            closing_rate[idx] > 0,
+            gap / np.maximum(closing_rate[idx], 1e-9),
+            max_distance,
+        )
+        step = np.maximum(step, min_step)
+        t_prev[idx[go]] = t[idx[go]]
+        t[idx[go]] += step[go]
+
+    # the hit lies between the last point above and the first point below the terrain
+    idx = np.flatnonzero(hit)
+    lo, hi = t_prev[idx], t[idx]
+    for _ in range(bisect_iter):
+        mid = (lo + hi) / 2
+        p = origin + mid[:, None] * d[idx]
+        above = p[:, 2] > terrain.heights(p[:, 0], p[:, 1])
+        lo = np.where(above, mid, lo)
+        hi = np.where(above, hi, mid)
+
+    distance = np.full(n, np.nan)
+    distance[idx] = (lo + hi) / 2
+    return distance
+
+
+def start_distances(rows, cols, origin, d, terrain, block, max_distance):
+    """
+    Conservative start distances for rays from a coarse pass: half the nearest
+    hit among the ray's and the neighbouring pixel blocks. Rays whose start
+    point would already be below the terrain start from the camera instead.
+    """
+    brows, bcols = rows // block, cols // block
+    _, first = np.unique(brows * (cols.max() // block + 1) + bcols, return_index=True)
+    t_coarse = trace(origin, d[first], terrain, max_distance)
+
+    grid = np.full((brows.max() + 3, bcols.max() + 3), np.inf)
+    grid[brows[first] + 1, bcols[first] + 1] = np.where(np.isnan(t_coarse), 0, t_coarse)
+    nearest = grid[1:-1, 1:-1].copy()
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            nearest = np.minimum(nearest, grid[1 + dr:grid.shape[0] - 1 + dr, 1 + dc:grid.shape[1] - 1 + dc])
+
+    t_start = nearest[brows, bcols] / 2
+    t_start[~np.isfinite(t_start)] = 0
+    p = origin + t_start[:, None] * d
+    below = ~(p[:, 2] > terrain.heights(p[:, 0], p[:, 1]))
+    t_start[below] = 0
+    return t_start
+
+
+def footprint_area(mask, camera, terrain, max_distance=TERRAIN_MAX_DISTANCE_M,
+                   max_rays=TERRAIN_MAX_RAYS, chunk_size=TERRAIN_CHUNK_SIZE):
+    """
+    Surface area in square meters of the terrain covered by the mask.
+
+    Args:
+        mask (np.ndarray): Boolean (H, W) segmentation mask of the photo.
+        camera (Camera): Camera pose and intrinsics; image_size must match the mask.
+        terrain (DEMGrid): Height grid covering the view, see `view_bounds`.
+        max_distance (float): Rays that don't hit terrain within it are ignored.
+        max_rays (int): Masks with more pixels are sub-sampled on a regular
+            grid, each ray then stands for stride^2 pixels.
+        chunk_size (int): Number of rays traced at once.
+
+    Returns:
+        tuple: (area in m^2, dict with the number of rays, hits and the mean distance)
+    """
+    rows, cols = np.nonzero(mask)
+    stride = max(1, int(math.ceil(math.sqrt(len(rows) / max_rays)))) if max_rays else 1
+    if stride > 1:
+        keep = (rows % stride == 0) & (cols % stride == 0)
+        rows, cols = rows[keep], cols[keep]
+        # scale the sub-sampled rays back to the true pixel count
+        weight = mask.sum() / max(len(rows), 1)
+    else:
+        weight = 1.0
+
+    origin = np.asarray(camera.position, dtype=np.float64)
+    area = 0.0
+    hits = 0
+    distance_sum = 0.0
+    for start in range(0, len(rows), chunk_size):
+        chunk_rows, chunk_cols = rows[start:start + chunk_size], cols[start:start + chunk_size]
+        d, solid_angle = camera.rays(chunk_rows, chunk_cols)
+        t_start = start_distances(chunk_rows, chunk_cols, origin, d, terrain, COARSE_BLOCK * stride, max_distance)
+        t = trace(origin, d, terrain, max_distance, t_start)
+        ok = ~np.isnan(t)
+        if not ok.any():
+            continue
+        d, solid_angle, t = d[ok], solid_angle[ok], t[ok]
+
+        p = origin + t[:, None] * d
+        dzdx, dzdy = terrain.gradient(p[:, 0], p[:, 1])
+        normal = np.stack([-dzdx, -dzdy, np.ones_like(dzdx)], axis=1)
+        normal /= np.linalg.norm(normal, axis=1, keepdims=True)
+        incidence = np.maximum(np.abs(np.einsum('ij,ij->i', d, normal)), MIN_INCIDENCE_COS)
+        incidence = np.nan_to_num(incidence, nan=1.0)
+
+        area += float(np.sum(t * t * solid_angle / incidence)) * weight
+        hits += int(ok.sum())
+        distance_sum += float(t.sum())
+
+    stats = {
+        "rays": int(len(rows)),
+        "hits": hits,
+        "stride": stride,
+        "mean_distance": distance_sum / hits if hits else None,
+    }
+    return area, stats
+
+
+@timed("terrain_projection")
+def estimate_area(mask, camera_ground, target, focal_length, sensor_size, dem,
+                  max_distance=TERRAIN_MAX_DISTANCE_M, cell_size=None):
+    """
+    Surface area of the masked terrain for a photo taken standing at
+    `camera_ground` (E, N, ground height) and centered on `target` (E, N, Z).
+    The terrain is cut out of the DEMStore `dem` around the view. Focal length
+    and sensor size are in meters, the sensor is turned to match portrait photos.
+    """
+    height, width = mask.shape
+    if (width > height) != (sensor_size[0] > sensor_size[1]):
+        sensor_size = (sensor_size[1], sensor_size[0])
+    camera = Camera.look_at(camera_ground, target, focal_length, sensor_size, (width, height))
+    terrain = dem.window(*view_bounds(camera, max_distance), cell_size=cell_size)
+
+    # stand on the resampled terrain itself so the camera is never below it
+    ground = terrain.heights(np.array([camera_ground[0]]), np.array([camera_ground[1]]))[0]
+    if np.isnan(ground):
+        ground = camera_ground[2]
+    position = (camera_ground[0], camera_ground[1], float(ground) + CAMERA_HEIGHT_M)
+    camera = Camera.look_at(position, target, focal_length, sensor_size, (width, height))
+    return footprint_area(mask, camera, terrain, max_distance=max_distance)
@@ -0,0 +1,68 @@
+"""Near-duplicate detection: multi-index hash lookups and the dedup index."""
+import io
+import random
+
+import numpy as np
+from PIL import Image
+
+from dedup import DedupIndex, MultiIndexHash
+
+
+def flip_bits(value, count, seed=0):
+    for bit in random.Random(seed).sample(range(64), count):
+        value ^= 1 << bit
+    return value
+
+
+def test_search_finds_hashes_up_to_the_distance():
+    index = MultiIndexHash(max_distance=4)
+    base = 0x0123_4567_89AB_CDEF
+    index.add(base, "base")
+    for seed in range(20):
+        near = flip_bits(base, 4, seed)
+        assert index.search(near) == [(4, "base")]
+        assert index.search(flip_bits(base, 5, seed)) == []
+
+
+def test_search_sorts_by_distance():
+    index = MultiIndexHash(max_distance=6)
+    base = 0xFFFF_0000_FFFF_0000
+    index.add(flip_bits(base, 3, seed=1), "far")
+    index.add(flip_bits(base, 1, seed=2), "near")
+    index.add(base ^ ((1 << 64) - 1), "other")
+    assert [item for _, item in index.search(base)] == ["near", "far"]
+    assert len(index) == 3
+
+
+def photo(seed):
+    rng = np.random.default_rng(seed)
+    # smooth content, so re-encoding keeps the low frequencies
+    small = rng.integers(0, 255, (6, 8, 3), dtype=np.uint8)
+    return Image.fromarray(small).resize((320, 240), Image.BICUBIC)
+
+
+def reencode(image, quality=60, size=None):
+    buffer = io.BytesIO()
+    (image.resize(size) if size else image).save(buffer, "JPEG", quality=quality)
+    return Image.open(io.BytesIO(buffer.getvalue()))
+
+
+def test_index_hits_and_misses():
+    dedup = DedupIndex(max_distance=4)
+    original = photo(0)
+    entry = dedup.match("a", original)
+    entry.verdicts["spam"] = 1
+
+    assert dedup.match("a", original) is entry
+    assert dedup.match("b", reencode(original, size=(160, 120))) is entry
+    other = dedup.match("c", photo(1))
+    assert other is not entry and other.verdicts == {}
+    assert (dedup.exact_hits, dedup.near_hits, dedup.misses) == (1, 1, 2)
+
+
+def test_index_forgets_the_older_half():
+    dedup = DedupIndex(max_distance=2, max_entries=4)
+    entries = [dedup.match(str(i), photo(i)) for i in range(5)]
+    # the oldest entries were dropped, a repeat of the first is a new photo
+    assert dedup.match("0-again", photo(0)) is not entries[0]
+    assert dedup.match("4", photo(4)) is entries[4]
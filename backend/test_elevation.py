@@ -0,0 +1,114 @@
+"""RemoteElevation against a stub height service: retries, coalescing and caching."""
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from elevation import ElevationError, RemoteElevation
+
+
+class StubHeightService:
+    """Answers with a height derived from the point, after `fail` 503s and `delay` seconds."""
+
+    def __init__(self, fail=0, delay=0.0):
+        self.fail = fail
+        self.delay = delay
+        self.requests = Counter()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                params = {k: float(v[0]) for k, v in parse_qs(urlparse(self.path).query).items()}
+                point = (params["easting"], params["northing"])
+                stub.requests[point] += 1
+                if stub.fail > 0:
+                    stub.fail -= 1
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                time.sleep(stub.delay)
+                body = json.dumps({"height": str(stub.height(*point))}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/height"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def height(easting, northing):
+        return round(1000 + easting / 1000 + northing / 10000, 3)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def service():
+    stub = StubHeightService()
+    yield stub
+    stub.close()
+
+
+def test_retries_unavailable_service(service):
+    service.fail = 2
+    remote = RemoteElevation(url=service.url, retries=3, cache_path=None)
+    assert remote.elevation(2600000, 1200000) == service.height(2600000, 1200000)
+    assert service.requests[2600000, 1200000] == 3
+
+
+def test_raises_once_retries_are_exhausted(service):
+    service.fail = 10
+    remote = RemoteElevation(url=service.url, retries=1, cache_path=None)
+    with pytest.raises(ElevationError):
+        remote.elevation(2600000, 1200000)
+
+
+def test_coalesces_concurrent_lookups_of_a_point(service):
+    service.delay = 0.2
+    remote = RemoteElevation(url=service.url, quantum=1, cache_path=None)
+    # all snap to the same 1m cell
+    heights = remote.elevations([(2600000.1, 1200000.2), (2600000.3, 1199999.9), (2600000, 1200000)] * 4)
+    assert len(set(heights)) == 1
+    assert sum(service.requests.values()) == 1
+
+
+def test_caches_heights_in_memory_and_on_disk(service, tmp_path):
+    path = str(tmp_path / "heights.sqlite")
+    remote = RemoteElevation(url=service.url, quantum=0.5, cache_path=path)
+    points = [(2600000, 1200000), (2600010.5, 1200020)]
+    heights = remote.elevations(points)
+    assert remote.elevations(points) == heights
+    assert sum(service.requests.values()) == 2
+
+    # a new client (a restart) reads the file
+    assert RemoteElevation(url=service.url, quantum=0.5, cache_path=path).elevations(points) == heights
+    assert sum(service.requests.values()) == 2
+
+
+def test_disk_cache_is_keyed_by_quantum_and_url(service, tmp_path):
+    path = str(tmp_path / "heights.sqlite")
+    RemoteElevation(url=service.url, quantum=0.5, cache_path=path).elevation(1300000, 600000)
+
+    # the same cell indices are another point on a coarser grid
+    remote = RemoteElevation(url=service.url, quantum=2, cache_path=path)
+    assert remote.elevation(5200000, 2400000) == service.height(5200000, 2400000)
+    assert sum(service.requests.values()) == 2
+
+    other = StubHeightService()
+    try:
+        RemoteElevation(url=other.url, quantum=0.5, cache_path=path).elevation(1300000, 600000)
+        assert sum(other.requests.values()) == 1
+    finally:
+        other.close()
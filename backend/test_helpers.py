@@ -0,0 +1,34 @@
+"""WGS84 to Swiss LV95 conversion."""
+import numpy as np
+import pytest
+
+from helpers import wgs84_to_lv95
+
+
+def dms(degrees, minutes, seconds):
+    return degrees + minutes / 60 + seconds / 3600
+
+
+def test_swisstopo_reference_point():
+    # the worked example of swisstopo's approximate formulas
+    easting, northing, height = wgs84_to_lv95(dms(46, 2, 38.87), dms(8, 43, 49.79), 650.60)
+    assert easting == pytest.approx(2_699_999.76, abs=0.05)
+    assert northing == pytest.approx(1_099_999.97, abs=0.05)
+    assert height == pytest.approx(600.05, abs=0.05)
+
+
+def test_bern_origin():
+    # the old observatory of Bern, origin of the Swiss projection
+    easting, northing = wgs84_to_lv95(dms(46, 57, 3.9), dms(7, 26, 19.1))
+    assert easting == pytest.approx(2_600_000, abs=2)
+    assert northing == pytest.approx(1_200_000, abs=2)
+
+
+def test_converts_arrays_elementwise():
+    latitudes, longitudes = np.array([46.0, 46.5, 47.0]), np.array([7.0, 8.0, 9.0])
+    eastings, northings = wgs84_to_lv95(latitudes, longitudes)
+    assert eastings.shape == northings.shape == (3,)
+    for lat, lon, e, n in zip(latitudes, longitudes, eastings, northings):
+        assert (e, n) == pytest.approx(wgs84_to_lv95(lat, lon))
+    # east and north increase with longitude and latitude
+    assert np.all(np.diff(eastings) > 0) and np.all(np.diff(northings) > 0)
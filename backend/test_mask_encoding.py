@@ -0,0 +1,61 @@
+"""Binary RLE bodies of mask updates: encode_masks / decode_masks round trips."""
+import numpy as np
+import pytest
+
+from mask_encoding import APPEND, POP, REPLACE, UPDATE, decode_masks, encode_masks, mask_runs
+
+
+def random_mask(shape, seed):
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(shape, dtype=bool)
+    for _ in range(3):
+        y, x = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        h, w = rng.integers(1, shape[0] // 2), rng.integers(1, shape[1] // 2)
+        mask[y:y + h, x:x + w] = True
+    # speckles, so runs of length 1 occur
+    return mask ^ (rng.random(shape) < 0.01)
+
+
+@pytest.mark.parametrize("operation", [APPEND, REPLACE, UPDATE])
+def test_round_trip(operation):
+    shape = (37, 53)
+    masks = [random_mask(shape, seed) for seed in range(4)]
+    decoded_operation, decoded = decode_masks(encode_masks(masks, shape, operation))
+    assert decoded_operation == operation
+    assert len(decoded) == len(masks)
+    for mask, back in zip(masks, decoded):
+        assert back.shape == shape
+        assert np.array_equal(mask, back)
+
+
+def test_edge_cases_round_trip():
+    shape = (8, 9)
+    full = np.ones(shape, dtype=bool)
+    empty = np.zeros(shape, dtype=bool)
+    corners = np.zeros(shape, dtype=bool)
+    corners[0, 0] = corners[-1, -1] = True
+    _, decoded = decode_masks(encode_masks([full, empty, corners], shape))
+    for mask, back in zip([full, empty, corners], decoded):
+        assert np.array_equal(mask, back)
+
+
+def test_runs_start_with_background_inside_the_box():
+    mask = np.zeros((5, 6), dtype=bool)
+    mask[1:3, 2:5] = True
+    mask[2, 2] = False
+    box, runs = mask_runs(mask)
+    assert box == (2, 1, 3, 2)
+    # the box starts on a mask pixel, so with an empty background run
+    assert runs.tolist() == [0, 3, 1, 2]
+    box, runs = mask_runs(np.zeros((4, 4), dtype=bool))
+    assert box == (0, 0, 0, 0) and len(runs) == 0
+
+
+def test_pop_has_no_masks():
+    operation, masks = decode_masks(encode_masks([], (10, 10), POP))
+    assert (operation, masks) == (POP, [])
+
+
+def test_rejects_other_bodies():
+    with pytest.raises(ValueError):
+        decode_masks(b"PNG\0" + bytes(16))
@@ -0,0 +1,74 @@
+"""ReportStore and its COCO RLE mask encoding, checked against pycocotools."""
+import numpy as np
+import pytest
+
+from reports import ReportStore, decode_rle, encode_rle
+
+
+def blob_mask(shape, seed):
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(shape, dtype=bool)
+    y, x = rng.integers(0, shape[0] // 2), rng.integers(0, shape[1] // 2)
+    mask[y:y + shape[0] // 3, x:x + shape[1] // 3] = True
+    return mask ^ (rng.random(shape) < 0.02)
+
+
+MASKS = [
+    blob_mask((48, 64), 0),
+    blob_mask((48, 64), 1),
+    np.ones((48, 64), dtype=bool),
+    np.zeros((48, 64), dtype=bool),
+]
+
+
+@pytest.mark.parametrize("mask", MASKS)
+def test_rle_matches_pycocotools(mask):
+    mask_utils = pytest.importorskip("pycocotools.mask")
+    coco = mask_utils.encode(np.asfortranarray(mask.astype(np.uint8)))
+    assert encode_rle(mask) == coco["counts"].decode()
+    assert np.array_equal(decode_rle(coco["counts"].decode(), mask.shape), mask)
+
+
+@pytest.mark.parametrize("mask", MASKS)
+def test_rle_round_trip(mask):
+    assert np.array_equal(decode_rle(encode_rle(mask), mask.shape), mask)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ReportStore(str(tmp_path / "reports.sqlite"))
+
+
+def test_saves_and_reads_back_a_report(store):
+    masks = MASKS[:2]
+    # the masks are at half the photo's resolution
+    report_id = store.save(masks, (128, 96), image_id="abc", latitude=46.5, longitude=7.7,
+                           avalanche_type=1, size_m2=1200.0)
+    assert len(store) == 1
+
+    report = store.get(report_id)
+    assert (report["image_id"], report["width"], report["height"]) == ("abc", 128, 96)
+    assert (report["latitude"], report["longitude"], report["avalanche_type"]) == (46.5, 7.7, 1)
+    assert [m["area"] for m in report["masks"]] == [int(m.sum()) * 4 for m in masks]
+    assert all(m["polygons"] for m in report["masks"])
+    assert "masks" not in store.get(report_id, polygons=False)
+
+    for mask, back in zip(masks, store.masks(report_id)):
+        assert np.array_equal(mask, back)
+
+
+def test_finds_reports_inside_a_box(store):
+    inside = store.save(MASKS[:1], (64, 48), latitude=46.5, longitude=7.7)
+    store.save(MASKS[:1], (64, 48), latitude=47.5, longitude=7.7)
+    store.save(MASKS[:1], (64, 48))
+    assert [r["report_id"] for r in store.within(46, 7, 47, 8)] == [inside]
+
+
+def test_unknown_and_deleted_reports(store):
+    assert store.get("nope") is None
+    assert store.masks("nope") is None
+    report_id = store.save(MASKS[:1], (64, 48))
+    store.delete(report_id)
+    assert store.get(report_id) is None
+    assert store.masks(report_id) is None
+    assert len(store) == 0
@@ -0,0 +1,89 @@
+"""MaskStack: objects, refinement clicks and undo."""
+import numpy as np
+
+from sam_utils import MaskStack
+
+
+SHAPE = (20, 30)
+
+
+def box(y0, y1, x0, x1):
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[y0:y1, x0:x1] = True
+    return mask
+
+
+def logits(value):
+    return np.full((1, 256, 256), value, dtype=np.float32)
+
+
+def stack(max_cached_overlays=2):
+    return MaskStack(np.zeros(SHAPE + (3,), dtype=np.uint8), max_cached_overlays)
+
+
+def test_undo_after_append_removes_the_object():
+    masks = stack()
+    masks.push(box(0, 5, 0, 5), ([(1, 1)], [1]), logits(1))
+    masks.push(box(10, 15, 10, 15), ([(12, 12)], [1]), logits(2))
+    assert len(masks) == 2
+
+    assert masks.pop() is None
+    assert len(masks) == 1
+    assert np.array_equal(masks.mask(0), box(0, 5, 0, 5))
+    assert masks.prompts == [([(1, 1)], [1])]
+    assert masks.pop() is None
+    assert len(masks) == 0 and not masks.can_undo()
+
+
+def test_undo_after_update_restores_the_previous_mask():
+    masks = stack()
+    first = box(0, 5, 0, 5)
+    masks.push(first, ([(1, 1)], [1]), logits(1))
+    masks.update(box(0, 8, 0, 8), ([(1, 1), (6, 6)], [1, 1]), logits(2))
+    masks.update(box(0, 8, 0, 4), ([(1, 1), (6, 6), (6, 2)], [1, 1, 0]), logits(3))
+
+    restored = masks.pop()
+    assert np.array_equal(restored, box(0, 8, 0, 8))
+    assert masks.prompts[-1] == ([(1, 1), (6, 6)], [1, 1])
+    assert masks.logits[-1][0, 0, 0] == 2
+
+    assert np.array_equal(masks.pop(), first)
+    assert masks.prompts[-1] == ([(1, 1)], [1])
+    assert masks.logits[-1][0, 0, 0] == 1
+    assert len(masks) == 1
+
+
+def test_union_and_composite_follow_undo():
+    masks = stack(max_cached_overlays=1)
+    objects = [box(0, 5, 0, 5), box(5, 10, 5, 10), box(10, 15, 10, 15)]
+    for i, mask in enumerate(objects):
+        masks.push(mask, ([(i, i)], [1]), logits(i))
+    assert np.array_equal(masks.union(), objects[0] | objects[1] | objects[2])
+    composite = masks.composite()
+    assert composite[12, 12].any() and not composite[18, 28].any()
+
+    masks.pop()
+    # the overlay before the popped object was evicted and is rebuilt
+    composite = masks.composite()
+    assert not composite[12, 12].any() and composite[7, 7].any()
+    assert np.array_equal(masks.union(), objects[0] | objects[1])
+
+
+def test_replace_keeps_undo_history_per_click():
+    masks = stack()
+    masks.push(box(0, 5, 0, 5), ([(1, 1)], [1]), logits(1))
+    masks.update(box(0, 6, 0, 6), ([(1, 1), (5, 5)], [1, 1]), logits(2))
+    masks.push(box(10, 15, 10, 15), ([(12, 12)], [1]), logits(3))
+
+    masks.replace([
+        [(box(0, 4, 0, 4), logits(10)), (box(0, 7, 0, 7), logits(11))],
+        [(box(11, 14, 11, 14), logits(12))],
+    ])
+    assert np.array_equal(masks.mask(0), box(0, 7, 0, 7))
+    assert np.array_equal(masks.mask(1), box(11, 14, 11, 14))
+
+    assert masks.pop() is None
+    assert np.array_equal(masks.pop(), box(0, 4, 0, 4))
+    assert masks.logits[0][0, 0, 0] == 10
+    assert masks.pop() is None
+    assert not masks.can_undo()
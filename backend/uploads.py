@@ -0,0 +1,75 @@
+import functools
+import hashlib
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from PIL import Image
+
+from cache import LRUCache
+from config import UPLOAD_CACHE_MB
+from decoding import decode, resize_min_side
+from photo_metadata import PhotoMetadata, read_metadata
+
+
+@dataclass
+class Upload:
+    """
+    An uploaded report photo, kept encoded and decoded at reduced resolution
+    (see decoding.py). `size` is the (width, height) of the upright original.
+    """
+    image_id: str
+    data: bytes
+    image: Image.Image
+    size: tuple
+    metadata: PhotoMetadata = field(default_factory=PhotoMetadata)
+    _views: dict = field(default_factory=dict, repr=False)
+    # called when a view is added, so the store can charge its memory
+    _on_resize: Optional[Callable] = field(default=None, repr=False)
+
+    def view(self, min_side: int) -> Image.Image:
+        """The image with its shorter side reduced to `min_side`, resized once."""
+        view = self._views.get(min_side)
+        if view is None:
+            view = self._views.setdefault(min_side, resize_min_side(self.image, min_side))
+            if self._on_resize is not None:
+                self._on_resize()
+        return view
+
+    def nbytes(self):
+        return len(self.data) + sum(
+            width * height * 3 for width, height in
+            [self.image.size] + [v.size for v in list(self._views.values())]
+        )
+
+
+class UploadStore:
+    """
+    Decoded uploads keyed by the hash of their bytes, so a report is
+    transferred and decoded once and then referenced by id from every
+    endpoint. Uploading the same file again returns the same id.
+    """
+
+    def __init__(self, max_bytes=UPLOAD_CACHE_MB * 1024 * 1024, id_prefix=""):
+        self._cache = LRUCache(max_bytes, Upload.nbytes)
+        # prepended to image ids, tells the pre-fork router the worker (see prefork.py)
+        self.id_prefix = id_prefix
+
+    def __len__(self):
+        return len(self._cache)
+
+    def add(self, data: bytes) -> Upload:
+        image_id = self.id_prefix + hashlib.sha256(data).hexdigest()
+        upload = self._cache.get(image_id)
+        if upload is None:
+            image, size = decode(data)
+            upload = Upload(image_id, data, image, size, read_metadata(data))
+            upload._on_resize = functools.partial(self._cache.resize, image_id)
+            self._cache.put(image_id, upload)
+        return upload
+
+    def get(self, image_id: str) -> Upload:
+        """Return a cached upload, raising KeyError if unknown or evicted."""
+        upload = self._cache.get(image_id)
+        if upload is None:
+            raise KeyError(image_id)
+        return upload
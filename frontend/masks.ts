@@ -0,0 +1,92 @@
+// Client side of the backend's RLE mask responses (see backend/mask_encoding.py):
+// the backend only sends the masks that changed and we composite them here.
+
+export const APPEND = 0;
+export const REPLACE = 1;
+export const POP = 2;
+export const UPDATE = 3;
+
+export interface Mask {
+  x0: number;
+  y0: number;
+  width: number;
+  height: number;
+  runs: Uint32Array;
+}
+
+export interface MaskUpdate {
+  operation: number;
+  imageHeight: number;
+  imageWidth: number;
+  masks: Mask[];
+}
+
+export const decodeMasks = (buffer: ArrayBuffer): MaskUpdate => {
+  const view = new DataView(buffer);
+  const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+  if (magic !== 'RLEM') {
+    throw new Error('Invalid mask data received');
+  }
+  const operation = view.getUint8(4);
+  const imageHeight = view.getUint32(8, true);
+  const imageWidth = view.getUint32(12, true);
+  const count = view.getUint32(16, true);
+
+  let offset = 20;
+  const masks: Mask[] = [];
+  for (let i = 0; i < count; i++) {
+    const [x0, y0, width, height, n] = [0, 4, 8, 12, 16].map((o) => view.getUint32(offset + o, true));
+    offset += 20;
+    // copy, the runs aren't necessarily 4-byte aligned in the buffer
+    const runs = new Uint32Array(buffer.slice(offset, offset + 4 * n));
+    offset += 4 * n;
+    masks.push({ x0, y0, width, height, runs });
+  }
+  return { operation, imageHeight, imageWidth, masks };
+};
+
+export const applyMaskUpdate = (masks: Mask[], update: MaskUpdate): Mask[] => {
+  if (update.operation === REPLACE) return update.masks;
+  if (update.operation === POP) return masks.slice(0, -1);
+  if (update.operation === UPDATE) return [...masks.slice(0, -1), ...update.masks];
+  return [...masks, ...update.masks];
+};
+
+const loadImage = (url: string): Promise<HTMLImageElement> =>
+  new Promise((resolve, reject) => {
+    const image = new Image();
+    image.onload = () => resolve(image);
+    image.onerror = reject;
+    image.src = url;
+  });
+
+// Draw the masks in red over the photo, like the backend's overlay (alpha 0.6)
+export const compositeMasks = async (imageUrl: string, masks: Mask[]): Promise<string> => {
+  const image = await loadImage(imageUrl);
+  const canvas = document.createElement('canvas');
+  canvas.width = image.naturalWidth;
+  canvas.height = image.naturalHeight;
+  const ctx = canvas.getContext('2d')!;
+  ctx.drawImage(image, 0, 0);
+
+  for (const mask of masks) {
+    if (mask.width === 0 || mask.height === 0) continue;
+    const pixels = ctx.getImageData(mask.x0, mask.y0, mask.width, mask.height);
+    const data = pixels.data;
+    let position = 0;
+    mask.runs.forEach((run, i) => {
+      if (i % 2 === 1) {
+        for (let p = position; p < position + run; p++) {
+          data[4 * p] = data[4 * p] * 0.4 + 255 * 0.6;
+          data[4 * p + 1] *= 0.4;
+          data[4 * p + 2] *= 0.4;
+        }
+      }
+      position += run;
+    });
+    ctx.putImageData(pixels, mask.x0, mask.y0);
+  }
+
+  const blob: Blob = await new Promise((resolve) => canvas.toBlob((b) => resolve(b!), 'image/jpeg', 0.9));
+  return URL.createObjectURL(blob);
+};
@@ -1,4 +1,5 @@
 import { BACKEND_URI } from '@/config';
+import { Mask, applyMaskUpdate, compositeMasks, decodeMasks } from '@/masks';
 import { useRouter } from 'next/router';
 import { useRef, useState } from "react";
 
@@ -19,6 +20,11 @@ interface ClickCoordinates {
   y: number;
 }
 
+interface SizeEstimate {
+  distance: number;
+  finalSize: number;
+}
+
 export default function Home() {
   const router = useRouter();
   const [isLoading, setIsLoading] = useState(false);
@@ -41,9 +47,16 @@ export default function Home() {
   const [showUndo, setShowUndo] = useState(false);
   const [showToast, setShowToast] = useState(false);
   const [submitted, setSubmitted] = useState(false);
-  const [distance, setDistance] = useState(0);
-  const [finalSize, setFinalSize] = useState(0);
+  // estimated once the user approves the masks, from the avalanche position they enter
+  const [sizeEstimate, setSizeEstimate] = useState<SizeEstimate | null>(null);
+  const [sizeError, setSizeError] = useState<string | null>(null);
+  const [avalancheLatitude, setAvalancheLatitude] = useState("");
+  const [avalancheLongitude, setAvalancheLongitude] = useState("");
   const [originalImgUrl, setOriginalImgUrl] = useState("");
+  const [sessionId, setSessionId] = useState<string | null>(null);
+  // the backend only sends changed masks, we composite them over the photo
+  const [masks, setMasks] = useState<Mask[]>([]);
+  const [photoUrl, setPhotoUrl] = useState<string | null>(null);
 
   const handleShowToast = () => {
     setShowToast(true);
@@ -62,12 +75,27 @@ export default function Home() {
     setIsImageApproved(false);
   };
 
-  // Add this function before handleFileChange
-  const checkIfSpam = async (file: File): Promise<boolean> => {
-
-    // send the coordinates to the backend
+  // Upload the image once, the other endpoints reference it by id
+  const uploadImage = async (file: File): Promise<string> => {
     const formData = new FormData();
     formData.append('file', file);
+    const response = await fetch(`${BACKEND_URI}/upload/`, {
+      method: 'POST',
+      body: formData,
+    });
+
+    if (!response.ok) {
+      throw new Error('Failed to upload files');
+    }
+    const data = await response.json();
+    return data.image_id;
+  };
+
+  const checkIfSpam = async (imageId: string): Promise<{ spam: boolean; sessionId: string | null }> => {
+
+    // send the image id to the backend
+    const formData = new FormData();
+    formData.append('image_id', imageId);
     const response = await fetch(`${BACKEND_URI}/spamcheck/`, {
       method: 'POST',
       body: formData,
@@ -78,13 +106,14 @@ export default function Home() {
     }
     const data = await response.json();
     console.log(data);
-    return data.spam
+    setSessionId(data.session_id ?? null);
+    return { spam: data.spam, sessionId: data.session_id ?? null };
   };
 
-  const predictAvalancheType = async (file: File) => {
-    // send the coordinates to the backend
+  const predictAvalancheType = async (imageId: string) => {
+    // send the image id to the backend
     const formData = new FormData();
-    formData.append('file', file);
+    formData.append('image_id', imageId);
     const response = await fetch(`${BACKEND_URI}/checkavalanchetype/`, {
       method: 'POST',
       body: formData,
@@ -102,23 +131,51 @@ export default function Home() {
     return avalancheType;
 
   }
-  const predictAvalancheSize = async (file: File) => {
-    // send the coordinates to the backend
+  const predictAvalancheSize = async (
+    sessionId: string,
+    position: { latitude: number; longitude: number } | null,
+  ): Promise<SizeEstimate | { error: string }> => {
+    // the backend reads the camera position and focal length from the session's photo
+    // and measures the session's masks
     const formData = new FormData();
-    formData.append('file', file);
+    formData.append('session_id', sessionId);
+    if (position) {
+      formData.append('avalanche_latitude', String(position.latitude));
+      formData.append('avalanche_longitude', String(position.longitude));
+    }
     const response = await fetch(`${BACKEND_URI}/estimate_avalanche_size/`, {
       method: 'POST',
-      //body: formData,
+      body: formData,
     });
 
-    if (!response.ok) {
-      throw new Error('Failed to upload files');
-    }
     const data = await response.json();
     console.log(data);
-
-    return [data.distance, data.finalsize];
+    if (!response.ok) {
+      // e.g. 422 when the photo lacks the EXIF data or the avalanche position is missing
+      return { error: data.error ?? data.detail ?? 'The size could not be estimated' };
+    }
+    return { distance: data.distance, finalSize: data.finalsize };
   }
+
+  const handleEstimateSize = async () => {
+    if (!sessionId) return;
+    const latitude = avalancheLatitude.trim();
+    const longitude = avalancheLongitude.trim();
+    const partial = Boolean(latitude) !== Boolean(longitude);
+    if (partial || (latitude && (isNaN(Number(latitude)) || isNaN(Number(longitude))))) {
+      setSizeError('Enter both the latitude and the longitude of the avalanche');
+      return;
+    }
+    const position = latitude ? { latitude: Number(latitude), longitude: Number(longitude) } : null;
+    const result = await predictAvalancheSize(sessionId, position);
+    if ('error' in result) {
+      setSizeEstimate(null);
+      setSizeError(result.error);
+    } else {
+      setSizeEstimate(result);
+      setSizeError(null);
+    }
+  };
   const possibleavalancheTypes = [
     "none",
     'slab',
@@ -133,6 +190,17 @@ export default function Home() {
     "Very Large"
   ];
 
+  // Apply a binary mask update of the backend and redraw the preview
+  const updateMasks = async (response: Response) => {
+    const update = decodeMasks(await response.arrayBuffer());
+    const updated = applyMaskUpdate(masks, update);
+    setMasks(updated);
+    if (photoUrl) {
+      if (previewUrl && previewUrl !== photoUrl) URL.revokeObjectURL(previewUrl);
+      setPreviewUrl(await compositeMasks(photoUrl, updated));
+    }
+  };
+
   const handleImageClick = async (event: React.MouseEvent<HTMLImageElement>) => {
     if (!imageRef.current) return;
 
@@ -165,24 +233,20 @@ export default function Home() {
         'Content-Type': 'application/json', // Indicate the payload is JSON
       },
       body: JSON.stringify({
+        session_id: sessionId,
         x: x, // Ensure x is an integer
-        y: y  // Ensure y is an integer
+        y: y, // Ensure y is an integer
+        // shift-click excludes the area, ctrl/cmd-click starts another object
+        label: event.shiftKey ? 0 : 1,
+        new_object: event.ctrlKey || event.metaKey,
+        response_format: 'rle',
       }),
     });
 
     if (!response.ok) {
       throw new Error('Failed to upload files');
     }
-    const data = await response.json();
-    console.log(data);
-
-    // Assuming `data.image` is the Base64 encoded image string
-    if (data.image) {
-      const base64Image = `data:image/jpeg;base64,${data.image}`;
-      setPreviewUrl(base64Image); // Update the preview image URL
-    } else {
-      throw new Error('Invalid image data received');
-    }
+    await updateMasks(response);
 
     // set the undo button to true
     setShowUndo(true);
@@ -193,22 +257,16 @@ export default function Home() {
 
     const response = await fetch(`${BACKEND_URI}/undo/`, {
       method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({ session_id: sessionId, response_format: 'rle' }),
     });
 
     if (!response.ok) {
       throw new Error('Failed to upload files');
     }
-    const data = await response.json();
-    console.log(data);
-
-    // Assuming `data.image` is the Base64 encoded image string
-    if (data.image) {
-      const base64Image = `data:image/jpeg;base64,${data.image}`;
-      setPreviewUrl(base64Image); // Update the preview image URL
-    } else {
-      throw new Error('Invalid image data received');
-    }
-    // here i get the image
+    await updateMasks(response);
   };
 
   const handleFileChange = async (event: React.ChangeEvent<HTMLInputElement>) => {
@@ -234,7 +292,12 @@ export default function Home() {
 
     const preview = URL.createObjectURL(file);
     setPreviewUrl(preview);
-    const spamCheckResult = await checkIfSpam(file);
+    setPhotoUrl(preview);
+    setMasks([]);
+    setSizeEstimate(null);
+    setSizeError(null);
+    const imageId = await uploadImage(file);
+    const { spam: spamCheckResult } = await checkIfSpam(imageId);
     setIsSpamCheckComplete(true);
     setIsLoading(false);
 
@@ -247,14 +310,10 @@ export default function Home() {
     }
 
     // Send the image to the backend to predict avalanche type
-    const possibleAvalancheType = await predictAvalancheType(file);
+    const possibleAvalancheType = await predictAvalancheType(imageId);
     if (possibleAvalancheType) {
       setAvalancheType(possibleAvalancheType);
     }
-
-    const possibleAvalancheSize = await predictAvalancheSize(file);
-    setDistance(possibleAvalancheSize[0]);
-    setFinalSize(possibleAvalancheSize[1]);
   };
 
   const handleGoToEditor = async () => {
@@ -341,6 +400,8 @@ export default function Home() {
                             onClick={() => {
                               setIsImageApproved(true);
                               setIsGenerated(true);
+                              // the masks are final, measure them
+                              handleEstimateSize();
                             }}
                             className={`
                             px-6 py-3 rounded-xl font-semibold text-sm transition-all duration-200
@@ -352,7 +413,11 @@ export default function Home() {
                           </button>
                         </div>
                       </div>
-
+                    )}
+                    {isImageApproved === false && (
+                      <p className="text-center text-xs text-gray-500 mt-2">
+                        Click to add to the avalanche, shift-click to exclude an area, ctrl-click to mark another avalanche
+                      </p>
                     )}
 
                   </div>
@@ -412,11 +477,44 @@ export default function Home() {
                     </p>
                     <span className="text-blue-400">{avalancheType}</span>
                   </div>
-                  <div className="relative text-center flex justify-center items-center">
-                    <p className="mb-0 mr-2 text-gray-700 font-bold">
-                      Our model predicted Avalanche Size as {finalSize.toFixed(2)} m^2 (distance to camera is {distance.toFixed(2)} m)
-                    </p>
-                  </div>
+                  {masks.length > 0 && (
+                    <div className="space-y-2">
+                      <div className="flex justify-center items-center gap-2">
+                        <input
+                          type="text"
+                          inputMode="decimal"
+                          value={avalancheLatitude}
+                          onChange={(e) => setAvalancheLatitude(e.target.value)}
+                          placeholder="Avalanche latitude"
+                          className="w-40 px-3 py-2 text-sm text-gray-800 rounded-md border border-gray-300"
+                        />
+                        <input
+                          type="text"
+                          inputMode="decimal"
+                          value={avalancheLongitude}
+                          onChange={(e) => setAvalancheLongitude(e.target.value)}
+                          placeholder="Avalanche longitude"
+                          className="w-40 px-3 py-2 text-sm text-gray-800 rounded-md border border-gray-300"
+                        />
+                        <button
+                          onClick={handleEstimateSize}
+                          className="px-4 py-2 bg-blue-500 text-white text-sm rounded-md hover:bg-blue-600 transition-colors"
+                        >
+                          Estimate size
+                        </button>
+                      </div>
+                      {sizeEstimate && (
+                        <div className="relative text-center flex justify-center items-center">
+                          <p className="mb-0 mr-2 text-gray-700 font-bold">
+                            Our model predicted Avalanche Size as {sizeEstimate.finalSize.toFixed(2)} m^2 (distance to camera is {sizeEstimate.distance.toFixed(2)} m)
+                          </p>
+                        </div>
+                      )}
+                      {sizeError && (
+                        <p className="text-sm text-red-600">{sizeError}</p>
+                      )}
+                    </div>
+                  )}
 
                   <div className="relative text-center flex justify-center items-center">
 